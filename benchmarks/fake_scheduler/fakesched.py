@@ -0,0 +1,146 @@
+"""Shared code for the stand-in scheduler commands in this directory.
+
+Jobs run as local processes. Each job is started by a runner process
+(this module run as a script) which waits for the queue delay and a free
+slot, then runs the job's command and records its state. The state of
+each job is a file in ``$CFUT_FAKE_STATE/jobs``, holding the state and
+the time at which the job ended.
+
+Settings, from the environment:
+
+``CFUT_FAKE_STATE``
+    Directory for the scheduler's state (default ``.cfut-fake``).
+``CFUT_FAKE_DELAY``
+    Seconds each job waits in the "queue" before it starts.
+``CFUT_FAKE_FAILURE_RATE``
+    Fraction of jobs that fail without running, like on a node failure.
+    Condor jobs are held instead.
+``CFUT_FAKE_SLOTS``
+    How many jobs may run at once (default: the number of CPUs).
+"""
+import fcntl
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+STATE_DIR = os.path.abspath(os.environ.get('CFUT_FAKE_STATE', '.cfut-fake'))
+JOBS_DIR = os.path.join(STATE_DIR, 'jobs')
+SLOTS_DIR = os.path.join(STATE_DIR, 'slots')
+DELAY = float(os.environ.get('CFUT_FAKE_DELAY', '0'))
+FAILURE_RATE = float(os.environ.get('CFUT_FAKE_FAILURE_RATE', '0'))
+SLOTS = int(os.environ.get('CFUT_FAKE_SLOTS', '0')) or os.cpu_count() or 1
+
+def next_job_id():
+    """Allocate a new job number."""
+    os.makedirs(JOBS_DIR, exist_ok=True)
+    with open(os.path.join(STATE_DIR, 'counter'), 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        jobid = int(f.read() or 0) + 1
+        f.seek(0)
+        f.truncate()
+        f.write(str(jobid))
+    return jobid
+
+def set_state(jobid, state):
+    path = os.path.join(JOBS_DIR, str(jobid))
+    with open(path + '.tmp', 'w') as f:
+        f.write('%s %f' % (state, time.time()))
+    os.rename(path + '.tmp', path)
+
+def read_states():
+    """Return a dict mapping job IDs to (state, time) pairs."""
+    states = {}
+    try:
+        names = os.listdir(JOBS_DIR)
+    except FileNotFoundError:
+        return states
+    for name in names:
+        if name.endswith('.tmp'):
+            continue
+        try:
+            with open(os.path.join(JOBS_DIR, name)) as f:
+                state, stamp = f.read().split()
+        except (FileNotFoundError, ValueError):
+            continue
+        states[name] = (state, float(stamp))
+    return states
+
+def launch(jobid, argv, env=None, stdout=os.devnull, stderr=None,
+           log=None, condor_id=None):
+    """Queue a job that runs ``argv``, in the background."""
+    set_state(jobid, 'PENDING')
+    spec = {
+        'jobid': str(jobid), 'argv': argv, 'env': env or {},
+        'stdout': stdout, 'stderr': stderr, 'log': log,
+        'condor_id': condor_id,
+    }
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), json.dumps(spec)],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL, start_new_session=True,
+    )
+
+def _take_slot():
+    """Wait for one of the job slots to be free and lock it."""
+    os.makedirs(SLOTS_DIR, exist_ok=True)
+    while True:
+        for i in range(SLOTS):
+            f = open(os.path.join(SLOTS_DIR, str(i)), 'w')
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                continue
+            return f
+        time.sleep(0.01)
+
+def _log_event(log, condor_id, code, text):
+    """Append an event to a Condor user log."""
+    cluster, proc = condor_id
+    event = '%03i (%03i.%03i.000) %s %s\n...\n' % (
+        code, cluster, proc, time.strftime('%m/%d %H:%M:%S'), text
+    )
+    fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, event.encode())
+    finally:
+        os.close(fd)
+
+def run(spec):
+    """Run a queued job: the body of the runner process."""
+    jobid = spec['jobid']
+    log = spec['log']
+    if log:
+        _log_event(log, spec['condor_id'], 0, 'Job submitted from host')
+    time.sleep(DELAY)
+
+    if random.random() < FAILURE_RATE:
+        if log:
+            set_state(jobid, 'HELD')
+            _log_event(log, spec['condor_id'], 12, 'Job was held.')
+        else:
+            set_state(jobid, 'NODE_FAIL')
+        return
+
+    with _take_slot():
+        set_state(jobid, 'RUNNING')
+        if log:
+            _log_event(log, spec['condor_id'], 1, 'Job executing on host')
+        env = dict(os.environ, **spec['env'])
+        with open(spec['stdout'], 'w') as out:
+            err = open(spec['stderr'], 'w') if spec['stderr'] else out
+            with err:
+                code = subprocess.call(spec['argv'], env=env,
+                                       stdout=out, stderr=err)
+        set_state(jobid, 'COMPLETED' if code == 0 else 'FAILED')
+        if log:
+            _log_event(log, spec['condor_id'], 5,
+                       'Job terminated.\n\t(1) Normal termination '
+                       '(return value %i)' % code)
+
+if __name__ == '__main__':
+    run(json.loads(sys.argv[1]))
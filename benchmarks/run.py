@@ -0,0 +1,209 @@
+"""End-to-end throughput and latency benchmarks.
+
+Runs jobs through the executors against the stand-in scheduler commands
+in ``fake_scheduler``, which start each job as a local process, and
+prints the measurements as JSON. For example::
+
+    python benchmarks/run.py --tasks 10 100 1000 --output results.json
+
+Run it from the repository's root so that the jobs can import ``cfut``.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def identity(x):
+    return x
+
+def _percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+def make_executor(cfut, scheduler, mode, options):
+    if mode != 'pool':
+        options = {k: v for k, v in options.items() if k != 'cores'}
+    if scheduler == 'slurm':
+        cls = cfut.SlurmPoolExecutor if mode == 'pool' else cfut.SlurmExecutor
+    else:
+        cls = cfut.CondorPoolExecutor if mode == 'pool' else \
+            cfut.CondorExecutor
+    return cls(**options)
+
+def run_one(cfut, fakesched, scheduler, mode, tasks, payload_size, options):
+    """Run ``tasks`` trivial jobs and measure how it went."""
+    arg = b'x' * payload_size
+    jobs = {}  # Futures and their latest job IDs.
+    done_at = {}
+
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    executor = make_executor(cfut, scheduler, mode, options)
+
+    # Note which scheduler job each future belongs to and when it was
+    # resolved, to compare with when the job ended. A resubmitted job is
+    # registered again under its new ID.
+    register = executor._register
+    def recording_register(fut, workerid, jobid):
+        if id(fut) not in jobs:
+            fut.add_done_callback(
+                lambda f: done_at.setdefault(id(f), time.time())
+            )
+        jobs[id(fut)] = (fut, jobid)
+        register(fut, workerid, jobid)
+    executor._register = recording_register
+
+    with executor:
+        if mode == 'array':
+            executor.map_array(identity, [arg] * tasks)
+        else:
+            for _ in range(tasks):
+                executor.submit(identity, arg)
+        submitted = time.monotonic()
+        peak_bytes = _dir_size(cfut.local_filename())
+
+        failed = resubmitted = 0
+        for fut, _ in list(jobs.values()):
+            if fut.exception() is not None:
+                failed += 1
+            resubmitted += getattr(fut, 'attempts', 1) - 1
+    finished = time.monotonic()
+    cpu = time.process_time() - cpu_start
+
+    states = fakesched.read_states()
+    latencies = []
+    for fut, jobid in jobs.values():
+        # A Condor job submitted on its own is known by its cluster ID.
+        for key in (str(jobid), '%s.0' % jobid):
+            if key in states:
+                latencies.append(done_at[id(fut)] - states[key][1])
+                break
+
+    return {
+        'scheduler': scheduler,
+        'mode': mode,
+        'tasks': tasks,
+        'failed': failed,
+        'resubmitted': resubmitted,
+        'submit_seconds': submitted - start,
+        'submit_per_second': tasks / max(submitted - start, 1e-9),
+        'total_seconds': finished - start,
+        'tasks_per_second': tasks / max(finished - start, 1e-9),
+        'latency_p50': _percentile(latencies, 0.5),
+        'latency_p95': _percentile(latencies, 0.95),
+        'latency_max': max(latencies) if latencies else None,
+        'driver_cpu_seconds': cpu,
+        'payload_bytes': dict(executor.payload_totals),
+        'cfut_dir_bytes_after_submit': peak_bytes,
+        'phases': executor.metrics.summary()['phases'],
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scheduler', nargs='+', default=['slurm'],
+                        choices=['slurm', 'condor'])
+    parser.add_argument('--mode', nargs='+', default=['submit'],
+                        choices=['submit', 'array', 'pool'])
+    parser.add_argument('--tasks', nargs='+', type=int, default=[10, 100])
+    parser.add_argument('--delay', type=float, default=0,
+                        help="seconds each job waits in the queue")
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help="fraction of jobs that die without running")
+    parser.add_argument('--cores', type=int, default=1,
+                        help="tasks each pilot runs at once (pool mode)")
+    parser.add_argument('--retries', type=int, default=0,
+                        help="times to resubmit each failed job")
+    parser.add_argument('--slots', type=int, default=0,
+                        help="jobs that run at once (default: CPUs)")
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help="bytes of data passed to each job")
+    parser.add_argument('--watcher', default='scan')
+    parser.add_argument('--output', help="write JSON here, not stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='cfut-bench-')
+    # These have to be set before cfut is imported, and are inherited by
+    # the fake scheduler commands and the jobs.
+    os.environ.update({
+        'CFUT_FAKE_DELAY': str(args.delay),
+        'CFUT_FAKE_FAILURE_RATE': str(args.failure_rate),
+        'CFUT_FAKE_SLOTS': str(args.slots),
+        'PATH': os.path.join(HERE, 'fake_scheduler') + os.pathsep +
+                os.environ['PATH'],
+    })
+    sys.path.insert(0, os.path.join(HERE, 'fake_scheduler'))
+    sys.path.insert(0, os.getcwd())
+
+    runs = []
+    try:
+        for scheduler in args.scheduler:
+            for mode in args.mode:
+                for tasks in args.tasks:
+                    name = '%s-%s-%i' % (scheduler, mode, tasks)
+                    os.environ['CFUT_DIR'] = os.path.join(workdir, name)
+                    os.environ['CFUT_FAKE_STATE'] = \
+                        os.path.join(workdir, name + '.state')
+                    # Reload so that the new directories take effect.
+                    for module in list(sys.modules):
+                        if module == 'cfut' or module.startswith('cfut.') \
+                                or module == 'fakesched':
+                            del sys.modules[module]
+                    import cfut
+                    import fakesched
+                    print('running %s' % name, file=sys.stderr)
+                    options = {'watcher': args.watcher,
+                               'cores': args.cores}
+                    if args.retries:
+                        options['retry'] = cfut.RetryPolicy(
+                            max_attempts=args.retries + 1, backoff=0,
+                        )
+                    runs.append(run_one(
+                        cfut, fakesched, scheduler, mode, tasks,
+                        args.payload_size, options,
+                    ))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'cfut_version': cfut.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'settings': {
+            'delay': args.delay,
+            'failure_rate': args.failure_rate,
+            'retries': args.retries,
+            'cores': args.cores,
+            'slots': args.slots,
+            'payload_size': args.payload_size,
+            'watcher': args.watcher,
+        },
+        'runs': runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == '__main__':
+    main()
@@ -1,23 +1,35 @@
 """Python futures for Condor clusters."""
+from collections import deque
 from concurrent import futures
-from itertools import count
+import functools
+from itertools import count, islice
+import math
 import os
 import sys
 import threading
 import time
 import traceback
+import weakref
 
+from . import broadcast
 from . import condor
+from . import metrics
+from . import payload
+from . import pool
+from . import push
+from . import session
 from . import slurm
+from . import watch
+from .broadcast import Broadcast
+from .remote import Upstream
 from .util import (
-    random_string, local_filename, INFILE_FMT, OUTFILE_FMT,
+    random_string, local_filename, input_path, output_path, array_workerid,
+    ARRAY_TASK_ID, RateLimiter,
 )
 import cloudpickle
 
 __version__ = '0.5'
 
-LOGFILE_FMT = local_filename('cfut.log.%s.txt')
-
 class RemoteException(Exception):
     def __init__(self, error):
         self.error = error
@@ -26,24 +38,131 @@ class RemoteException(Exception):
         return '\n' + self.error.strip()
 
 class JobDied(Exception):
-    pass
+    def __init__(self, message, state=None):
+        super().__init__(message)
+        self.state = state  # The scheduler's final state for the job.
+
+class RetryPolicy:
+    """When to resubmit jobs that end without writing a result. A job is
+    tried up to ``max_attempts`` times if the scheduler says it ended in
+    one of ``states``: Slurm job states such as ``PREEMPTED``, or the
+    Condor states ``held`` and ``aborted``. The ``n``th resubmission
+    waits ``backoff * factor ** (n - 1)`` seconds, up to ``max_backoff``.
+    """
+    def __init__(self, max_attempts=3,
+                 states=('PREEMPTED', 'NODE_FAIL', 'BOOT_FAIL', 'held'),
+                 backoff=10, factor=2, max_backoff=600):
+        self.max_attempts = max_attempts
+        self.states = set(states)
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+
+    def should_retry(self, state, attempt):
+        """Whether a job that ended in ``state`` on its ``attempt``th try
+        should be tried again.
+        """
+        return state in self.states and attempt < self.max_attempts
+
+    def delay(self, attempt):
+        """How long to wait before the try after ``attempt``."""
+        return min(self.backoff * self.factor ** (attempt - 1),
+                   self.max_backoff)
+
+
+class _LazyOutput:
+    """A finished job's output that is read, once, the first time one of
+    its calls' results is needed.
+    """
+    def __init__(self, read):
+        self.read = read
+        self.lock = threading.Lock()
+        self.outcomes = None
+        self.error = None
+
+    @property
+    def loaded(self):
+        return self.read is None
+
+    def get(self, index):
+        with self.lock:
+            if self.read is not None:
+                try:
+                    self.outcomes = self.read()
+                except Exception as exc:
+                    self.error = exc
+                self.read = None
+        if self.error is not None:
+            raise self.error
+        return self.outcomes[index]
+
+class _Deferred:
+    """Stands in for the result of the ``index``th call in a lazy output."""
+    def __init__(self, output, index):
+        self.output = output
+        self.index = index
+
+    def get(self):
+        success, result = self.output.get(self.index)
+        if not success:
+            raise RemoteException(result)
+        return result
+
+class ClusterFuture(futures.Future):
+    """The future for a call run by a ``ClusterExecutor``. With
+    ``lazy_results``, the call's result is read from its job's output
+    when it is first asked for.
+
+    Passing the future to ``submit`` makes the new call wait for this
+    one's job, and read its result from the job's output file.
+    """
+    def __init__(self, workerid=None, index=None):
+        super().__init__()
+        self.workerid = workerid  # The worker that runs the call.
+        self.index = index  # The call's position in its chunk, if any.
+        self.jobid = None  # The call's job, while it is queued or running.
+
+    def result(self, timeout=None):
+        value = super().result(timeout)
+        if isinstance(value, _Deferred):
+            return value.get()
+        return value
+
+    def exception(self, timeout=None):
+        exc = super().exception(timeout)
+        if exc is None and isinstance(super().result(), _Deferred):
+            try:
+                self.result()
+            except Exception as e:
+                return e
+        return exc
 
 
 class FileWaitThread(threading.Thread):
     """A thread that polls the filesystem waiting for a list of files to
     be created. When a specified file is created, it invokes a callback.
     """
-    def __init__(self, callback, interval=1):
+    def __init__(self, callback, interval=1, watcher='scan'):
         """The callable ``callback`` will be invoked with value
         associated with the filename of each file that is created.
-        ``interval`` specifies the polling rate.
+        ``interval`` specifies the polling rate. ``watcher`` names the
+        way of looking for files (see ``cfut.watch``).
         """
         threading.Thread.__init__(self, daemon=True)
         self.callback = callback
         self.interval = interval
+        self.watcher = watch.make_watcher(watcher)
         self.waiting = {}
         self.lock = threading.Lock()  # To protect the .waiting dict
         self.shutdown = False
+        # A session to keep marked as in use while we wait, if any.
+        self.session = None
+
+        # How long looking for files took, for the most recent check and
+        # in total.
+        self.scan_time = 0.0
+        self.total_scan_time = 0.0
+        self.scans = 0
 
     def stop(self):
         """Stop the thread soon."""
@@ -56,14 +175,25 @@ class FileWaitThread(threading.Thread):
         with self.lock:
             self.waiting[filename] = value
 
+    def forget(self, filename):
+        """Stop waiting for a file. Returns False if it was not being
+        waited upon (because its callback has already been invoked).
+        """
+        with self.lock:
+            return self.waiting.pop(filename, None) is not None
+
     def run(self):
-        for i in count():
-            if self.shutdown:
-                return
+        try:
+            for i in count():
+                if self.shutdown:
+                    return
 
-            with self.lock:
                 self.check(i)
-            time.sleep(self.interval)
+                if self.session is not None:
+                    self.session.touch()
+                time.sleep(self.interval)
+        finally:
+            self.watcher.close()
 
     def check(self, i):
         """Do one check for completed jobs
@@ -71,20 +201,115 @@ class FileWaitThread(threading.Thread):
         The i parameter allows subclasses like SlurmWaitThread to do something
         on every Nth check.
         """
-        # Poll for each file.
-        for filename in list(self.waiting):
-            if os.path.exists(filename):
-                self.callback(self.waiting[filename])
-                del self.waiting[filename]
+        with self.lock:
+            filenames = list(self.waiting)
+
+        # Look for the files without holding the lock, so that submitting
+        # jobs doesn't have to wait for us.
+        start = time.perf_counter()
+        found = self.watcher.found(filenames)
+        self.scan_time = time.perf_counter() - start
+        self.total_scan_time += self.scan_time
+        self.scans += 1
+
+        for filename in found:
+            self.done(filename)
+
+    def done(self, filename, state=None):
+        """Stop waiting for a file and invoke its callback, unless that
+        has already happened. ``state`` is the job's final state, if the
+        scheduler told us.
+        """
+        with self.lock:
+            value = self.waiting.pop(filename, None)
+        if value is not None:
+            self.callback(value, state)
 
 
 class ClusterExecutor(futures.Executor):
     """An abstract base class for executors that run jobs on clusters.
+
+    ``watcher`` chooses how the executor notices jobs' output files:
+    ``'scan'`` lists the directory once per poll, ``'inotify'`` has Linux
+    report new files (scanning where it can't), and ``'stat'`` checks for
+    each outstanding file separately.
+
+    A function that pickles to more than ``broadcast_threshold`` bytes
+    (usually because of what it closes over) is written to the shared
+    filesystem once and loaded from there by each job, rather than being
+    copied into every job's input file. ``None`` turns this off.
+
+    ``codec`` compresses input and output pickles of at least
+    ``compress_threshold`` bytes: ``'zlib'``, or ``'lz4'`` or ``'zstd'``
+    if those packages are installed. Each future gets a
+    ``payload_bytes`` dict with the sizes of its job's input and output
+    before (``in_raw``, ``out_raw``) and after (``in_stored``,
+    ``out_stored``) compression, and ``payload_totals`` adds them up.
+
+    With ``submitters=N``, ``submit`` returns a future straight away and
+    ``N`` background threads pickle the calls and run the scheduler
+    commands. If submitting a job fails, its future gets the exception.
+    ``submit_queue_depth`` is the number of submissions not yet done.
+    ``submit_rate`` limits how many jobs are submitted per second.
+
+    ``retry``, a ``RetryPolicy``, resubmits jobs that the scheduler
+    reports as preempted, failed with their node, or held. A job's input
+    file is kept until its last attempt, and each future's ``attempts``
+    says how many times its job was started.
+
+    ``cache``, a ``cfut.cache.ResultCache``, makes ``submit`` look for
+    the result of an identical call before starting a job, and store
+    the results of successful jobs for next time. Pass ``cache_key`` to
+    ``submit`` to use your own key for a call.
+
+    The wait thread only notices that jobs have finished; their results
+    are read by ``loaders`` threads, so that large results don't hold up
+    noticing other jobs. With ``lazy_results``, a result isn't read
+    until the future's ``result`` (or ``exception``) is called, and if
+    that never happens, it's deleted along with the future.
+
+    A future from the executor can be passed to ``submit`` as an
+    argument. The new job then waits for the future's job to succeed and
+    reads its result from that job's output, which is kept until every
+    job that needs it has finished. On Slurm, the job is submitted
+    straight away with an ``afterok`` dependency; other executors submit
+    it once the result is in. If the future's call fails, so does the
+    new one.
+
+    Each future gets a ``timing`` dict recording when its job went
+    through each step, and ``metrics`` collects these for all the jobs
+    (see ``cfut.metrics``).
+
+    With ``push_results``, the executor runs a server (see ``cfut.push``)
+    and workers send their results straight to it over TCP, so that it
+    hears about them at once instead of at its next look at the shared
+    filesystem. Workers that can't reach it write their output files as
+    usual. ``push_host`` is the name or address that workers connect to
+    (and that the server listens on); by default, the server listens on
+    every interface and workers use this host's name.
+
+    The executor keeps its files in a directory of its own under
+    ``CFUT_DIR`` (see ``cfut.session``), which is removed on shutdown
+    unless ``keep_logs`` is set. When it starts, it removes in the
+    background the directories of executors that haven't used theirs
+    for ``max_session_age`` seconds. ``None`` turns this off.
     """
     wait_thread_cls = FileWaitThread
 
-    def __init__(self, debug=False, keep_logs=False):
+    # With chunksize='auto', pack enough calls into each job for it to run
+    # for roughly this long.
+    target_chunk_seconds = 60
+
+    def __init__(self, debug=False, keep_logs=False, watcher='scan',
+                 broadcast_threshold=2**20, codec=None,
+                 compress_threshold=2**20, submitters=0, submit_rate=None,
+                 cache=None, retry=None, max_session_age=session.MAX_AGE,
+                 loaders=4, lazy_results=False, push_results=False,
+                 push_host=None):
         os.makedirs(local_filename(), exist_ok=True)
+        self.session = session.Session()
+        if max_session_age is not None:
+            session.collect_in_background(max_session_age)
         self.debug = debug
 
         self.jobs = {}
@@ -92,8 +317,78 @@ class ClusterExecutor(futures.Executor):
         self.jobs_lock = threading.Lock()
         self.jobs_empty_cond = threading.Condition(self.jobs_lock)
         self.keep_logs = keep_logs
+        self.call_time = None  # Moving average of observed call run times.
+
+        self.blobs = broadcast.BlobStore(self.session.id)
+        self.blob_refs = {}  # Maps worker IDs to the blobs they use.
+        self.broadcast_threshold = broadcast_threshold
+        # Handles for functions too big to pickle into every input file.
+        self.function_blobs = weakref.WeakKeyDictionary()
+
+        self.codec = payload.Codec(codec, compress_threshold) if codec else None
+        self.payload_bytes = {}  # Maps worker IDs to their payloads' sizes.
+        self.timings = {}  # Maps worker IDs to their timing records.
+        self.cache = cache
+        self.cache_keys = {}  # Maps worker IDs to their calls' cache keys.
+        self.retry = retry
+        self.attempts = {}  # Maps worker IDs of retried jobs to attempts.
+        self.setup_lines = {}  # Worker IDs' own setup lines, for retries.
+        self.metrics = metrics.Metrics()
+        self.payload_totals = dict.fromkeys(
+            ['in_raw', 'in_stored', 'out_raw', 'out_stored'], 0
+        )
+
+        self.submit_pool = None
+        if submitters:
+            self.submit_pool = futures.ThreadPoolExecutor(
+                submitters, thread_name_prefix='cfut-submit'
+            )
+        self.submitting = 0  # Submissions queued or in progress.
+
+        self.load_pool = futures.ThreadPoolExecutor(
+            loaders, thread_name_prefix='cfut-load'
+        )
+        self.loading = 0  # Results waiting to be read, or being read.
+        self.lazy_results = lazy_results
+        self.unread = weakref.WeakSet()  # Lazy results' outputs.
+        self.lazy_workers = set()  # Worker IDs to read lazily regardless.
+
+        self.pending_outputs = set()  # Worker IDs whose outputs are unread.
+        self.output_holds = {}  # Worker IDs' outputs that other jobs need.
+        self.released_outputs = set()  # Held outputs that we've read.
+        self.upstreams = {}  # Maps worker IDs to the futures they need.
+        self.after = set()  # Worker IDs of jobs with scheduler dependencies.
+        self.rate_limiter = RateLimiter(submit_rate) if submit_rate else None
+
+        self.watcher = watcher
+        self.wait_thread = self._make_wait_thread(
+            self.wait_thread_cls, self._completion, watcher
+        )
+        # Jobs can run for longer than an unused session is kept.
+        self.wait_thread.session = self.session
+        self._start_waiting()
+
+        self.result_server = None
+        if push_results:
+            self.result_server = push.ResultServer(self.session, self._pushed,
+                                                   push_host)
 
-        self.wait_thread = self.wait_thread_cls(self._completion)
+    @property
+    def result_address(self):
+        """Where workers should send their results, or None."""
+        if self.result_server is None:
+            return None
+        return self.result_server.address
+
+    def _pushed(self, workerid):
+        """Called when a worker has sent its result to the server."""
+        self.wait_thread.done(output_path(workerid))
+
+    def _make_wait_thread(self, cls, callback, watcher):
+        return cls(callback, watcher=watcher)
+
+    def _start_waiting(self):
+        """Start noticing when jobs finish."""
         self.wait_thread.start()
 
     def _start(self, workerid, additional_setup_lines):
@@ -103,97 +398,785 @@ class ClusterExecutor(futures.Executor):
         """
         raise NotImplementedError()
 
+    def _start_array(self, arrayid, count, throttle, additional_setup_lines):
+        """Start an array of ``count`` jobs in a single scheduler call.
+        The ``i``th job should run ``python -m cfut.remote
+        <arrayid>+<i>``, which is the worker ``array_workerid(arrayid,
+        i)``. Return a list of job IDs, one per worker. At most
+        ``throttle`` of the jobs should run at once, if given.
+        """
+        raise NotImplementedError()
+
+    def _start_after(self, workerid, upstream, additional_setup_lines):
+        """Start a job that the scheduler should only run once the jobs
+        computing the futures in ``upstream`` have succeeded, and return
+        its job ID. Return None to leave it to the executor, which starts
+        the job itself once those futures are done.
+        """
+        return None
+
     def _cleanup(self, jobid):
         """Given a job ID as returned by _start, perform any necessary
         cleanup after the job has finished.
         """
 
-    def _completion(self, jobid):
-        """Called whenever a job finishes."""
+    def _abandon(self, jobid, state):
+        """Called for a job that ended in ``state`` without writing its
+        result, before it is retried or given up on. Remove it from the
+        scheduler if it could still run.
+        """
+
+    def _completion(self, jobid, state=None):
+        """Called whenever a job finishes. ``state`` is its final state
+        according to the scheduler, if known.
+        """
         with self.jobs_lock:
             fut, workerid = self.jobs.pop(jobid)
-            if not self.jobs:
-                self.jobs_empty_cond.notify_all()
+            for f in (fut if isinstance(fut, list) else [fut]):
+                f.jobid = None
+            retry = self._should_retry(workerid, state)
+            redefer = not retry and self._broke_dependency(workerid, state)
+            lazy = (self.lazy_results or workerid in self.lazy_workers) and \
+                not retry and os.path.exists(output_path(workerid))
+            # Keep shutdown waiting for the job to be resubmitted, or for
+            # its result to be read.
+            if retry or redefer:
+                self.submitting += 1
+            elif not lazy:
+                self.loading += 1
+            self._notify_if_idle()
         if self.debug:
-            print("job completed: %i" % jobid, file=sys.stderr)
+            print("job completed: %s" % jobid, file=sys.stderr)
+        self.session.touch()
 
-        try:
-            with open(OUTFILE_FMT % workerid, 'rb') as f:
-                outdata = f.read()
-        except FileNotFoundError:
-            fut.set_exception(
-                JobDied(f"Cluster job {jobid} finished without writing a result")
-            )
+        if state is not None and not os.path.exists(output_path(workerid)):
+            self._abandon(jobid, state)
+        if retry:
+            self._cleanup(jobid)
+            attempt = self.attempts.get(workerid, 1)
+            self.attempts[workerid] = attempt + 1
+            if self.debug:
+                print("job %s ended in state %s; retrying" % (jobid, state),
+                      file=sys.stderr)
+            timer = threading.Timer(self.retry.delay(attempt),
+                                    self._resubmit, (fut, workerid))
+            timer.daemon = True
+            timer.start()
+            return
+        if redefer:
+            # Start it again once its upstream jobs are really done.
+            self._cleanup(jobid)
+            self.after.discard(workerid)
+            self._defer(fut, workerid, self.upstreams[workerid])
+            return
+
+        # A chunk job has a list of futures, one for each call.
+        futs = fut if isinstance(fut, list) else [fut]
+        sizes = self.payload_bytes.pop(workerid, {})
+        timing = self.timings.pop(workerid, {})
+        timing['detected'] = time.time()
+        cache_key = self.cache_keys.pop(workerid, None)
+        attempts = self.attempts.pop(workerid, 1)
+        self.setup_lines.pop(workerid, None)
+        self.lazy_workers.discard(workerid)
+        for fut in futs:
+            fut.payload_bytes = sizes
+            fut.timing = timing
+            fut.attempts = attempts
+
+        # Clean up communication files.
+        payload.remove(input_path(workerid))
+        self.blobs.release(self.blob_refs.pop(workerid, ()))
+        self._release_upstream(workerid)
+        self._cleanup(jobid)
+
+        # Reading the result can take a while, so it's done elsewhere:
+        # when it's asked for, or on a loader thread.
+        if lazy:
+            output = _LazyOutput(functools.partial(
+                self._read_output, jobid, workerid, len(futs), sizes,
+                timing, cache_key
+            ))
+            weakref.finalize(output, self._drop_output, workerid)
+            self.unread.add(output)
+            for i, fut in enumerate(futs):
+                fut.set_result(_Deferred(output, i))
         else:
-            success, result = cloudpickle.loads(outdata)
+            self.load_pool.submit(self._finish, jobid, workerid, futs, sizes,
+                                  timing, cache_key, state)
 
-            if success:
-                fut.set_result(result)
+    def _finish(self, jobid, workerid, futs, sizes, timing, cache_key, state):
+        """Read a finished job's result and resolve its futures."""
+        try:
+            try:
+                outcomes = self._read_output(jobid, workerid, len(futs),
+                                             sizes, timing, cache_key)
+            except FileNotFoundError:
+                message = \
+                    f"Cluster job {jobid} finished without writing a result"
+                if state is not None:
+                    message += f" (state {state})"
+                for fut in futs:
+                    fut.set_exception(JobDied(message, state))
+                self._drop_output(workerid)
+                self._record(jobid, len(futs), len(futs), timing, sizes)
             else:
-                fut.set_exception(RemoteException(result))
+                for fut, (success, result) in zip(futs, outcomes):
+                    _set_outcome(fut, success, result)
+        finally:
+            with self.jobs_lock:
+                self.loading -= 1
+                self._notify_if_idle()
 
-            os.unlink(OUTFILE_FMT % workerid)
+    def _read_output(self, jobid, workerid, calls, sizes, timing, cache_key):
+        """Read a job's output file and delete it. Returns a list with a
+        ``(success, result)`` pair for each of its ``calls``.
+        """
+        (outcome, worker_timing), _, sizes['out_raw'], \
+            sizes['out_stored'] = payload.read(output_path(workerid))
+        timing['loaded'] = time.time()
+        timing.update(worker_timing)
+        self._count_payload_bytes(sizes, 'out_raw', 'out_stored')
+        if isinstance(outcome, list):
+            # Each call in a chunk succeeds or fails on its own.
+            self._observe_call_times([run_time for _, _, run_time in outcome])
+            outcomes = [(success, result) for success, result, _ in outcome]
+            for key, (success, result) in zip(cache_key or (), outcomes):
+                if success:
+                    self.cache.put(key, result)
+        else:
+            success, result = outcome
+            if success and cache_key is not None:
+                self.cache.add(cache_key, output_path(workerid))
+            outcomes = [outcome] * calls
+        self._drop_output(workerid)
 
-        # Clean up communication files.
-        os.unlink(INFILE_FMT % workerid)
+        failed = sum(not success for success, _ in outcomes)
+        self._record(jobid, calls, failed, timing, sizes)
+        return outcomes
 
-        self._cleanup(jobid)
+    def _record(self, jobid, calls, failed, timing, sizes):
+        self.metrics.record({
+            'jobid': jobid, 'calls': calls, 'failed': failed,
+            'timing': timing, 'payload_bytes': sizes,
+        })
+
+    def _drop_output(self, workerid):
+        """Delete a job's output file now that we have its result, or
+        once the jobs that depend on it have finished.
+        """
+        with self.jobs_lock:
+            self.pending_outputs.discard(workerid)
+            if workerid in self.output_holds:
+                self.released_outputs.add(workerid)
+                return
+        payload.remove(output_path(workerid))
+
+    def _release_outputs(self, upstream):
+        """Stop keeping the outputs of the jobs computing the futures in
+        ``upstream`` for a job that needed them.
+        """
+        drop = []
+        with self.jobs_lock:
+            for fut in upstream:
+                self.output_holds[fut.workerid] -= 1
+                if not self.output_holds[fut.workerid]:
+                    del self.output_holds[fut.workerid]
+                    if fut.workerid in self.released_outputs:
+                        self.released_outputs.remove(fut.workerid)
+                        drop.append(fut.workerid)
+        for workerid in drop:
+            payload.remove(output_path(workerid))
+
+    def _release_upstream(self, workerid):
+        """Called when a job that depended on others is done with them."""
+        self.after.discard(workerid)
+        self._release_outputs(self.upstreams.pop(workerid, ()))
+
+    def _own_future(self, arg):
+        """Whether ``arg`` is the future for a call run by this executor."""
+        return (isinstance(arg, ClusterFuture) and arg.workerid is not None
+                and arg.workerid.rsplit('.', 1)[0] == self.session.id)
+
+    def _check_futures(self, args, kwargs):
+        """Reject futures among a call's arguments that its job can't
+        wait for, which can't be pickled either.
+        """
+        for arg in [*args, *kwargs.values()]:
+            if isinstance(arg, futures.Future) and not self._own_future(arg):
+                raise TypeError("Only futures from the same executor can "
+                                "be passed as arguments")
+
+    def _link_upstream(self, args, kwargs):
+        """Replace this executor's futures among a call's arguments with
+        references to their jobs' outputs, which are kept until released.
+        Futures whose results have already been read are replaced by
+        their results. Returns the new arguments and a list of the
+        futures that the call has to wait for.
+        """
+        upstream = []
+
+        def link(arg):
+            if not self._own_future(arg):
+                return arg
+            with self.jobs_lock:
+                if arg.workerid in self.pending_outputs:
+                    self.output_holds[arg.workerid] = \
+                        self.output_holds.get(arg.workerid, 0) + 1
+                    upstream.append(arg)
+                    return Upstream(arg.workerid, arg.index)
+            return arg.result()
+
+        try:
+            args = [link(arg) for arg in args]
+            kwargs = {key: link(arg) for key, arg in kwargs.items()}
+        except BaseException:
+            self._release_outputs(upstream)
+            raise
+        return args, kwargs, upstream
+
+    def _broke_dependency(self, workerid, state):
+        """Whether a job that the scheduler was to start after others
+        ended without running, because one of them failed or had to be
+        resubmitted. Call with ``jobs_lock`` held.
+        """
+        if workerid not in self.after or state is None or \
+                os.path.exists(output_path(workerid)):
+            return False
+        return not all(
+            fut.done() and not fut.cancelled() and
+            futures.Future.exception(fut) is None and
+            getattr(fut, 'attempts', 1) == 1
+            for fut in self.upstreams[workerid]
+        )
+
+    def _defer(self, fut, workerid, upstream):
+        """Start a job once the futures in ``upstream`` are done. The
+        caller counts it in ``submitting``.
+        """
+        waiting = set(upstream)
+        waiting_lock = threading.Lock()
+
+        def upstream_done(done):
+            with waiting_lock:
+                waiting.discard(done)
+                if waiting:
+                    return
+            self._start_deferred(fut, workerid, upstream)
+
+        for f in set(upstream):
+            f.add_done_callback(upstream_done)
+
+    def _start_deferred(self, fut, workerid, upstream):
+        """Start a job whose upstream futures are done, or fail it with
+        the first of their exceptions. Lazy results aren't read here: if
+        their calls failed, the job fails when it reads them.
+        """
+        try:
+            for f in upstream:
+                exc = futures.CancelledError() if f.cancelled() \
+                    else futures.Future.exception(f)
+                if exc is not None:
+                    raise exc
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            jobid = self._start(workerid, self.setup_lines.get(workerid))
+        except (Exception, futures.CancelledError) as exc:
+            fut.set_exception(exc)
+            self._discard_input(workerid)
+        else:
+            self._register(fut, workerid, jobid)
+        finally:
+            with self.jobs_lock:
+                self.submitting -= 1
+                self._notify_if_idle()
 
-    def submit(self, fun, *args, additional_setup_lines=None, **kwargs):
+    def _should_retry(self, workerid, state):
+        """Whether a job should be resubmitted."""
+        return (self.retry is not None and
+                self.retry.should_retry(state,
+                                        self.attempts.get(workerid, 1)) and
+                not os.path.exists(output_path(workerid)))
+
+    def _resubmit(self, fut, workerid):
+        """Start another attempt at a job, reusing its input file."""
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            jobid = self._start(workerid, self.setup_lines.get(workerid))
+        except Exception as exc:
+            futs = fut if isinstance(fut, list) else [fut]
+            for f in futs:
+                f.attempts = self.attempts.pop(workerid, 1)
+                f.set_exception(exc)
+            self._discard_input(workerid)
+        else:
+            self._register(fut, workerid, jobid)
+        finally:
+            with self.jobs_lock:
+                self.submitting -= 1
+                self._notify_if_idle()
+
+    def submit(self, fun, *args, additional_setup_lines=None, cache_key=None,
+               **kwargs):
         """Submit a job to the pool.
 
         If additional_setup_lines is passed, it overrides the lines given
-        when creating the executor.
+        when creating the executor. Arguments that are futures from this
+        executor are replaced by their results, once they are ready.
+        """
+        return self._submit(fun, args, kwargs, additional_setup_lines,
+                            cache_key)
+
+    def _prepare(self, fun, args, kwargs, cache_key=None, lazy=False):
+        """The part of submitting a call that comes before its job: link
+        the futures among its arguments and look it up in the cache.
+        Returns its future, worker ID, new arguments and the futures it
+        has to wait for. The future is already done if there is no job
+        to run.
+        """
+        self._check_futures(args, kwargs)
+        workerid = self.session.new_workerid()
+        fut = ClusterFuture(workerid)
+        try:
+            args, kwargs, upstream = self._link_upstream(args, kwargs)
+        except Exception as exc:
+            fut.set_exception(exc)  # An argument's call failed.
+            return fut, workerid, args, kwargs, []
+        # A call on other jobs' results is only cached by its own key.
+        if self.cache is not None and (cache_key is not None or
+                                       not upstream):
+            if cache_key is None:
+                cache_key = self.cache.key(fun, args, kwargs)
+            found, result = self.cache.get(cache_key)
+            if found:
+                self._release_outputs(upstream)
+                fut.set_result(result)
+                return fut, workerid, args, kwargs, []
+            self.cache_keys[workerid] = cache_key
+        if lazy:
+            self.lazy_workers.add(workerid)
+        with self.jobs_lock:
+            self.pending_outputs.add(workerid)
+        return fut, workerid, args, kwargs, upstream
+
+    def _submit(self, fun, args, kwargs, additional_setup_lines=None,
+                cache_key=None, lazy=False):
+        """Submit a call and return its future. With ``lazy``, its result
+        is only read if it is asked for, as with ``lazy_results``.
+        """
+        fut, workerid, args, kwargs, upstream = self._prepare(
+            fun, args, kwargs, cache_key, lazy
+        )
+        if fut.done():
+            return fut
+        if self.submit_pool is None:
+            self._submit_job(fut, workerid, fun, args, kwargs,
+                             additional_setup_lines, upstream)
+            return fut
+
+        with self.jobs_lock:
+            self.submitting += 1
+        self.submit_pool.submit(self._submit_queued, fut, workerid, fun,
+                                args, kwargs, additional_setup_lines,
+                                upstream)
+        return fut
+
+    def _submit_job(self, fut, workerid, fun, args, kwargs,
+                    additional_setup_lines, upstream=()):
+        """Write a call's input file and start its job, or arrange for it
+        to be started once the futures in ``upstream`` are done.
+        """
+        if additional_setup_lines is not None and \
+                (self.retry is not None or upstream):
+            self.setup_lines[workerid] = additional_setup_lines
+        if upstream:
+            self.upstreams[workerid] = upstream
+        try:
+            if isinstance(fut, list):
+                # A chunk: ``args`` lists its calls' argument tuples.
+                self._write_chunk(workerid, fun, args)
+            else:
+                self._write_input(workerid, fun, args, kwargs)
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            if upstream:
+                jobid = self._start_after(workerid, upstream,
+                                          additional_setup_lines)
+            else:
+                jobid = self._start(workerid, additional_setup_lines)
+        except BaseException:
+            self._discard_input(workerid)
+            raise
+        if jobid is None:
+            with self.jobs_lock:
+                self.submitting += 1
+            self._defer(fut, workerid, upstream)
+            return
+        if upstream:
+            self.after.add(workerid)
+        self._register(fut, workerid, jobid)
+
+    def _submit_queued(self, fut, *args):
+        """Submit a job on a submitter thread."""
+        try:
+            self._submit_job(fut, *args)
+        except Exception as exc:
+            for f in (fut if isinstance(fut, list) else [fut]):
+                f.set_exception(exc)
+        finally:
+            with self.jobs_lock:
+                self.submitting -= 1
+                self._notify_if_idle()
+
+    @property
+    def submit_queue_depth(self):
+        """The number of submissions that haven't finished yet."""
+        return self.submitting
+
+    def _notify_if_idle(self):
+        """Wake up ``shutdown`` if nothing is outstanding. Call with
+        ``jobs_lock`` held.
+        """
+        if not self.jobs and not self.submitting and not self.loading:
+            self.jobs_empty_cond.notify_all()
+
+    def _discard_input(self, workerid):
+        """Remove what was written for a job that couldn't be started."""
+        payload.remove(input_path(workerid))
+        self.blobs.release(self.blob_refs.pop(workerid, ()))
+        self._release_upstream(workerid)
+        self._drop_output(workerid)
+        self.payload_bytes.pop(workerid, None)
+        self.timings.pop(workerid, None)
+        self.cache_keys.pop(workerid, None)
+        self.setup_lines.pop(workerid, None)
+        self.lazy_workers.discard(workerid)
+
+    def _write_input(self, workerid, fun, args, kwargs):
+        """Serialize a call into the input file for a worker."""
+        fun = self._broadcast_function(fun)
+        self._write_payload(workerid, (fun, args, kwargs))
+
+    def _write_payload(self, workerid, job):
+        timing = self.timings[workerid] = {'submitted': time.time()}
+        with broadcast.collecting() as refs:
+            raw, stored = payload.dump(job, input_path(workerid), self.codec)
+        if refs:
+            self.blobs.acquire(refs)
+            self.blob_refs[workerid] = refs
+        timing['serialized'] = time.time()
+        sizes = self.payload_bytes[workerid] = {
+            'in_raw': raw, 'in_stored': stored,
+        }
+        self._count_payload_bytes(sizes, 'in_raw', 'in_stored')
+
+    def _count_payload_bytes(self, sizes, *keys):
+        with self.jobs_lock:
+            for key in keys:
+                self.payload_totals[key] += sizes[key]
+
+    def put(self, obj):
+        """Store a large object on the shared filesystem once, and return
+        a ``Broadcast`` handle to it. Pass the handle to jobs (as an
+        argument or in a closure) instead of the object, and use its
+        ``value`` attribute in the job to get the object. The file is
+        removed once the handle and all the jobs using it are gone.
+        """
+        return self.blobs.put(obj)
+
+    def _broadcast_function(self, fun):
+        """If a function (with everything it closes over) pickles to more
+        than ``broadcast_threshold`` bytes, store it once as a blob and
+        return a handle to it; otherwise return the function itself.
+        The decision is remembered for as long as the function exists.
         """
-        fut = futures.Future()
+        if self.broadcast_threshold is None:
+            return fun
+        try:
+            handle = self.function_blobs[fun]
+        except KeyError:
+            pass
+        except TypeError:
+            return fun  # Can't be weakly referenced, so can't remember it.
+        else:
+            return handle or fun
 
-        # Start the job.
-        workerid = random_string()
-        funcser = cloudpickle.dumps((fun, args, kwargs))
-        with open(INFILE_FMT % workerid, 'wb') as f:
-            f.write(funcser)
-        jobid = self._start(workerid, additional_setup_lines)
+        handle = None
+        if len(cloudpickle.dumps(fun)) > self.broadcast_threshold:
+            # The handle mustn't refer to the function, or the function
+            # would never be dropped from the weak dictionary.
+            handle = self.blobs.put(fun, keep=False)
+        self.function_blobs[fun] = handle
+        return handle or fun
 
+    def _write_chunk(self, workerid, fn, calls):
+        """Serialize a chunk of calls to ``fn`` into a worker's input."""
+        fn = self._broadcast_function(fn)
+        self._write_payload(workerid, [(fn, args, {}) for args in calls])
+
+    def _submit_chunk(self, fn, calls, cache_keys=None):
+        """Submit a list of argument tuples for ``fn`` as a single job.
+        Return a list of futures, one for each call. ``cache_keys`` are
+        the calls' keys in the cache, if there is one.
+        """
+        workerid = self.session.new_workerid()
+        futs = [ClusterFuture(workerid, i) for i in range(len(calls))]
+        if cache_keys is not None:
+            self.cache_keys[workerid] = cache_keys
+        with self.jobs_lock:
+            self.pending_outputs.add(workerid)
+        if self.submit_pool is None:
+            self._submit_job(futs, workerid, fn, calls, {}, None)
+            return futs
+
+        with self.jobs_lock:
+            self.submitting += 1
+        self.submit_pool.submit(self._submit_queued, futs, workerid, fn,
+                                calls, {}, None)
+        return futs
+
+    def _submit_chunks(self, fn, calls, chunksize):
+        """Submit calls to ``fn`` in chunks of ``chunksize`` calls per job
+        and return a flat list of futures, in order. A ``chunksize`` of
+        ``'auto'`` picks the size from the run times observed so far.
+        Calls whose results are cached don't go in any job.
+        """
+        for args in calls:
+            self._check_futures(args, {})
+        if chunksize == 'auto':
+            chunksize = self._auto_chunksize()
+
+        futs = [None] * len(calls)
+        keys = {}  # Cache keys of the calls that have to be run.
+        for i, args in enumerate(calls):
+            if self.cache is None:
+                continue
+            key = self.cache.key(fn, args, {})
+            found, result = self.cache.get(key)
+            if found:
+                futs[i] = ClusterFuture(self.session.new_workerid())
+                futs[i].set_result(result)
+            else:
+                keys[i] = key
+
+        todo = [i for i, fut in enumerate(futs) if fut is None]
+        for start in range(0, len(todo), chunksize):
+            chunk = todo[start:start + chunksize]
+            chunk_futs = self._submit_chunk(
+                fn, [calls[i] for i in chunk],
+                [keys[i] for i in chunk] if keys else None
+            )
+            for i, fut in zip(chunk, chunk_futs):
+                futs[i] = fut
+        return futs
+
+    def _auto_chunksize(self):
+        """Choose how many calls to pack into each job so that jobs run
+        for about ``target_chunk_seconds``.
+        """
+        if not self.call_time:
+            return 1
+        return max(1, math.ceil(self.target_chunk_seconds / self.call_time))
+
+    def _observe_call_times(self, run_times):
+        """Update the running estimate of how long a single call takes."""
+        for run_time in run_times:
+            if self.call_time is None:
+                self.call_time = run_time
+            else:
+                self.call_time += 0.1 * (run_time - self.call_time)
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        """Like ``Executor.map``. If ``chunksize`` is more than 1, that
+        many calls are packed into each cluster job, which is much more
+        efficient for short functions. ``chunksize='auto'`` chooses the
+        size based on how long calls have taken so far.
+        """
+        if chunksize == 1:
+            return super().map(fn, *iterables, timeout=timeout)
+        futs = self._submit_chunks(fn, list(zip(*iterables)), chunksize)
+        return _result_iterator(futs, timeout)
+
+    def imap(self, fn, iterable, max_in_flight=100, ordered=True,
+             max_buffered=None, chunksize=1):
+        """Map ``fn`` over ``iterable``, generating results as they
+        arrive. Unlike ``map``, items are taken from ``iterable`` lazily
+        and at most ``max_in_flight`` jobs are outstanding at once, so
+        the number of jobs, input files and futures stays bounded however
+        long the input is. ``chunksize`` packs several calls into each
+        job, as for ``map``.
+
+        If ``ordered`` is true, results are generated in input order.
+        Results that finish ahead of an earlier, slower one are held
+        until it is done; at most ``max_buffered`` of them (by default,
+        as many as the jobs in flight hold) are held before submission
+        pauses.
+        """
+        items = iter(iterable)
+        exhausted = False
+        pending = set()  # Submitted and not yet seen to be done.
+        order = deque()  # Submitted and not yet generated, in order.
+
+        while True:
+            size = (self._auto_chunksize() if chunksize == 'auto'
+                    else chunksize)
+            buffered = (max_in_flight * size if max_buffered is None
+                        else max_buffered)
+            # Top up the jobs in flight.
+            while (not exhausted and len(pending) < max_in_flight * size
+                    and len(order) - len(pending) < buffered):
+                batch = list(islice(items, size))
+                if len(batch) < size:
+                    exhausted = True
+                    if not batch:
+                        break
+                if size == 1:
+                    futs = [self.submit(fn, batch[0])]
+                else:
+                    futs = self._submit_chunks(
+                        fn, [(item,) for item in batch], size
+                    )
+                pending.update(futs)
+                if ordered:
+                    order.extend(futs)
+
+            if ordered:
+                while order and order[0].done():
+                    fut = order.popleft()
+                    pending.discard(fut)
+                    yield fut.result()
+
+            if not pending:
+                if exhausted and not order:
+                    return
+                continue
+
+            done, _ = futures.wait(pending,
+                                   return_when=futures.FIRST_COMPLETED)
+            pending -= done
+            if not ordered:
+                for fut in done:
+                    yield fut.result()
+
+    def _register(self, fut, workerid, jobid):
+        """Start waiting for a submitted job to finish."""
         if self.debug:
-            print("job submitted: %i" % jobid, file=sys.stderr)
+            print("job submitted: %s" % jobid, file=sys.stderr)
+
+        self.timings.setdefault(workerid, {})['queued'] = time.time()
+        with self.jobs_lock:
+            self.jobs[jobid] = (fut, workerid)
+            for f in (fut if isinstance(fut, list) else [fut]):
+                f.jobid = jobid
 
         # Thread will wait for it to finish.
-        self.wait_thread.wait(OUTFILE_FMT % workerid, jobid)
+        self.wait_thread.wait(output_path(workerid), jobid)
+
+    def map_reduce(self, mapper, reducer, items, fan_in=8):
+        """Call ``mapper`` on each item and combine the results with
+        ``reducer``, which takes two values, as ``functools.reduce``
+        does. ``reducer`` should be associative. Returns a future for the
+        combined value.
 
+        The combining is done on the cluster, by a tree of jobs that each
+        reduce the results of up to ``fan_in`` others. Each job reads its
+        inputs from their jobs' output files, so only the final value is
+        loaded here.
+        """
+        if fan_in < 2:
+            raise ValueError('fan_in must be at least 2')
+        futs = [self._submit(mapper, (item,), {}, lazy=True)
+                for item in items]
+        if not futs:
+            raise ValueError('map_reduce needs at least one item')
+        while len(futs) > 1:
+            groups = [futs[i:i + fan_in] for i in range(0, len(futs), fan_in)]
+            # Results inside the tree are never loaded by the driver.
+            futs = [group[0] if len(group) == 1 else
+                    self._submit(_reduce, (reducer, *group), {},
+                                 lazy=len(groups) > 1)
+                    for group in groups]
+        return futs[0]
+
+    def map_array(self, fn, *iterables, timeout=None, throttle=None,
+                  additional_setup_lines=None):
+        """Like ``map``, but submits all the calls together as a single
+        array job instead of starting one job per item. If ``throttle``
+        is given, at most that many of the calls run at the same time.
+        """
+        calls = list(zip(*iterables))
+        if not calls:
+            return _result_iterator([], timeout)
+        workerids = self.session.new_workerids(len(calls))
+        try:
+            for workerid, args in zip(workerids, calls):
+                self._write_input(workerid, fn, args, {})
+                if self.retry is not None and \
+                        additional_setup_lines is not None:
+                    # Retries start the task as a job of its own.
+                    self.setup_lines[workerid] = additional_setup_lines
+            # The array's tasks are numbered from its first worker ID.
+            jobids = self._start_array(workerids[0], len(calls), throttle,
+                                       additional_setup_lines)
+        except BaseException:
+            for workerid in workerids:
+                self._discard_input(workerid)
+            raise
         with self.jobs_lock:
-            self.jobs[jobid] = (fut, workerid)
-        return fut
+            self.pending_outputs.update(workerids)
+        fs = []
+        for workerid, jobid in zip(workerids, jobids):
+            fut = ClusterFuture(workerid)
+            self._register(fut, workerid, jobid)
+            fs.append(fut)
+        return _result_iterator(fs, timeout)
 
     def shutdown(self, wait=True):
         """Close the pool."""
         if wait:
             with self.jobs_lock:
-                if self.jobs:
+                while self.jobs or self.submitting or self.loading:
                     self.jobs_empty_cond.wait()
+        if self.submit_pool is not None:
+            self.submit_pool.shutdown(wait)
 
         self.wait_thread.stop()
         self.wait_thread.join()
+        if self.result_server is not None:
+            self.result_server.close()
+        self.load_pool.shutdown(wait)
+        if wait:
+            self.blobs.clear()
+            self._close_session()
 
-class SlurmWaitThread(FileWaitThread):
-    slurm_poll_interval = 30
+    def _close_session(self):
+        """Remove the session directory once nothing needs it. Lazy
+        results that haven't been read yet still need it.
+        """
+        if not self.keep_logs and \
+                all(output.loaded for output in list(self.unread)):
+            self.session.remove()
 
+class SlurmWaitThread(FileWaitThread):
+    """Also asks Slurm which jobs have finished, to notice jobs that died
+    without writing their output. The answers come from a cache shared
+    by the whole process (``slurm.STATE_CACHE``), which decides how
+    often to actually ask the scheduler.
+    """
     def check(self, i):
         super().check(i)
-        if i % (self.slurm_poll_interval // self.interval) == 0:
-            try:
-                finished_jobs = slurm.jobs_finished(self.waiting.values())
-            except Exception:
-                # Don't abandon completion checking if jobs_finished errors
-                traceback.print_exc()
-                return
-
-            if not finished_jobs:
-                return
-
+        with self.lock:
             id_to_filename = {v: k for (k, v) in self.waiting.items()}
-            for finished_id in finished_jobs:
-                self.callback(finished_id)
-                self.waiting.pop(id_to_filename[finished_id])
+        try:
+            finished_jobs = slurm.jobs_finished(list(id_to_filename))
+        except Exception:
+            # Don't abandon completion checking if jobs_finished errors
+            traceback.print_exc()
+            return
+
+        for finished_id, state in finished_jobs.items():
+            self.done(id_to_filename[finished_id], state)
 
 
 class SlurmExecutor(ClusterExecutor):
@@ -202,67 +1185,462 @@ class SlurmExecutor(ClusterExecutor):
     additional_setup_lines is a list of lines to include in the shell script
     passed to sbatch. They may include sbatch options (starting with
     '#SBATCH') and shell commands, e.g. to set environment variables.
+
+    With ``resources``, a ``cfut.resources.ResourceProfiles``, each job
+    asks for the memory, time and CPUs that its function's earlier jobs
+    needed, after the setup lines so that these requests win. Jobs that
+    run out of memory are retried with more.
+
+    ``map_array`` submits at most ``max_array_size`` tasks per job array,
+    starting several arrays for more; keep it within the cluster's
+    MaxArraySize.
     """
     wait_thread_cls = SlurmWaitThread
 
     def __init__(self, debug=False, keep_logs=False, additional_setup_lines=(),
-                 additional_import_paths=()):
-        super().__init__(debug, keep_logs)
+                 additional_import_paths=(), resources=None,
+                 max_array_size=1000, **kwargs):
+        if resources is not None and kwargs.get('retry') is None:
+            # Keep setup lines for retries; out-of-memory jobs are retried
+            # by _should_retry below, straight away.
+            kwargs['retry'] = RetryPolicy(states=(), backoff=0)
+        super().__init__(debug, keep_logs, **kwargs)
         self.additional_setup_lines = additional_setup_lines
         self.additional_import_paths = additional_import_paths
+        self.outfile_fmt = os.path.join(self.session.log_dir,
+                                        'slurm.{}.log')
+        self.resources = resources
+        self.profile_keys = {}  # Maps worker IDs to their profiles' keys.
+        self.requested_mem = {}  # Maps worker IDs to the memory asked for.
+        self.max_array_size = max_array_size
+
+    def _write_input(self, workerid, fun, args, kwargs):
+        if self.resources is not None:
+            key = self.resources.key(fun)
+            if key is not None:
+                self.profile_keys[workerid] = key
+        super()._write_input(workerid, fun, args, kwargs)
+
+    def _job_setup_lines(self, workerid, additional_setup_lines,
+                         workerids=None):
+        """The setup lines for a job, followed by requests for the
+        resources its function has needed before. ``workerids`` are the
+        workers sharing the job script, if there are several.
+        """
+        if additional_setup_lines is None:
+            additional_setup_lines = self.additional_setup_lines
+        key = self.profile_keys.get(workerid)
+        if key is None:
+            return additional_setup_lines
+        lines = [*additional_setup_lines,
+                 *slurm.resource_lines(**self.resources.requests(key))]
+        mem = slurm.requested_memory(lines)
+        for w in workerids or [workerid]:
+            self.requested_mem[w] = mem
+        return lines
+
+    def _should_retry(self, workerid, state):
+        if state == 'OUT_OF_MEMORY' and self.requested_mem.get(workerid) \
+                and self.attempts.get(workerid, 1) < \
+                self.resources.max_attempts \
+                and not os.path.exists(output_path(workerid)):
+            self.resources.out_of_memory(self.profile_keys[workerid],
+                                         self.requested_mem[workerid])
+            return True
+        return super()._should_retry(workerid, state)
+
+    def _read_output(self, jobid, workerid, calls, sizes, timing, cache_key):
+        key = self.profile_keys.get(workerid)
+        outcomes = super()._read_output(jobid, workerid, calls, sizes,
+                                        timing, cache_key)
+        if key is not None:
+            self.resources.observe(key, timing)
+        return outcomes
+
+    def _drop_output(self, workerid):
+        self.profile_keys.pop(workerid, None)
+        self.requested_mem.pop(workerid, None)
+        super()._drop_output(workerid)
+
+    def shutdown(self, wait=True):
+        super().shutdown(wait)
+        if self.resources is not None:
+            self.resources.flush()
 
     def _start(self, workerid, additional_setup_lines):
+        additional_setup_lines = self._job_setup_lines(
+            workerid, additional_setup_lines
+        )
+        return slurm.submit(
+            self._remote_cmdline(workerid),
+            outpat=self.outfile_fmt.format('%j'),
+            additional_setup_lines=additional_setup_lines
+        )
+
+    def _start_after(self, workerid, upstream, additional_setup_lines):
+        jobids = [fut.jobid for fut in upstream if not fut.done()]
+        if None in jobids:
+            return None  # Not submitted yet, or waiting to be resubmitted.
         if additional_setup_lines is None:
             additional_setup_lines = self.additional_setup_lines
+        if jobids:
+            # If an upstream job fails, Slurm cancels this one.
+            additional_setup_lines = [
+                '#SBATCH --dependency=afterok:%s' %
+                ':'.join(str(jobid) for jobid in dict.fromkeys(jobids)),
+                '#SBATCH --kill-on-invalid-dep=yes',
+                *additional_setup_lines,
+            ]
+        return self._start(workerid, additional_setup_lines)
+
+    def _remote_cmdline(self, *args, module='cfut.remote'):
         if self.additional_import_paths:
             extra_path = ":".join(self.additional_import_paths)
         else:
             extra_path = "!"  # ! for nothing, because '' is valid (CWD)
-        return slurm.submit(
-            [sys.executable, '-m', 'cfut.remote', workerid, extra_path],
-            additional_setup_lines=additional_setup_lines
-        )
+        cmdline = [sys.executable, '-m', module, *args, extra_path]
+        if self.result_address is not None:
+            cmdline.append(self.result_address)
+        return cmdline
+
+    def _start_array(self, arrayid, count, throttle, additional_setup_lines):
+        # Slurm refuses arrays above its MaxArraySize, so large ones are
+        # split. Each part is numbered from its own first worker ID.
+        jobids = []
+        previous = None
+        for start in range(0, count, self.max_array_size):
+            size = min(self.max_array_size, count - start)
+            partid = array_workerid(arrayid, start)
+            lines = self._job_setup_lines(
+                partid, additional_setup_lines,
+                [array_workerid(partid, i) for i in range(size)]
+            )
+            if throttle and previous is not None:
+                # One part at a time, so that the throttle still holds.
+                lines = ['#SBATCH --dependency=afterany:%s' % previous,
+                         *lines]
+            previous = slurm.submit_array(
+                self._remote_cmdline(partid + '+' + ARRAY_TASK_ID), size,
+                throttle=throttle, outpat=self.outfile_fmt.format('%A_%a'),
+                additional_setup_lines=lines
+            )
+            jobids.extend('%s_%i' % (previous, i) for i in range(size))
+        return jobids
 
     def _cleanup(self, jobid):
         if self.keep_logs:
             return
 
-        outf = slurm.OUTFILE_FMT.format(str(jobid))
+        outf = self.outfile_fmt.format(str(jobid))
         try:
             os.unlink(outf)
         except OSError:
             pass
 
+class CondorWaitThread(FileWaitThread):
+    """Also reads the executor's Condor user log, to notice jobs that
+    ended without writing their output. Jobs that stall in one of the
+    ``stalled`` states (such as ``held``) are treated as having ended;
+    otherwise they are waited for, in case they are released.
+    """
+    def __init__(self, callback, log, interval=1, watcher='scan',
+                 stalled=()):
+        super().__init__(callback, interval, watcher)
+        self.log_reader = condor.LogReader(log)
+        self.stalled = set(stalled)
+
+    def check(self, i):
+        # Read the log first: a job writes its output before it ends, so
+        # the output of any job that the log says has ended will be found.
+        self.log_reader.read()
+        super().check(i)
+
+        with self.lock:
+            waiting = list(self.waiting.items())
+        for filename, jobid in waiting:
+            state = self.log_reader.states.get(condor.job_key(jobid))
+            if state in condor.STATES_FINISHED or state in self.stalled:
+                self.done(filename, state)
+
 class CondorExecutor(ClusterExecutor):
     """Futures executor for executing jobs on a Condor cluster."""
-    def __init__(self, debug=False, keep_logs=False):
-        super(CondorExecutor, self).__init__(debug, keep_logs)
-        self.logfile = LOGFILE_FMT % random_string()
+    wait_thread_cls = CondorWaitThread
+
+    def __init__(self, debug=False, keep_logs=False, **kwargs):
+        super(CondorExecutor, self).__init__(debug, keep_logs, **kwargs)
+        self.outfile_fmt = os.path.join(self.session.log_dir,
+                                        'condor.stdout.%s.log')
+        self.errfile_fmt = os.path.join(self.session.log_dir,
+                                        'condor.stderr.%s.log')
+
+    @property
+    def logfile(self):
+        """The Condor user log for all of the executor's jobs."""
+        return self.session.filename('condor.log')
+
+    def _make_wait_thread(self, cls, callback, watcher):
+        if issubclass(cls, CondorWaitThread):
+            # Only give up on held jobs if they are to be retried.
+            stalled = condor.STATES_STALLED & self.retry.states \
+                if self.retry is not None else ()
+            return cls(callback, self.logfile, watcher=watcher,
+                       stalled=stalled)
+        return super()._make_wait_thread(cls, callback, watcher)
+
+    def _abandon(self, jobid, state):
+        if state in condor.STATES_STALLED:
+            condor.remove(jobid)
+
+    def _arguments(self, *args, module='cfut.remote'):
+        """The arguments to Python for a job running ``module``."""
+        if self.result_address is not None:
+            args += ('!', self.result_address)
+        return ' '.join(['-m', module, *args])
 
     def _start(self, workerid, additional_setup_lines):
-        return condor.submit(sys.executable, '-m cfut.remote %s' % workerid,
-                             log=self.logfile)
+        return condor.submit(sys.executable, self._arguments(workerid),
+                             log=self.logfile,
+                             outfile=self.outfile_fmt % '$(Cluster)',
+                             errfile=self.errfile_fmt % '$(Cluster)')
+
+    def _start_array(self, arrayid, count, throttle, additional_setup_lines):
+        # One cluster, with a job per worker numbered by $(Process).
+        return condor.submit_array(
+            sys.executable, self._arguments('%s+$(Process)' % arrayid), count,
+            throttle=throttle, log=self.logfile,
+            outfile=self.outfile_fmt % '$(Cluster).$(Process)',
+            errfile=self.errfile_fmt % '$(Cluster).$(Process)'
+        )
 
     def _cleanup(self, jobid):
         if self.keep_logs:
             return
-        os.unlink(condor.OUTFILE_FMT % str(jobid))
-        os.unlink(condor.ERRFILE_FMT % str(jobid))
+        for fmt in (self.outfile_fmt, self.errfile_fmt):
+            try:
+                os.unlink(fmt % str(jobid))
+            except FileNotFoundError:
+                pass  # The job never ran.
 
     def shutdown(self, wait=True):
         super(CondorExecutor, self).shutdown(wait)
         if os.path.exists(self.logfile):
             os.unlink(self.logfile)
 
-def map(executor, func, args, ordered=True):
+class PoolExecutorMixin:
+    """Runs futures on a pool of long-running pilot jobs instead of
+    starting a batch job for each one. This avoids paying the
+    scheduler's queueing delay and the interpreter's startup time for
+    every task.
+
+    Tasks wait in a queue under ``CFUT_DIR``. Up to ``pilots`` pilot jobs
+    are started as tasks arrive; each runs tasks from the queue until it
+    has been idle for ``idle_timeout`` seconds. If a pilot dies while
+    running a task, that task's future fails with ``JobDied``. Pilots
+    always use the setup lines given to the executor.
+
+    Each pilot asks the scheduler for ``cores`` CPUs and runs that many
+    tasks at once, so one job can fill a whole node with single-threaded
+    tasks. Each task still writes its own result.
+
+    On shutdown, pilots are told to stop, and the executor waits up to
+    ``stop_timeout`` seconds for them to exit before removing its
+    session. Pilots still queued or running after that leave the session
+    for ``cfut.session.collect``.
+    """
+    wait_thread_cls = FileWaitThread
+    pilot_wait_thread_cls = FileWaitThread
+
+    def __init__(self, *args, pilots=4, idle_timeout=60, cores=1,
+                 stop_timeout=30, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_pilots = pilots
+        self.idle_timeout = idle_timeout
+        self.cores = cores
+        self.stop_timeout = stop_timeout
+        self.poolid = self.session.id
+        self.queue = pool.TaskQueue(self.poolid)
+        self.queue.create()
+
+        self.pilots = {}  # Maps pilot job IDs to pilot IDs.
+        self.pilots_lock = threading.Lock()
+        self.pilot_wait_thread = self._make_wait_thread(
+            self.pilot_wait_thread_cls, self._pilot_exited, self.watcher
+        )
+        self.pilot_wait_thread.start()
+
+    def _start_pilot(self, pilotid):
+        """Start a pilot job running ``python -m cfut.pool`` on ``cores``
+        CPUs and return its job ID.
+        """
+        raise NotImplementedError()
+
+    def _start(self, workerid, additional_setup_lines):
+        self.queue.put(workerid)
+        self._ensure_pilots()
+        # Tasks don't have their own jobs, so the worker ID stands in.
+        return workerid
+
+    def _start_array(self, arrayid, count, throttle, additional_setup_lines):
+        workerids = [array_workerid(arrayid, i) for i in range(count)]
+        for workerid in workerids:
+            self.queue.put(workerid)
+        # None of the array's tasks are registered yet.
+        self._ensure_pilots(count)
+        return workerids
+
+    def _start_after(self, workerid, upstream, additional_setup_lines):
+        return None  # Queue the task once its upstream tasks are done.
+
+    def _cleanup(self, jobid):
+        pass
+
+    def _abandon(self, jobid, state):
+        pass  # Tasks aren't scheduler jobs.
+
+    def _ensure_pilots(self, new=1):
+        """Start pilots until there are enough for the outstanding tasks,
+        along with ``new`` tasks that are queued but not registered yet.
+        """
+        with self.jobs_lock:
+            wanted = min(self.max_pilots,
+                         math.ceil((len(self.jobs) + new) / self.cores))
+        with self.pilots_lock:
+            while len(self.pilots) < wanted:
+                pilotid = random_string()
+                jobid = self._start_pilot(pilotid)
+                if self.debug:
+                    print("pilot submitted: %s" % jobid, file=sys.stderr)
+                self.pilots[jobid] = pilotid
+                self.pilot_wait_thread.wait(self.queue.done_file(pilotid),
+                                            jobid)
+
+    def _pilot_exited(self, jobid, state=None):
+        """Called whenever a pilot job finishes."""
+        with self.pilots_lock:
+            pilotid = self.pilots.pop(jobid)
+        if self.debug:
+            print("pilot exited: %s" % jobid, file=sys.stderr)
+        if state is not None:
+            super()._abandon(jobid, state)
+
+        # Tasks that the pilot claimed but didn't finish died with it.
+        # They are retried if the pilot's end state calls for it.
+        for workerid in self.queue.claimed(pilotid):
+            if os.path.exists(output_path(workerid)):
+                continue  # Finished just before the pilot exited.
+            if self.wait_thread.forget(output_path(workerid)):
+                self._completion(workerid, state)
+
+        self.queue.forget_pilot(pilotid)
+        super()._cleanup(jobid)
+
+        # Replace the pilot if it left work behind.
+        if self.queue.pending() and not self.queue.stopped():
+            self._ensure_pilots()
+
+    def _close_session(self):
+        pass  # Pilots may still be using the queue; see shutdown.
+
+    def shutdown(self, wait=True):
+        super().shutdown(wait)
+        self.queue.stop()
+        if wait:
+            deadline = time.time() + self.stop_timeout
+            while self.pilots and time.time() < deadline:
+                time.sleep(self.pilot_wait_thread.interval)
+        self.pilot_wait_thread.stop()
+        self.pilot_wait_thread.join()
+        with self.pilots_lock:
+            if not self.pilots:
+                self.queue.remove()
+                if wait:
+                    super()._close_session()
+
+class SlurmPoolExecutor(PoolExecutorMixin, SlurmExecutor):
+    """Runs futures on a pool of long-running Slurm pilot jobs. Takes the
+    same options as ``SlurmExecutor`` along with ``pilots``,
+    ``idle_timeout`` and ``cores``.
+    """
+    pilot_wait_thread_cls = SlurmWaitThread
+
+    def _start_pilot(self, pilotid):
+        setup_lines = list(self.additional_setup_lines)
+        if self.cores > 1:
+            setup_lines.insert(0, '#SBATCH --cpus-per-task=%i' % self.cores)
+        return slurm.submit(
+            self._remote_cmdline(self.poolid, pilotid, str(self.idle_timeout),
+                                 str(self.cores), module='cfut.pool'),
+            outpat=self.outfile_fmt.format('%j'),
+            additional_setup_lines=setup_lines
+        )
+
+class CondorPoolExecutor(PoolExecutorMixin, CondorExecutor):
+    """Runs futures on a pool of long-running Condor pilot jobs."""
+    pilot_wait_thread_cls = CondorWaitThread
+
+    def _start_pilot(self, pilotid):
+        return condor.submit(
+            sys.executable,
+            self._arguments(self.poolid, pilotid, str(self.idle_timeout),
+                            str(self.cores), module='cfut.pool'),
+            log=self.logfile, request_cpus=self.cores,
+            outfile=self.outfile_fmt % '$(Cluster)',
+            errfile=self.errfile_fmt % '$(Cluster)'
+        )
+
+def _reduce(reducer, *values):
+    """Combine the values in a ``map_reduce`` job."""
+    return functools.reduce(reducer, values)
+
+def _set_outcome(fut, success, result):
+    if success:
+        fut.set_result(result)
+    else:
+        fut.set_exception(RemoteException(result))
+
+def _result_iterator(fs, timeout):
+    """Yield the results of a list of futures in order, like the
+    iterator returned by ``Executor.map``.
+    """
+    end_time = None if timeout is None else timeout + time.monotonic()
+
+    def result_iterator():
+        try:
+            fs.reverse()
+            while fs:
+                if timeout is None:
+                    yield fs.pop().result()
+                else:
+                    yield fs.pop().result(end_time - time.monotonic())
+        finally:
+            for fut in fs:
+                fut.cancel()
+
+    return result_iterator()
+
+def map(executor, func, args, ordered=True, chunksize=1,
+        max_in_flight=None):
     """Convenience function to map a function over cluster jobs. Given
     a function and an iterable, generates results. (Works like
     ``itertools.imap``.) If ``ordered`` is False, then the values are
     generated in an undefined order, possibly more quickly.
+    ``chunksize`` packs several calls into each job, as for
+    ``ClusterExecutor.map``. If ``max_in_flight`` is given, ``args`` is
+    consumed lazily with at most that many jobs outstanding, as for
+    ``ClusterExecutor.imap``.
     """
     with executor:
-        futs = []
-        for arg in args:
-            futs.append(executor.submit(func, arg))
+        if max_in_flight is not None:
+            yield from executor.imap(func, args, max_in_flight, ordered,
+                                     chunksize=chunksize)
+            return
+        if chunksize == 1:
+            futs = []
+            for arg in args:
+                futs.append(executor.submit(func, arg))
+        else:
+            futs = executor._submit_chunks(
+                func, [(arg,) for arg in args], chunksize
+            )
         for fut in (futs if ordered else futures.as_completed(futs)):
             yield fut.result()
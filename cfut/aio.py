@@ -0,0 +1,185 @@
+"""Executors for asyncio programs.
+
+Submitting a job through these doesn't block the event loop: the call is
+pickled in a thread pool and the scheduler command runs as an asyncio
+subprocess. Finished jobs are noticed by a task on the event loop instead
+of a separate wait thread, and each job's result is an awaitable.
+"""
+import asyncio
+from concurrent import futures
+from itertools import count
+import os
+import sys
+import weakref
+
+from . import CondorExecutor, SlurmExecutor
+from . import condor
+from . import slurm
+
+class AsyncExecutorMixin:
+    """Adds ``asubmit`` and ``amap`` to a cluster executor. Use it with
+    ``async with`` (or call ``ashutdown``) rather than the synchronous
+    ``shutdown``.
+
+    ``serializers`` is the number of threads that pickle calls and look
+    for finished jobs. At most ``max_submitting`` scheduler commands run
+    at once.
+    """
+    def __init__(self, *args, serializers=4, max_submitting=16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.serializer = futures.ThreadPoolExecutor(serializers)
+        self.max_submitting = max_submitting
+        self.submit_slots = None  # Semaphore, made on the event loop.
+        self.poller = None
+        self.pending = set()
+        # Maps the asyncio futures handed out to the futures they wrap.
+        self.cluster_futures = weakref.WeakKeyDictionary()
+
+    def _start_waiting(self):
+        # The poller starts with the first submission, on its loop.
+        pass
+
+    async def _astart(self, workerid, additional_setup_lines):
+        """Like ``_start``, for use in asyncio code."""
+        raise NotImplementedError()
+
+    async def _poll(self):
+        """Check for finished jobs at the wait thread's interval. Each
+        check (and reading the results it finds) runs in the thread pool.
+        """
+        loop = asyncio.get_running_loop()
+        for i in count():
+            await loop.run_in_executor(self.serializer,
+                                       self.wait_thread.check, i)
+            await asyncio.sleep(self.wait_thread.interval)
+
+    async def asubmit(self, fun, *args, additional_setup_lines=None,
+                      cache_key=None, **kwargs):
+        """Submit a job to the cluster. Returns an asyncio future for its
+        result once the job has been submitted. Takes the same arguments
+        as ``submit``.
+        """
+        loop = asyncio.get_running_loop()
+        if self.poller is None:
+            self.poller = loop.create_task(self._poll())
+            self.submit_slots = asyncio.Semaphore(self.max_submitting)
+
+        # Jobs can wait for the results of others, as with ``submit``.
+        args = [self._unwrap(arg) for arg in args]
+        kwargs = {key: self._unwrap(arg) for key, arg in kwargs.items()}
+        fut, workerid, args, kwargs, upstream = await loop.run_in_executor(
+            self.serializer, self._prepare, fun, args, kwargs, cache_key
+        )
+        if upstream:
+            # Jobs that wait for others are started the usual way.
+            await loop.run_in_executor(
+                self.serializer, self._submit_job, fut, workerid, fun, args,
+                kwargs, additional_setup_lines, upstream
+            )
+        elif not fut.done():
+            await self._asubmit_job(fut, workerid, fun, args, kwargs,
+                                    additional_setup_lines)
+
+        afut = asyncio.wrap_future(fut)
+        self.cluster_futures[afut] = fut
+        self.pending.add(afut)
+        afut.add_done_callback(self.pending.discard)
+        return afut
+
+    def _unwrap(self, arg):
+        if isinstance(arg, asyncio.Future):
+            return self.cluster_futures.get(arg, arg)
+        return arg
+
+    async def _asubmit_job(self, fut, workerid, fun, args, kwargs,
+                           additional_setup_lines):
+        """Like ``_submit_job``, for a job that doesn't wait for others."""
+        if additional_setup_lines is not None and self.retry is not None:
+            self.setup_lines[workerid] = additional_setup_lines
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.serializer, self._write_input,
+                                       workerid, fun, args, kwargs)
+            if self.rate_limiter is not None:
+                await loop.run_in_executor(self.serializer,
+                                           self.rate_limiter.wait)
+            async with self.submit_slots:
+                jobid = await self._astart(workerid, additional_setup_lines)
+        except BaseException:
+            self._discard_input(workerid)
+            raise
+        self._register(fut, workerid, jobid)
+
+    async def amap(self, fn, *iterables):
+        """Submit ``fn`` for each set of arguments concurrently, and
+        return a list of the results.
+        """
+        futs = await asyncio.gather(*(
+            self.asubmit(fn, *args) for args in zip(*iterables)
+        ))
+        return await asyncio.gather(*futs)
+
+    async def ashutdown(self, wait=True):
+        """Close the pool, waiting for outstanding jobs if ``wait`` is
+        true.
+        """
+        if wait and self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        if self.poller is not None:
+            self.poller.cancel()
+            try:
+                await self.poller
+            except asyncio.CancelledError:
+                pass
+        self.wait_thread.watcher.close()
+        if self.result_server is not None:
+            self.result_server.close()
+        self.load_pool.shutdown(wait)
+        self.serializer.shutdown(wait)
+        if wait:
+            self.blobs.clear()
+            self._close_session()
+
+    def shutdown(self, wait=True):
+        raise TypeError("use 'async with' or 'await executor.ashutdown()' "
+                        "with an async executor")
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.ashutdown()
+        return False
+
+class AsyncSlurmExecutor(AsyncExecutorMixin, SlurmExecutor):
+    """Submits jobs to a Slurm cluster from asyncio code. Takes the same
+    options as ``SlurmExecutor``.
+    """
+    async def _astart(self, workerid, additional_setup_lines):
+        additional_setup_lines = self._job_setup_lines(
+            workerid, additional_setup_lines
+        )
+        return await slurm.asubmit(
+            self._remote_cmdline(workerid),
+            outpat=self.outfile_fmt.format('%j'),
+            additional_setup_lines=additional_setup_lines
+        )
+
+    async def ashutdown(self, wait=True):
+        await super().ashutdown(wait)
+        if self.resources is not None:
+            self.resources.flush()
+
+class AsyncCondorExecutor(AsyncExecutorMixin, CondorExecutor):
+    """Submits jobs to a Condor cluster from asyncio code."""
+    async def _astart(self, workerid, additional_setup_lines):
+        return await condor.asubmit(sys.executable,
+                                    self._arguments(workerid),
+                                    log=self.logfile,
+                                    outfile=self.outfile_fmt % '$(Cluster)',
+                                    errfile=self.errfile_fmt % '$(Cluster)')
+
+    async def ashutdown(self, wait=True):
+        await super().ashutdown(wait)
+        if os.path.exists(self.logfile):
+            os.unlink(self.logfile)
@@ -0,0 +1,127 @@
+"""Large objects that many jobs share, written to the shared filesystem
+once instead of being pickled into every job's input file.
+"""
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+import weakref
+from . import payload
+from .util import local_filename
+
+def blob_path(name):
+    """The file holding a blob. A blob's name is ``<session>.<hash>``,
+    and it lives in its executor's session directory.
+    """
+    session, digest = name.split('.', 1)
+    return os.path.join(local_filename(session), 'blob.%s.pickle' % digest)
+
+# Objects already loaded in this process, by blob name.
+_loaded = {}
+
+# The blobs referred to by the object currently being pickled.
+_collector = threading.local()
+
+class Broadcast:
+    """A handle to an object in a blob file. Pickling a handle only
+    pickles the blob's name; ``value`` loads the object the first time it
+    is used in each process.
+    """
+    def __init__(self, name, value=None):
+        self.name = name
+        if value is not None:
+            self._value = value
+
+    @property
+    def value(self):
+        try:
+            return self._value
+        except AttributeError:
+            pass
+        try:
+            self._value = _loaded[self.name]
+        except KeyError:
+            self._value = _loaded[self.name] = \
+                payload.load(blob_path(self.name))
+        return self._value
+
+    def __reduce__(self):
+        refs = getattr(_collector, 'refs', None)
+        if refs is not None:
+            refs.add(self.name)
+        return Broadcast, (self.name,)
+
+    def __repr__(self):
+        return '<Broadcast %s>' % self.name
+
+@contextmanager
+def collecting():
+    """Collect the names of the blobs whose handles are pickled in this
+    thread inside the ``with`` block, into the set it yields.
+    """
+    _collector.refs = refs = set()
+    try:
+        yield refs
+    finally:
+        _collector.refs = None
+
+def unwrap(obj):
+    """Get the object behind a handle, or return ``obj`` as it is."""
+    return obj.value if isinstance(obj, Broadcast) else obj
+
+class BlobStore:
+    """Keeps the blobs for one executor and reference-counts them. Each
+    handle returned by ``put`` holds a reference until it is garbage
+    collected, and each job that uses a blob holds one until it
+    finishes. A blob's file is deleted when nothing refers to it. The
+    files go in the directory of the executor's ``session``, by ID.
+    """
+    def __init__(self, session):
+        self.storeid = session
+        self.refs = {}
+        self.lock = threading.Lock()
+
+    def put(self, obj, keep=True):
+        """Store an object and return a ``Broadcast`` handle to it.
+        Storing an equal object again reuses the same file. Unless
+        ``keep`` is false, the handle holds on to the object so that
+        using it here doesn't need to load it again.
+        """
+        data, buffers, _ = payload.dumps(obj)
+        digest = hashlib.sha256(data)
+        for buf in buffers:
+            digest.update(buf.raw())
+        name = '%s.%s' % (self.storeid, digest.hexdigest())
+        with self.lock:
+            if name not in self.refs:
+                payload.write(blob_path(name), data, buffers)
+                self.refs[name] = 0
+            self.refs[name] += 1
+
+        handle = Broadcast(name, obj if keep else None)
+        weakref.finalize(handle, self.release, [name])
+        return handle
+
+    def acquire(self, names):
+        with self.lock:
+            for name in names:
+                self.refs[name] += 1
+
+    def release(self, names):
+        with self.lock:
+            for name in names:
+                if name not in self.refs:
+                    continue  # Already cleared.
+                self.refs[name] -= 1
+                if not self.refs[name]:
+                    del self.refs[name]
+                    _loaded.pop(name, None)
+                    payload.remove(blob_path(name))
+
+    def clear(self):
+        """Delete all the blobs, whatever still refers to them."""
+        with self.lock:
+            names, self.refs = list(self.refs), {}
+        for name in names:
+            _loaded.pop(name, None)
+            payload.remove(blob_path(name))
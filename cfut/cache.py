@@ -0,0 +1,164 @@
+"""A cache of call results on the shared filesystem, so that a call that
+has already been made doesn't need to be run again.
+
+Each entry is a directory named after the call's key, holding the job's
+output file as the worker wrote it. An entry is built under a temporary
+name and then renamed into place, so executors in different processes
+(or on different hosts) can share a cache: whoever finishes first wins,
+and nobody sees a half-written entry.
+"""
+import hashlib
+import os
+import shutil
+import threading
+import time
+
+import cloudpickle
+
+from . import payload
+from .util import local_filename, random_string
+
+RESULT_FILE = 'result.pickle'
+
+# Partly built entries older than this, in seconds, are removed.
+STALE_TEMP_AGE = 3600
+
+class ResultCache:
+    """Stores the results of successful calls under a key computed from
+    the call. By default, the key is a hash of the pickled function and
+    arguments; ``key_func(fun, args, kwargs)`` can compute it instead.
+
+    Entries that haven't been used for ``max_age`` seconds are removed,
+    and the least recently used ones are removed while the cache holds
+    more than ``max_bytes``. This happens every ``evict_every`` new
+    entries, or when ``evict`` is called.
+    """
+    def __init__(self, directory=None, max_bytes=None, max_age=None,
+                 key_func=None, evict_every=100):
+        self.dir = directory or local_filename('cache')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.key_func = key_func
+        self.evict_every = evict_every
+        self.added = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, fun, args, kwargs):
+        """Compute the key for a call."""
+        if self.key_func is not None:
+            return str(self.key_func(fun, args, kwargs))
+        data = cloudpickle.dumps((fun, args, kwargs))
+        return hashlib.sha256(data).hexdigest()
+
+    def _entry(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.dir, digest[:2], digest)
+
+    def get(self, key):
+        """Look up a result. Returns a ``(found, result)`` pair."""
+        filename = os.path.join(self._entry(key), RESULT_FILE)
+        try:
+            (outcome, _), _, _, _ = payload.read(filename)
+            # Remember when the entry was last used, for eviction.
+            os.utime(filename)
+        except Exception:
+            # Not there, evicted while we were reading it, or it can't
+            # be loaded any more (because a class it uses has changed).
+            with self.lock:
+                self.misses += 1
+            return False, None
+        with self.lock:
+            self.hits += 1
+        return True, outcome[1]
+
+    def add(self, key, output_file):
+        """Add a job's output file (which must hold a successful result)
+        to the cache. The file is hard-linked where possible, so it
+        doesn't have to be copied.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        temp = '%s.%s.tmp' % (entry, random_string(8))
+        os.makedirs(temp)
+        try:
+            payload.link(output_file, os.path.join(temp, RESULT_FILE))
+            os.rename(temp, entry)
+        except OSError:
+            # Someone else added it first.
+            shutil.rmtree(temp, ignore_errors=True)
+            return
+
+        with self.lock:
+            self.added += 1
+            evict = self.evict_every and self.added % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def put(self, key, result):
+        """Add a successful call's result to the cache, for calls whose
+        job's output holds other calls' results too.
+        """
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        temp = '%s.%s.result.tmp' % (entry, random_string(8))
+        try:
+            payload.dump(((True, result), {}), temp)
+            self.add(key, temp)
+        finally:
+            payload.remove(temp)
+
+    def evict(self):
+        """Remove expired entries, and then the least recently used ones
+        until the cache is small enough.
+        """
+        if self.max_age is None and self.max_bytes is None:
+            return
+        entries = []
+        now = time.time()
+        for shard in _listdir(self.dir):
+            shard_dir = os.path.join(self.dir, shard)
+            for name in _listdir(shard_dir):
+                entry = os.path.join(shard_dir, name)
+                if name.endswith('.tmp'):
+                    # Left behind if a process died while adding it.
+                    if _age(entry, now) > STALE_TEMP_AGE:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                try:
+                    used = os.stat(os.path.join(entry, RESULT_FILE)).st_mtime
+                    size = sum(os.stat(os.path.join(entry, f)).st_size
+                               for f in os.listdir(entry))
+                except FileNotFoundError:
+                    continue
+                if self.max_age is not None and now - used > self.max_age:
+                    shutil.rmtree(entry, ignore_errors=True)
+                else:
+                    entries.append((used, size, entry))
+
+        if self.max_bytes is not None:
+            total = sum(size for _, size, _ in entries)
+            for _, size, entry in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def _age(path, now):
+    try:
+        return now - os.stat(path).st_mtime
+    except FileNotFoundError:
+        return 0
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return []
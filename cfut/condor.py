@@ -4,7 +4,7 @@ import re
 import os
 import threading
 import time
-from .util import call, chcall, local_filename
+from .util import achcall, call, chcall, local_filename
 
 LOG_FILE = local_filename("condorpy.log")
 OUTFILE_FMT = local_filename("condorpy.stdout.%s.log")
@@ -16,15 +16,22 @@ def submit_text(job):
     the cluster ID of the submitted job.
     """
     out, _ = chcall('condor_submit -v', job.encode('utf-8'))
-    jobid = re.search(rb'Proc (\d+)\.0', out).group(1)
-    return int(jobid)
+    return _cluster_id(out)
 
-def submit(executable, arguments=None, universe="vanilla", log=LOG_FILE,
-           outfile = OUTFILE_FMT % "$(Cluster)",
-           errfile = ERRFILE_FMT % "$(Cluster)"):
-    """Starts a Condor job based on specified parameters. A job
-    description is generated. Returns the cluster ID of the new job.
+async def asubmit_text(job):
+    """Like ``submit_text``, but runs condor_submit without blocking the
+    event loop.
     """
+    out, _ = await achcall(['condor_submit', '-v'], job.encode('utf-8'))
+    return _cluster_id(out)
+
+def _cluster_id(out):
+    """Find the cluster ID in the output of ``condor_submit -v``."""
+    match = re.search(rb'Proc (\d+)\.\d+|submitted to cluster (\d+)', out)
+    return int(match.group(1) or match.group(2))
+
+def _description(executable, arguments, universe, log, outfile, errfile,
+                 request_cpus=None):
     descparts = [
         "Executable = %s" % executable,
         "Universe = %s" % universe,
@@ -34,11 +41,51 @@ def submit(executable, arguments=None, universe="vanilla", log=LOG_FILE,
     ]
     if arguments:
         descparts.append("Arguments = %s" % arguments)
+    if request_cpus:
+        descparts.append("request_cpus = %i" % request_cpus)
+    return descparts
+
+def submit(executable, arguments=None, universe="vanilla", log=LOG_FILE,
+           outfile = OUTFILE_FMT % "$(Cluster)",
+           errfile = ERRFILE_FMT % "$(Cluster)", request_cpus=None):
+    """Starts a Condor job based on specified parameters. A job
+    description is generated. Returns the cluster ID of the new job.
+    """
+    descparts = _description(executable, arguments, universe, log,
+                             outfile, errfile, request_cpus)
     descparts.append("Queue")
 
     desc = "\n".join(descparts)
     return submit_text(desc)
 
+async def asubmit(executable, arguments=None, universe="vanilla",
+                  log=LOG_FILE, outfile=OUTFILE_FMT % "$(Cluster)",
+                  errfile=ERRFILE_FMT % "$(Cluster)"):
+    """Like ``submit``, for use in asyncio code."""
+    descparts = _description(executable, arguments, universe, log,
+                             outfile, errfile)
+    descparts.append("Queue")
+    return await asubmit_text("\n".join(descparts))
+
+def submit_array(executable, arguments, count, throttle=None,
+                 universe="vanilla", log=LOG_FILE,
+                 outfile = OUTFILE_FMT % "$(Cluster).$(Process)",
+                 errfile = ERRFILE_FMT % "$(Cluster).$(Process)"):
+    """Starts a cluster of ``count`` Condor jobs with a single
+    submission. ``$(Process)`` in the arguments expands to each job's
+    index. If ``throttle`` is given, at most that many of the jobs are
+    in the queue at once. Returns the job IDs as ``cluster.proc``
+    strings.
+    """
+    descparts = _description(executable, arguments, universe, log,
+                             outfile, errfile)
+    if throttle:
+        descparts.append("max_materialize = %i" % throttle)
+    descparts.append("Queue %i" % count)
+
+    clustid = submit_text("\n".join(descparts))
+    return ['%i.%i' % (clustid, proc) for proc in range(count)]
+
 def submit_script(script, **kwargs):
     """Like ``submit`` but takes the text of an executable script that
     should be used instead of a filename. Returns the cluster ID along
@@ -51,6 +98,10 @@ def submit_script(script, **kwargs):
     os.chmod(filename, 0o755)
     return submit(filename, **kwargs), filename
 
+def remove(jobid):
+    """Remove a job (or a whole cluster) from the queue."""
+    call("condor_rm %s" % str(jobid))
+
 def wait(jobid, log=LOG_FILE):
     """Waits for a cluster (or specific job) to complete."""
     call("condor_wait %s %s" % (LOG_FILE, str(jobid)))
@@ -75,21 +126,116 @@ def getoutput(jobid, log=LOG_FILE, cleanup=True):
 
     return stdout, stderr
 
+# Event codes in Condor user logs, and the job state each one leaves the
+# job in.
+EVENT_STATES = {
+    0: 'idle',         # Job submitted
+    1: 'running',      # Job executing
+    4: 'idle',         # Job evicted
+    5: 'terminated',   # Job terminated
+    7: 'idle',         # Shadow exception
+    9: 'aborted',      # Job aborted (e.g., by condor_rm)
+    12: 'held',        # Job held
+    13: 'idle',        # Job released
+}
+STATES_FINISHED = {'terminated', 'aborted'}
+# Jobs in these states won't finish unless someone intervenes.
+STATES_STALLED = {'held'}
+
+EVENT_RE = re.compile(rb'(\d{3}) \((\d+)\.(\d+)\.\d+\)')
+
+class LogReader:
+    """Incrementally reads the events in a Condor user log. Each call to
+    ``read`` only reads what was appended to the log since the last one,
+    and a table of the jobs' current states is kept up to date.
+    """
+    def __init__(self, log=LOG_FILE):
+        self.log = log
+        self.offset = 0
+        self.file_id = None
+        self.head = b''  # The start of the file, to tell if it's replaced.
+        self.partial = b''  # Incomplete last line.
+        self.in_event = False  # Whether we're inside an event's body.
+        self.states = {}  # Maps (cluster, proc) pairs to states.
+
+    def _reset(self, file_id):
+        self.file_id = file_id
+        self.offset = 0
+        self.partial = b''
+        self.in_event = False
+
+    def read(self):
+        """Read any new events. Returns a list of ``(code, cluster,
+        proc)`` tuples.
+        """
+        try:
+            f = open(self.log, 'rb')
+        except FileNotFoundError:
+            return []
+        with f:
+            # Identify the file by its inode and its first few bytes, which
+            # hold the first event's timestamp.
+            st = os.fstat(f.fileno())
+            file_id = (st.st_dev, st.st_ino)
+            head = f.read(64)
+            if (file_id != self.file_id or not head.startswith(self.head) or
+                    st.st_size < self.offset):
+                # A new or truncated log, e.g. after rotation: start over.
+                self._reset(file_id)
+            self.head = head
+            f.seek(self.offset)
+            data = f.read()
+        self.offset += len(data)
+
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+
+        events = []
+        for line in lines:
+            # Events are a header line, some detail lines, and "...".
+            if self.in_event:
+                if line.startswith(b'...'):
+                    self.in_event = False
+                continue
+            match = EVENT_RE.match(line)
+            if not match:
+                continue
+            self.in_event = True
+            code, cluster, proc = (int(g) for g in match.groups())
+            if code in EVENT_STATES:
+                self.states[cluster, proc] = EVENT_STATES[code]
+            events.append((code, cluster, proc))
+        return events
+
+    def finished(self, cluster, proc=0):
+        return self.states.get((cluster, proc)) in STATES_FINISHED
+
+def job_key(jobid):
+    """Turn a job ID, either a cluster ID or a ``cluster.proc`` string,
+    into a ``(cluster, proc)`` pair.
+    """
+    if isinstance(jobid, str) and '.' in jobid:
+        cluster, proc = jobid.split('.')
+        return int(cluster), int(proc)
+    return int(jobid), 0
+
 class WaitThread(threading.Thread):
     """A worker that polls Condor log files to observe when jobs
     finish. Each cluster is only waited upon once (after which it is
     "reaped" from the waiting pool).
     """
     def __init__(self, callback, log=LOG_FILE, interval=1):
-        """The callable ``callback`` will be invoked with the cluster
-        ID of every waited-upon job that finishes. ``interval``
-        specifies the polling rate.
+        """The callable ``callback`` will be invoked with the ID of
+        every waited-upon job that finishes: either a cluster ID or a
+        ``cluster.proc`` string, as it was passed to ``wait``.
+        ``interval`` specifies the polling rate.
         """
         threading.Thread.__init__(self)
         self.callback = callback
-        self.log = log
+        self.reader = LogReader(log)
         self.interval = interval
-        self.waiting = set()
+        self.waiting = {}  # Maps (cluster, proc) pairs to job IDs.
+        self.ready = []  # Jobs that had finished before we waited on them.
         self.lock = threading.Lock()
         self.shutdown = False
 
@@ -98,29 +244,35 @@ class WaitThread(threading.Thread):
         with self.lock:
             self.shutdown = True
 
-    def wait(self, clustid):
+    def wait(self, jobid):
         """Adds a new job ID to the set of jobs being waited upon."""
+        key = job_key(jobid)
         with self.lock:
-            self.waiting.add(clustid)
+            if self.reader.finished(*key):
+                self.ready.append(jobid)
+            else:
+                self.waiting[key] = jobid
 
     def run(self):
         while True:
             with self.lock:
                 if self.shutdown:
                     return
+                finished, self.ready = self.ready, []
+
+            # Read new events from the log file.
+            for code, cluster, proc in self.reader.read():
+                if EVENT_STATES.get(code) in STATES_FINISHED:
+                    with self.lock:
+                        jobid = self.waiting.pop((cluster, proc), None)
+                    if jobid is not None:
+                        finished.append(jobid)
+
+            for jobid in finished:
+                self.callback(jobid)
 
-                # Poll the log file.
-                if os.path.exists(self.log):
-                    with open(self.log) as f:
-                        for line in f:
-                            if 'Job terminated.' in line:
-                                clustid = re.search(r'\((\d+)\.', line).group(1)
-                                clustid = int(clustid)
-                                if clustid in self.waiting:
-                                    self.callback(clustid)
-                                    self.waiting.remove(clustid)
-
-                time.sleep(self.interval)
+            # Sleep without the lock, so that wait() isn't held up.
+            time.sleep(self.interval)
 
 if __name__ == '__main__':
     jid, jfn = submit_script("#!/bin/sh\necho hey there")
@@ -0,0 +1,182 @@
+"""An executor that runs quick calls locally and slow ones on the cluster."""
+from collections import deque
+from concurrent import futures
+import os
+import threading
+import time
+
+import cloudpickle
+
+from . import RemoteException, _result_iterator
+from .remote import run_call
+
+def _run_pickled(data):
+    """Run a cloudpickled call in a local worker process, and cloudpickle
+    its ``(success, result, run_time)`` outcome.
+    """
+    return cloudpickle.dumps(run_call(*cloudpickle.loads(data)))
+
+def function_key(fn):
+    """A name for a function that's the same every time it is defined,
+    for keeping track of how long it takes.
+    """
+    code = getattr(fn, '__code__', None)
+    name = '%s.%s' % (getattr(fn, '__module__', None),
+                      getattr(fn, '__qualname__', type(fn).__qualname__))
+    if code is not None:
+        name += ':%i' % code.co_firstlineno
+    return name
+
+class HybridExecutor(futures.Executor):
+    """Runs each call either in a local process pool or through
+    ``cluster``, a ``ClusterExecutor``.
+
+    Pass ``run_locally=True`` or ``False`` to ``submit`` to choose.
+    Otherwise, calls to a function are run locally if they have taken no
+    more than ``local_threshold`` seconds on average so far, or if the
+    ``duration`` hint says they take about that long. Calls to a
+    function that hasn't been timed yet, and has no hint, run locally to
+    find out how long they take.
+
+    A quick call is done sooner locally than as a cluster job, even if it
+    has to wait, so while ``max_local_pending`` local calls are
+    outstanding, submitting another call to run locally waits for one of
+    them to finish.
+
+    ``decisions`` holds a record for each of the latest calls: the
+    function, where it ran, the estimate it was routed on and how long
+    it actually ran. ``stats`` summarizes them by function.
+    """
+    def __init__(self, cluster, local_workers=None, local_threshold=1.0,
+                 max_local_pending=None, keep=10000):
+        self.cluster = cluster
+        local_workers = local_workers or os.cpu_count() or 1
+        self.local = futures.ProcessPoolExecutor(local_workers)
+        self.local_threshold = local_threshold
+        self.max_local_pending = max_local_pending or 4 * local_workers
+
+        self.lock = threading.Lock()
+        self.estimates = {}  # Moving averages of run times, by function.
+        self.changed = threading.Condition(self.lock)
+        self.local_pending = 0
+        self.decisions = deque(maxlen=keep)
+
+    def _route(self, key, run_locally, duration):
+        """Decide whether to run a call locally, and return that decision
+        with the estimate it was based on. The decision is None if the
+        call should wait for room locally. Call with the lock held.
+        """
+        estimate = self.estimates.get(key, duration)
+        if run_locally is not None:
+            return run_locally, estimate
+        if estimate is not None and estimate > self.local_threshold:
+            return False, estimate
+        if self.local_pending >= self.max_local_pending:
+            return None, estimate
+        return True, estimate
+
+    def _observe(self, key, decision, run_time):
+        with self.lock:
+            if decision['where'] == 'local':
+                self.local_pending -= 1
+                self.changed.notify_all()
+            if run_time is not None:
+                decision['run_time'] = run_time
+                old = self.estimates.get(key)
+                self.estimates[key] = run_time if old is None else \
+                    old + 0.2 * (run_time - old)
+            decision['wall_time'] = time.time() - decision['submitted']
+
+    def submit(self, fn, *args, run_locally=None, duration=None, **kwargs):
+        """Submit a call, to run wherever ``run_locally`` says or where
+        the routing policy chooses. ``duration`` is a guess at how many
+        seconds the call takes, used until the function has been timed.
+        """
+        key = function_key(fn)
+        with self.lock:
+            while True:
+                local, estimate = self._route(key, run_locally, duration)
+                if local is not None:
+                    break
+                self.changed.wait()
+            if local:
+                self.local_pending += 1
+        decision = {
+            'function': key, 'where': 'local' if local else 'cluster',
+            'estimate': estimate, 'run_time': None, 'submitted': time.time(),
+        }
+        self.decisions.append(decision)
+
+        if not local:
+            fut = self.cluster.submit(fn, *args, **kwargs)
+            fut.add_done_callback(
+                lambda f: self._observe(key, decision, _cluster_run_time(f))
+            )
+            return fut
+
+        fut = futures.Future()
+        try:
+            local_fut = self.local.submit(
+                _run_pickled, cloudpickle.dumps((fn, args, kwargs))
+            )
+        except BaseException:
+            self._observe(key, decision, None)
+            raise
+
+        def finished(local_fut):
+            try:
+                success, result, run_time = \
+                    cloudpickle.loads(local_fut.result())
+            except BaseException as exc:
+                # The worker process died, for example.
+                self._observe(key, decision, None)
+                fut.set_exception(exc)
+                return
+            self._observe(key, decision, run_time)
+            if success:
+                fut.set_result(result)
+            else:
+                fut.set_exception(RemoteException(result))
+
+        local_fut.add_done_callback(finished)
+        return fut
+
+    def map(self, fn, *iterables, timeout=None, duration=None):
+        """Like ``Executor.map``, passing ``duration`` on to ``submit``."""
+        fs = [self.submit(fn, *args, duration=duration)
+              for args in zip(*iterables)]
+        return _result_iterator(fs, timeout)
+
+    def stats(self):
+        """Summarize the recorded decisions: for each function, how many
+        calls ran locally and on the cluster, their mean run times and
+        the current estimate.
+        """
+        stats = {}
+        measured = {}
+        for decision in list(self.decisions):
+            key = decision['function']
+            s = stats.setdefault(key, {
+                'local': 0, 'cluster': 0, 'local_run_time': None,
+                'cluster_run_time': None, 'estimate': self.estimates.get(key),
+            })
+            where = decision['where']
+            s[where] += 1
+            if decision['run_time'] is not None:
+                measured.setdefault((key, where), []).append(
+                    decision['run_time']
+                )
+        for (key, where), run_times in measured.items():
+            stats[key][where + '_run_time'] = sum(run_times) / len(run_times)
+        return stats
+
+    def shutdown(self, wait=True):
+        self.cluster.shutdown(wait)
+        self.local.shutdown(wait)
+
+def _cluster_run_time(fut):
+    """How long a cluster job's call ran, from its timing record."""
+    timing = getattr(fut, 'timing', {})
+    if 'worker_loaded' in timing and 'worker_finished' in timing:
+        return timing['worker_finished'] - timing['worker_loaded']
+    return None
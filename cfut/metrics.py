@@ -0,0 +1,144 @@
+"""Where the time goes in each job.
+
+Every job gets a timing record: a dict of timestamps (from ``time.time``)
+for the steps it went through, filled in partly by the executor and
+partly by the worker. The executor keeps a ``Metrics`` object that
+collects the records of finished jobs, summarizes them and passes each
+one to any hooks that want to export it.
+
+The steps, in order:
+
+``submitted``
+    The executor started preparing the job.
+``serialized``
+    Its input file was written.
+``queued``
+    The scheduler accepted it.
+``worker_started``
+    The worker started running it. The time since ``queued`` includes the
+    time spent waiting in the scheduler's queue and starting Python.
+``worker_loaded``
+    The worker read its input.
+``worker_finished``
+    The call (or chunk of calls) returned.
+``detected``
+    The executor noticed the job's output. This includes the time taken
+    to write the output and the time until the next poll.
+``loaded``
+    The executor read the output.
+
+The worker also adds its peak memory use in bytes (``max_rss``) and the
+CPU time it used in seconds (``cpu_time``), where it can measure them.
+
+The worker's timestamps come from the clock of the host it ran on, so
+durations that span hosts are only as good as the hosts' clock sync.
+"""
+from collections import deque
+import json
+import threading
+
+STEPS = [
+    'submitted', 'serialized', 'queued', 'worker_started', 'worker_loaded',
+    'worker_finished', 'detected', 'loaded',
+]
+
+# Named durations between steps.
+PHASES = {
+    'serialize': ('submitted', 'serialized'),
+    'submit': ('serialized', 'queued'),
+    'queue': ('queued', 'worker_started'),
+    'load': ('worker_started', 'worker_loaded'),
+    'run': ('worker_loaded', 'worker_finished'),
+    'detect': ('worker_finished', 'detected'),
+    'deserialize': ('detected', 'loaded'),
+    'total': ('submitted', 'loaded'),
+}
+
+def phases(timing):
+    """Work out how long each phase of a job took, in seconds, from its
+    timing record. Phases whose steps weren't recorded are left out.
+    """
+    return {name: timing[end] - timing[start]
+            for name, (start, end) in PHASES.items()
+            if start in timing and end in timing}
+
+def percentile(values, q):
+    """The ``q``-th quantile (between 0 and 1) of a sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Metrics:
+    """Collects a record for each finished job: a dict with its ``jobid``,
+    the number of ``calls`` it ran, its ``timing``, the ``phases``
+    computed from that, its ``payload_bytes`` and how many of its calls
+    ``failed``. The most recent ``keep`` records are kept for
+    ``summary``.
+    """
+    def __init__(self, keep=10000):
+        self.records = deque(maxlen=keep)
+        self.hooks = []
+        self.lock = threading.Lock()
+
+    def add_hook(self, hook):
+        """Call ``hook`` with each job's record when the job finishes.
+        Hooks run on the thread that notices finished jobs, so they
+        should be quick.
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    def record(self, record):
+        record['phases'] = phases(record['timing'])
+        with self.lock:
+            self.records.append(record)
+        for hook in list(self.hooks):
+            hook(record)
+
+    def summary(self):
+        """Summarize the kept records: the count, median, 90th and 99th
+        percentile, maximum and total of each phase's duration, along
+        with the numbers of jobs, calls and failed calls and the total
+        payload bytes.
+        """
+        with self.lock:
+            records = list(self.records)
+
+        summary = {
+            'jobs': len(records),
+            'calls': sum(r['calls'] for r in records),
+            'failed': sum(r['failed'] for r in records),
+            'phases': {},
+            'payload_bytes': {},
+        }
+        for name in PHASES:
+            values = sorted(r['phases'][name] for r in records
+                            if name in r['phases'])
+            if values:
+                summary['phases'][name] = {
+                    'count': len(values),
+                    'p50': percentile(values, 0.5),
+                    'p90': percentile(values, 0.9),
+                    'p99': percentile(values, 0.99),
+                    'max': values[-1],
+                    'total': sum(values),
+                }
+        for r in records:
+            for key, value in r['payload_bytes'].items():
+                summary['payload_bytes'][key] = \
+                    summary['payload_bytes'].get(key, 0) + value
+        return summary
+
+class JsonLinesWriter:
+    """A hook that writes each record to a file as a line of JSON."""
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.Lock()
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
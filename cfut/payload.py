@@ -0,0 +1,244 @@
+"""Reading and writing the files that carry jobs' inputs and outputs.
+
+Objects are pickled with protocol 5 where it's available. Large buffers
+that support it (NumPy arrays, for instance) are then written "out of
+band" to a separate file next to the pickle, each starting at an aligned
+offset. Loading maps that file into memory instead of reading it, so a
+large array is never copied into the process's heap.
+
+Alternatively, pickles can be compressed with a ``Codec``. The header of
+a file records the codec, so that whoever reads it can tell how to
+decompress it, and the worker can compress its result the same way.
+"""
+from collections import namedtuple
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import zlib
+import cloudpickle
+
+# Files that start with this have a header; plain pickles don't. The
+# header is the magic string and a flags byte; if HAS_CODEC is set, it
+# goes on with the codec's name (a length byte and then the name) and its
+# size threshold.
+MAGIC = b'CFUT'
+HEADER = struct.Struct('<4sB')
+THRESHOLD = struct.Struct('<Q')
+HAS_BUFFERS = 0x01
+COMPRESSED = 0x02
+HAS_CODEC = 0x04
+
+BUFFERS_SUFFIX = '.buffers'
+BUFFERS_MAGIC = b'CFUTBUF1'
+ALIGNMENT = 64
+
+# Buffers smaller than this are kept inside the pickle.
+OUT_OF_BAND_THRESHOLD = 2**16
+
+PROTOCOL_5 = hasattr(pickle, 'PickleBuffer')
+
+# Compression functions by name. lz4 and zstd are available if their
+# packages are installed.
+CODECS = {
+    'zlib': (zlib.compress, zlib.decompress),
+}
+try:
+    import lz4.frame
+except ImportError:
+    pass
+else:
+    CODECS['lz4'] = (lz4.frame.compress, lz4.frame.decompress)
+try:
+    import zstandard
+except ImportError:
+    pass
+else:
+    CODECS['zstd'] = (
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        lambda data: zstandard.ZstdDecompressor().decompress(data),
+    )
+
+class Codec(namedtuple('Codec', ['name', 'threshold'])):
+    """A compression policy: pickles of at least ``threshold`` bytes are
+    compressed with the named codec.
+    """
+    def __new__(cls, name, threshold=2**20):
+        if name not in CODECS:
+            raise ValueError("codec %r is not available (have: %s)"
+                             % (name, ', '.join(sorted(CODECS))))
+        return super().__new__(cls, name, threshold)
+
+# What ``read`` returns: the object, the codec it was written with (if
+# any), and the size of its pickle before and after compression, in
+# bytes. The sizes include any out-of-band buffers.
+Loaded = namedtuple('Loaded', ['obj', 'codec', 'raw_size', 'stored_size'])
+
+def dumps(obj, codec=None):
+    """Pickle an object, compressing it according to ``codec`` if one is
+    given. Returns the data to write (with its header), a list of the
+    buffers that should be stored out of band, and the uncompressed size.
+    Compressed pickles keep all their buffers in band.
+    """
+    buffers = []
+    if not PROTOCOL_5:
+        data = cloudpickle.dumps(obj)
+    elif codec:
+        data = cloudpickle.dumps(obj, protocol=5)
+    else:
+        def keep_in_band(buf):
+            if buf.raw().nbytes < OUT_OF_BAND_THRESHOLD:
+                return True
+            buffers.append(buf)
+            return False
+        data = cloudpickle.dumps(obj, protocol=5,
+                                 buffer_callback=keep_in_band)
+    raw_size = len(data) + sum(buf.raw().nbytes for buf in buffers)
+
+    flags = HAS_BUFFERS if buffers else 0
+    header = b''
+    if codec:
+        flags |= HAS_CODEC
+        name = codec.name.encode('ascii')
+        header = bytes([len(name)]) + name + THRESHOLD.pack(codec.threshold)
+        if len(data) >= codec.threshold:
+            flags |= COMPRESSED
+            data = CODECS[codec.name][0](data)
+    if flags:
+        data = HEADER.pack(MAGIC, flags) + header + data
+    return data, buffers, raw_size
+
+def _aligned(n):
+    return (n + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _write_buffers(filename, buffers):
+    """Write buffers to a file: a header giving each one's offset and
+    length, followed by the data with each buffer aligned.
+    """
+    views = [buf.raw() for buf in buffers]
+    stream_buffers(filename, len(views),
+                   ((view.nbytes, [view]) for view in views))
+
+def stream_buffers(filename, count, buffers):
+    """Write a buffers file, as ``_write_buffers`` does, without having
+    the buffers in memory. ``buffers`` generates a ``(length, pieces)``
+    pair for each of the ``count`` buffers, where ``pieces`` generates
+    its data.
+    """
+    offset = _aligned(len(BUFFERS_MAGIC) + 8 + 16 * count)
+    table = []
+    with open(filename, 'wb') as f:
+        for length, pieces in buffers:
+            f.seek(offset)
+            for piece in pieces:
+                f.write(piece)
+            table.append((offset, length))
+            offset = _aligned(offset + length)
+        if len(table) != count:
+            raise ValueError("expected %i buffers, got %i"
+                             % (count, len(table)))
+
+        f.seek(0)
+        f.write(BUFFERS_MAGIC)
+        f.write(struct.pack('<Q', count))
+        for entry in table:
+            f.write(struct.pack('<QQ', *entry))
+
+def _map_buffers(filename):
+    """Map a buffers file into memory and return a memoryview for each
+    buffer. The mapping is copy-on-write, so the objects built on the
+    buffers are writable without changing the file.
+    """
+    with open(filename, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    if mapped[:len(BUFFERS_MAGIC)] != BUFFERS_MAGIC:
+        raise ValueError("%s is not a buffers file" % filename)
+    count, = struct.unpack_from('<Q', mapped, len(BUFFERS_MAGIC))
+    view = memoryview(mapped)
+    buffers = []
+    for i in range(count):
+        start, length = struct.unpack_from(
+            '<QQ', mapped, len(BUFFERS_MAGIC) + 8 + 16 * i
+        )
+        buffers.append(view[start:start + length])
+    return buffers
+
+def write(filename, data, buffers=()):
+    """Write data from ``dumps``, and any out-of-band buffers, to
+    ``filename``. The file appears atomically, once everything has been
+    written. Returns the number of bytes written.
+    """
+    if buffers:
+        _write_buffers(filename + BUFFERS_SUFFIX, buffers)
+
+    tempfile = filename + '.tmp'
+    with open(tempfile, 'wb') as f:
+        f.write(data)
+    os.rename(tempfile, filename)
+    return len(data) + sum(buf.raw().nbytes for buf in buffers)
+
+def dump(obj, filename, codec=None):
+    """Pickle an object to a file. Returns its size before and after
+    compression.
+    """
+    data, buffers, raw_size = dumps(obj, codec)
+    return raw_size, write(filename, data, buffers)
+
+def read(filename):
+    """Load an object written by ``dump``, along with how it was stored
+    (see ``Loaded``).
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    stored_size = len(data)
+
+    buffers = None
+    codec = None
+    if data.startswith(MAGIC):
+        _, flags = HEADER.unpack_from(data)
+        pos = HEADER.size
+        if flags & HAS_CODEC:
+            length = data[pos]
+            name = data[pos + 1:pos + 1 + length].decode('ascii')
+            pos += 1 + length
+            threshold, = THRESHOLD.unpack_from(data, pos)
+            pos += THRESHOLD.size
+            codec = Codec(name, threshold)
+        data = memoryview(data)[pos:]
+        if flags & COMPRESSED:
+            data = CODECS[codec.name][1](data)
+        if flags & HAS_BUFFERS:
+            buffers = _map_buffers(filename + BUFFERS_SUFFIX)
+
+    if buffers is None:
+        return Loaded(cloudpickle.loads(data), codec, len(data), stored_size)
+    buffers_size = sum(buf.nbytes for buf in buffers)
+    return Loaded(cloudpickle.loads(data, buffers=buffers), codec,
+                  len(data) + buffers_size, stored_size + buffers_size)
+
+def load(filename):
+    """Load an object written by ``dump``."""
+    return read(filename).obj
+
+def link(filename, target):
+    """Make ``target`` a copy of a file written by ``dump``, and of its
+    buffers, by hard-linking them if possible.
+    """
+    for src, dst in ((filename + BUFFERS_SUFFIX, target + BUFFERS_SUFFIX),
+                     (filename, target)):
+        if not os.path.exists(src):
+            continue
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Different filesystems, or no hard links.
+            shutil.copyfile(src, dst)
+
+def remove(filename):
+    """Delete a file written by ``dump``, along with its buffers."""
+    for path in (filename, filename + BUFFERS_SUFFIX):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,156 @@
+"""A task queue on the shared filesystem, served by long-running pilot
+jobs that each run many tasks.
+"""
+from concurrent import futures
+from itertools import count
+import os
+import shutil
+import sys
+import time
+from .util import local_filename
+from .remote import add_import_paths, run_job
+
+# How long an idle pilot waits between looks at the queue, in seconds.
+# The wait doubles while the queue stays empty, up to the maximum.
+MIN_POLL_INTERVAL = 0.05
+MAX_POLL_INTERVAL = 1
+
+class TaskQueue:
+    """A queue of worker IDs kept as empty files in a directory. A pilot
+    claims a task by renaming its entry into the pilot's own directory.
+    Renaming is atomic, so every task is claimed by exactly one pilot.
+    """
+    def __init__(self, poolid):
+        # Each pool lives in its executor's session directory.
+        self.dir = os.path.join(local_filename(poolid), 'pool')
+        self.queue_dir = os.path.join(self.dir, 'queue')
+        self.claimed_dir = os.path.join(self.dir, 'claimed')
+        self.stop_file = os.path.join(self.dir, 'stop')
+        self.seq = count()
+
+    def create(self):
+        os.makedirs(self.queue_dir, exist_ok=True)
+        os.makedirs(self.claimed_dir, exist_ok=True)
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def put(self, workerid):
+        """Add a task to the queue. Its input file must already exist."""
+        # The sequence number keeps the queue roughly first-in, first-out.
+        entry = '%012i.%s' % (next(self.seq), workerid)
+        open(os.path.join(self.queue_dir, entry), 'w').close()
+
+    def pending(self):
+        """Count the tasks that no pilot has claimed yet."""
+        try:
+            return len(os.listdir(self.queue_dir))
+        except FileNotFoundError:
+            return 0
+
+    def add_pilot(self, pilotid):
+        """Create the directory where a pilot keeps its claimed tasks."""
+        os.makedirs(os.path.join(self.claimed_dir, pilotid), exist_ok=True)
+
+    def claim(self, pilotid):
+        """Claim a task for a pilot. Return its worker ID, or None if
+        there is nothing in the queue.
+        """
+        mine = os.path.join(self.claimed_dir, pilotid)
+        for entry in sorted(os.listdir(self.queue_dir)):
+            workerid = entry.partition('.')[2]
+            try:
+                os.rename(os.path.join(self.queue_dir, entry),
+                          os.path.join(mine, workerid))
+            except FileNotFoundError:
+                continue  # Another pilot claimed it first.
+            return workerid
+        return None
+
+    def finish(self, pilotid, workerid):
+        """Release a pilot's claim on a task once its output is written."""
+        os.unlink(os.path.join(self.claimed_dir, pilotid, workerid))
+
+    def claimed(self, pilotid):
+        """List the worker IDs that a pilot claimed but did not finish."""
+        try:
+            return os.listdir(os.path.join(self.claimed_dir, pilotid))
+        except FileNotFoundError:
+            return []
+
+    def done_file(self, pilotid):
+        """The file a pilot creates when it exits."""
+        return os.path.join(self.dir, 'pilot.%s.done' % pilotid)
+
+    def forget_pilot(self, pilotid):
+        shutil.rmtree(os.path.join(self.claimed_dir, pilotid),
+                      ignore_errors=True)
+        try:
+            os.unlink(self.done_file(pilotid))
+        except FileNotFoundError:
+            pass
+
+    def stop(self):
+        """Ask all pilots to exit."""
+        open(self.stop_file, 'w').close()
+
+    def stopped(self):
+        return os.path.exists(self.stop_file)
+
+def pilot(poolid, pilotid, idle_timeout, cores=1, extra_import_paths="!",
+          result_address=None):
+    """Called to run a pilot job on a remote host. Runs tasks from the
+    queue until it has been empty for ``idle_timeout`` seconds. With
+    more than one core, that many tasks run at once, each in a worker
+    process of its own. Results go to ``result_address``, as for
+    ``cfut.remote.worker``.
+    """
+    print("pilot")
+    add_import_paths(extra_import_paths)
+    queue = TaskQueue(poolid)
+    idle_timeout = float(idle_timeout)
+    cores = int(cores)
+
+    queue.add_pilot(pilotid)
+    workers = futures.ProcessPoolExecutor(cores) if cores > 1 else None
+    running = {}  # Maps the futures of tasks in workers to worker IDs.
+    try:
+        idle_since = time.time()
+        interval = MIN_POLL_INTERVAL
+        while True:
+            for fut in [f for f in running if f.done()]:
+                fut.result()  # Raises if the worker process died.
+                queue.finish(pilotid, running.pop(fut))
+                idle_since = time.time()
+
+            stopped = queue.stopped()
+            if not running and (stopped or
+                                time.time() - idle_since >= idle_timeout):
+                break
+            workerid = None
+            if len(running) < cores and not stopped:
+                workerid = queue.claim(pilotid)
+            if workerid is None:
+                if running:
+                    futures.wait(running, interval, futures.FIRST_COMPLETED)
+                else:
+                    time.sleep(interval)
+                interval = min(interval * 2, MAX_POLL_INTERVAL)
+                continue
+
+            print("running", workerid)
+            if workers is None:
+                run_job(workerid, result_address)
+                queue.finish(pilotid, workerid)
+                idle_since = time.time()
+            else:
+                running[workers.submit(run_job, workerid,
+                                       result_address)] = workerid
+            interval = MIN_POLL_INTERVAL
+    finally:
+        if workers is not None:
+            workers.shutdown()
+        open(queue.done_file(pilotid), 'w').close()
+
+if __name__ == '__main__':
+    pilot(*sys.argv[1:])
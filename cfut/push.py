@@ -0,0 +1,174 @@
+"""Sending results straight back to the executor over TCP, so that it
+notices them without waiting for its next look at the shared filesystem.
+
+The executor runs a ``ResultServer`` and passes its address to workers
+on their command lines. A worker connects and sends a key that proves
+it belongs to the executor, its worker ID, and its result as made by
+``payload.dumps``. The server writes the result to the job's output
+file, where everything else expects to find it, acknowledges it, and
+reports the job finished straight away. A worker that can't connect,
+or doesn't hear back, writes the output file itself as usual.
+
+The key is kept in the executor's session directory, readable only by
+its owner, so only the owner's jobs can send results.
+"""
+import hmac
+import os
+import re
+import socket
+import socketserver
+import struct
+import threading
+
+from . import payload
+from .util import local_filename, output_path, random_string
+
+KEY_FILE = 'push.key'
+KEY_SIZE = 32
+LENGTH = struct.Struct('<Q')
+ACK = b'K'
+
+# How long, in seconds, a worker waits to connect, and then for each
+# step of sending its result and hearing back.
+CONNECT_TIMEOUT = 10
+IO_TIMEOUT = 300
+
+# The most of a result the server holds in memory at once, in bytes.
+PIECE_SIZE = 2**20
+
+def key_file(workerid):
+    """The file holding the key for a worker's executor."""
+    return os.path.join(local_filename(workerid.rsplit('.', 1)[0]),
+                        KEY_FILE)
+
+def _read_exactly(rfile, size):
+    data = rfile.read(size)
+    if len(data) != size:
+        raise EOFError("connection closed early")
+    return data
+
+def _read_chunk(rfile):
+    size, = LENGTH.unpack(_read_exactly(rfile, LENGTH.size))
+    return _read_exactly(rfile, size)
+
+def _stream_chunk(rfile):
+    """Start reading a chunk. Returns its length and a generator of its
+    data in pieces, which must be used up before reading anything else.
+    """
+    size, = LENGTH.unpack(_read_exactly(rfile, LENGTH.size))
+
+    def pieces():
+        left = size
+        while left:
+            piece = _read_exactly(rfile, min(left, PIECE_SIZE))
+            left -= len(piece)
+            yield piece
+    return size, pieces()
+
+def _receive_file(filename, rfile):
+    """Write a chunk to a file as it arrives."""
+    _, pieces = _stream_chunk(rfile)
+    with open(filename, 'wb') as f:
+        for piece in pieces:
+            f.write(piece)
+
+def _send_chunk(sock, data):
+    data = memoryview(data)
+    sock.sendall(LENGTH.pack(data.nbytes))
+    sock.sendall(data)
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Don't let a worker that goes quiet hold a thread forever.
+    timeout = IO_TIMEOUT
+
+    def handle(self):
+        try:
+            self.server.results.receive(self.rfile, self.wfile)
+        except (OSError, EOFError, ValueError):
+            pass  # The worker writes its output file instead.
+
+class ResultServer:
+    """Receives results from a session's workers. ``callback`` is called
+    with the worker ID of each result, once its output file is written.
+    The server listens on ``host`` (all interfaces by default), and
+    ``address`` is where workers should connect.
+    """
+    def __init__(self, session, callback, host=None):
+        self.key = os.urandom(KEY_SIZE)
+        fd = os.open(session.filename(KEY_FILE),
+                     os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(self.key)
+        self.workerid_re = re.compile(r'%s\.\d+\Z' % re.escape(session.id))
+        self.callback = callback
+
+        self.server = socketserver.ThreadingTCPServer((host or '', 0),
+                                                      _Handler)
+        self.server.daemon_threads = True
+        self.server.results = self
+        self.address = '%s:%i' % (host or socket.gethostname(),
+                                  self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True, name='cfut-push')
+        self.thread.start()
+
+    def receive(self, rfile, wfile):
+        """Read one result from a connection."""
+        if not hmac.compare_digest(_read_exactly(rfile, KEY_SIZE), self.key):
+            return
+        workerid = _read_chunk(rfile).decode('ascii')
+        if not self.workerid_re.match(workerid):
+            return
+
+        # Results can be large, so they go straight to temporary files,
+        # which take the output's place once they're complete. The
+        # worker may still be writing its own files if it gave up on us.
+        filename = output_path(workerid)
+        buffers_file = filename + payload.BUFFERS_SUFFIX
+        suffix = '.%s.tmp' % random_string(8)
+        try:
+            _receive_file(filename + suffix, rfile)
+            count, = LENGTH.unpack(_read_exactly(rfile, LENGTH.size))
+            if count:
+                payload.stream_buffers(
+                    buffers_file + suffix, count,
+                    (_stream_chunk(rfile) for _ in range(count))
+                )
+                os.replace(buffers_file + suffix, buffers_file)
+            os.replace(filename + suffix, filename)
+        except BaseException:
+            for path in (filename + suffix, buffers_file + suffix):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            raise
+        wfile.write(ACK)
+        wfile.flush()
+        self.callback(workerid)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+def send(address, workerid, data, buffers=()):
+    """Send a worker's result, as made by ``payload.dumps``, to the
+    ``ResultServer`` at ``address``. Returns whether it was received.
+    """
+    host, _, port = address.rpartition(':')
+    try:
+        with open(key_file(workerid), 'rb') as f:
+            key = f.read()
+        with socket.create_connection((host, int(port)),
+                                      CONNECT_TIMEOUT) as sock:
+            sock.settimeout(IO_TIMEOUT)
+            sock.sendall(key)
+            _send_chunk(sock, workerid.encode('ascii'))
+            _send_chunk(sock, data)
+            sock.sendall(LENGTH.pack(len(buffers)))
+            for buf in buffers:
+                _send_chunk(sock, buf.raw())
+            return sock.recv(1) == ACK
+    except (OSError, ValueError):
+        return False
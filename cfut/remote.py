@@ -1,18 +1,68 @@
 """Tools for executing remote commands."""
-import cloudpickle
 import sys
 import os
+import time
 import traceback
-from .util import INFILE_FMT, OUTFILE_FMT
+try:
+    import resource
+except ImportError:
+    resource = None  # Not on Windows.
+from . import payload
+from . import push
+from .broadcast import unwrap
+from .util import ARRAY_TASK_ID, array_workerid, input_path, output_path
 
 def format_remote_exc():
     typ, value, tb = sys.exc_info()
-    tb = tb.tb_next  # Remove root call to worker().
+    tb = tb.tb_next  # Remove root call to run_job().
     return ''.join(traceback.format_exception(typ, value, tb))
 
-def worker(workerid, extra_import_paths="!"):
-    """Called to execute a job on a remote host."""
-    print("worker")
+class UpstreamFailed(Exception):
+    """The call that computes one of a job's arguments failed."""
+
+class Upstream:
+    """Stands in for an argument that is the result of another job's
+    call. The worker reads it from that job's output file.
+    """
+    def __init__(self, workerid, index=None):
+        self.workerid = workerid
+        self.index = index  # The call's position in its chunk, if any.
+
+    def load(self):
+        (outcome, _), _, _, _ = payload.read(output_path(self.workerid))
+        if self.index is not None:
+            success, result, _ = outcome[self.index]
+        else:
+            success, result = outcome
+        if not success:
+            raise UpstreamFailed(
+                "Call in job %s failed:\n%s" % (self.workerid, result)
+            )
+        return result
+
+def resolve(args, kwargs):
+    """Load the results of other jobs that a call's arguments stand for."""
+    args = [a.load() if isinstance(a, Upstream) else a for a in args]
+    kwargs = {k: v.load() if isinstance(v, Upstream) else v
+              for k, v in kwargs.items()}
+    return args, kwargs
+
+def run_call(fun, args, kwargs):
+    """Run one call from a chunk. Returns a ``(success, result,
+    run_time)`` tuple.
+    """
+    start = time.time()
+    try:
+        result = True, unwrap(fun)(*args, **kwargs)
+    except Exception:
+        print(traceback.format_exc())
+        result = False, format_remote_exc()
+    return (*result, time.time() - start)
+
+def add_import_paths(extra_import_paths):
+    """Prepend a colon-separated list of paths to ``sys.path``, unless
+    it is ``!`` (meaning none).
+    """
     if extra_import_paths != '!':
         extra_import_paths = extra_import_paths.split(':')
         print("Prepending %d paths to sys.path:" % len(extra_import_paths))
@@ -20,24 +70,68 @@ def worker(workerid, extra_import_paths="!"):
             print(" ", p)
         sys.path[:0] = extra_import_paths
 
+def record_usage(timing):
+    """Add the process's peak memory use, in bytes, and the CPU time it
+    has used, in seconds, to a timing record.
+    """
+    if resource is None:
+        return
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # Linux reports the peak in kilobytes, macOS in bytes.
+    scale = 1 if sys.platform == 'darwin' else 1024
+    timing['max_rss'] = usage.ru_maxrss * scale
+    timing['cpu_time'] = usage.ru_utime + usage.ru_stime
+
+def run_job(workerid, result_address=None):
+    """Run the call (or chunk of calls) in a worker's input file and
+    write the outcome to its output file, along with a dict of when the
+    job started, finished loading its input and finished running, and
+    the resources it used. With ``result_address``, the outcome is sent
+    to the executor's result server instead, if it can be reached.
+    """
+    timing = {'worker_started': time.time()}
+    codec = None
     try:
-        with open(INFILE_FMT % workerid, 'rb') as f:
-            indata = f.read()
-        fun, args, kwargs = cloudpickle.loads(indata)
-        result = True, fun(*args, **kwargs)
-        out = cloudpickle.dumps(result)
+        # Compress the result the same way as the input, if it was.
+        job, codec, _, _ = payload.read(input_path(workerid))
+        timing['worker_loaded'] = time.time()
+        if isinstance(job, list):
+            # A chunk of calls, each of which succeeds or fails separately.
+            result = [run_call(*call) for call in job]
+        else:
+            fun, args, kwargs = job
+            args, kwargs = resolve(args, kwargs)
+            result = True, unwrap(fun)(*args, **kwargs)
+        timing['worker_finished'] = time.time()
+        record_usage(timing)
+        data, buffers, _ = payload.dumps((result, timing), codec)
 
     except Exception as e:
         print(traceback.format_exc())
 
         result = False, format_remote_exc()
-        out = cloudpickle.dumps(result)
+        timing['worker_finished'] = time.time()
+        record_usage(timing)
+        data, buffers, _ = payload.dumps((result, timing), codec)
+
+    if result_address is None or \
+            not push.send(result_address, workerid, data, buffers):
+        payload.write(output_path(workerid), data, buffers)
 
-    destfile = OUTFILE_FMT % workerid
-    tempfile = destfile + '.tmp'
-    with open(tempfile, 'wb') as f:
-        f.write(out)
-    os.rename(tempfile, destfile)
+def worker(workerid, extra_import_paths="!", result_address=None):
+    """Called to execute a job on a remote host. ``result_address`` is
+    where the executor's result server listens, if it has one.
+    """
+    print("worker")
+    if ARRAY_TASK_ID in workerid:
+        workerid = workerid.replace(
+            ARRAY_TASK_ID, os.environ['SLURM_ARRAY_TASK_ID']
+        )
+    if '+' in workerid:
+        # One task of a job array: the index picks out our input file.
+        workerid = array_workerid(*workerid.split('+'))
+    add_import_paths(extra_import_paths)
+    run_job(workerid, result_address)
 
 if __name__ == '__main__':
     worker(*sys.argv[1:])
@@ -0,0 +1,153 @@
+"""Learning how much memory, time and CPU each function's jobs use, so
+that jobs can ask the scheduler for about that much instead of a
+generous guess.
+
+Workers record their peak memory use and CPU time along with their
+timing (see ``cfut.metrics``). A ``ResourceProfiles`` store keeps the
+most recent of these for each function, in a JSON file per function,
+so later runs and other drivers sharing the directory benefit too.
+"""
+import json
+import math
+import os
+import re
+import threading
+import time
+
+from .util import local_filename, random_string
+
+class ResourceProfiles:
+    """Records what jobs running each function used, keyed by the
+    function's module and qualified name, and works out what later jobs
+    should ask for.
+
+    Once a function has ``min_runs`` recorded runs, its jobs ask for
+    ``margin`` times the most memory and time used by any of the last
+    ``window`` runs (and at least ``min_time`` seconds), and for as many
+    CPUs as those runs kept busy on average. A job that runs out of
+    memory is tried again with ``oom_factor`` times the memory it had,
+    up to ``max_attempts`` times in all, and the function's later jobs
+    ask for at least that much.
+
+    Runs are kept in memory and written to the files at most every
+    ``flush_interval`` seconds, and when the executor shuts down (see
+    ``flush``).
+    """
+    def __init__(self, directory=None, margin=1.5, min_runs=3, window=20,
+                 min_time=60, oom_factor=2, max_attempts=3,
+                 flush_interval=60):
+        self.dir = directory or local_filename('profiles')
+        self.margin = margin
+        self.min_runs = min_runs
+        self.window = window
+        self.min_time = min_time
+        self.oom_factor = oom_factor
+        self.max_attempts = max_attempts
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.profiles = {}  # Profiles read or written so far, by key.
+        self.unsaved = {}  # Runs not yet written to the files, by key.
+        self.flushed = time.monotonic()
+
+    def key(self, fun):
+        """The key for a function's profile, or None if it has no name."""
+        module = getattr(fun, '__module__', None)
+        qualname = getattr(fun, '__qualname__', None)
+        if module is None or qualname is None:
+            return None
+        return '%s.%s' % (module, qualname)
+
+    def _file(self, key):
+        return os.path.join(self.dir,
+                            re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def _load(self, key):
+        try:
+            with open(self._file(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'runs': [], 'min_mem': 0}
+
+    def _save(self, key, profile):
+        """Write a profile read from its file, along with the runs that
+        haven't been written yet.
+        """
+        # Start from the file, to keep runs that other drivers added.
+        runs = profile['runs'] + self.unsaved.pop(key, [])
+        profile['runs'] = runs[-self.window:]
+        os.makedirs(self.dir, exist_ok=True)
+        filename = self._file(key)
+        temp = '%s.%s.tmp' % (filename, random_string(8))
+        with open(temp, 'w') as f:
+            json.dump(profile, f)
+        os.replace(temp, filename)
+        self.profiles[key] = profile
+
+    def get(self, key):
+        """A function's profile: a dict with a list of ``runs``, each a
+        ``[max_rss, elapsed, cpu_time]`` list, and the least memory its
+        jobs should ask for (``min_mem``).
+        """
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key):
+        if key not in self.profiles:
+            self.profiles[key] = self._load(key)
+        return self.profiles[key]
+
+    def observe(self, key, timing):
+        """Record the resources used by a job, from its timing record."""
+        if 'max_rss' not in timing or 'worker_finished' not in timing:
+            return
+        run = [timing['max_rss'],
+               timing['worker_finished'] - timing['worker_started'],
+               timing['cpu_time']]
+        with self.lock:
+            profile = self._get(key)
+            profile['runs'] = (profile['runs'] + [run])[-self.window:]
+            unsaved = self.unsaved.setdefault(key, [])
+            unsaved.append(run)
+            del unsaved[:-self.window]
+            if time.monotonic() - self.flushed < self.flush_interval:
+                return
+        self.flush()
+
+    def flush(self):
+        """Write the runs recorded since the last flush to the files."""
+        with self.lock:
+            for key in list(self.unsaved):
+                self._save(key, self._load(key))
+            self.flushed = time.monotonic()
+
+    def out_of_memory(self, key, requested):
+        """Note that a job that asked for ``requested`` bytes ran out of
+        memory. Returns how much it should ask for next time.
+        """
+        with self.lock:
+            profile = self._load(key)
+            profile['min_mem'] = max(profile['min_mem'],
+                                     math.ceil(requested * self.oom_factor))
+            self._save(key, profile)
+            return profile['min_mem']
+
+    def requests(self, key):
+        """What a job running the function should ask for: a dict with
+        the ``mem`` (in bytes), ``time`` (in seconds) and ``cpus`` to
+        request. Things there aren't enough runs to tell are left out.
+        """
+        profile = self.get(key)
+        wanted = {}
+        runs = profile['runs']
+        if len(runs) >= self.min_runs:
+            wanted['mem'] = math.ceil(max(r[0] for r in runs) * self.margin)
+            wanted['time'] = max(self.min_time,
+                                 max(r[1] for r in runs) * self.margin)
+            # A little slack, so that a busy single-threaded job doesn't
+            # ask for two CPUs.
+            busy = [cpu_time / elapsed for _, elapsed, cpu_time in runs
+                    if elapsed > 0]
+            wanted['cpus'] = max([1] + [math.ceil(b - 0.1) for b in busy])
+        if profile['min_mem']:
+            wanted['mem'] = max(wanted.get('mem', 0), profile['min_mem'])
+        return wanted
@@ -0,0 +1,170 @@
+"""The directories under ``CFUT_DIR`` where executors keep their files,
+and cleaning up after executors that are gone.
+
+Each executor has a session: a directory of its own, holding its tasks'
+input and output files, the scheduler's logs for its jobs, its blobs and
+its pilot pool's queue. Task files are split between subdirectories
+(shards) of ``SHARD_SIZE`` tasks, numbered in the order the tasks were
+submitted (see ``cfut.util.task_path``). No directory grows with the
+number of tasks, and tasks that are outstanding at the same time share
+a few shards, so the wait thread only has to list those.
+
+An executor that crashes leaves its session behind. ``collect`` removes
+sessions that haven't been used for a while, unless the process that
+owns them is still running on this host, and executors run it in the
+background when they start.
+"""
+from fnmatch import fnmatch
+import os
+import shutil
+import socket
+import threading
+import time
+
+from .util import SHARD_SIZE, local_filename, random_string
+
+# A file in each session's directory, naming the process that owns it.
+# Its modification time is when the session was last used.
+SESSION_FILE = 'session'
+
+# How often, in seconds, a session in use updates its SESSION_FILE.
+TOUCH_INTERVAL = 60
+
+# Sessions unused for this long, in seconds, are removed by ``collect``.
+MAX_AGE = 24 * 3600
+
+# Files that older versions kept directly in CFUT_DIR. These are removed
+# by ``collect`` once they are as old as an unused session.
+LEFTOVER_PATTERNS = [
+    'cfut.in.*', 'cfut.out.*', 'cfut.blob.*', 'cfut.log.*', 'cfut.pool.*',
+    'slurmpy.stdout.*', 'condorpy.stdout.*', 'condorpy.stderr.*',
+    'condorpy.jobscript.*', '_temp_*.sh',
+]
+
+class Session:
+    """A directory for one executor's files. Hands out worker IDs, which
+    are ``<session>.<n>`` for the ``n``th task, and makes the shard
+    directories for them.
+    """
+    def __init__(self):
+        self.id = random_string(12)
+        self.dir = local_filename(self.id)
+        self.log_dir = os.path.join(self.dir, 'logs')
+        os.makedirs(self.log_dir)
+        with open(os.path.join(self.dir, SESSION_FILE), 'w') as f:
+            f.write('%s %i\n' % (socket.gethostname(), os.getpid()))
+        self.touched = time.time()
+
+        self.lock = threading.Lock()
+        self.next = 0
+        self.shards = set()  # Shard directories that exist.
+
+    def filename(self, name):
+        return os.path.join(self.dir, name)
+
+    def new_workerids(self, count=1):
+        """Allocate worker IDs for ``count`` consecutive tasks."""
+        with self.lock:
+            start = self.next
+            self.next += count
+            shards = set(range(start // SHARD_SIZE,
+                               (start + count - 1) // SHARD_SIZE + 1))
+            new_shards = shards - self.shards
+            self.shards |= shards
+        for shard in new_shards:
+            os.makedirs(os.path.join(self.dir, str(shard)), exist_ok=True)
+        self.touch()
+        return ['%s.%i' % (self.id, n) for n in range(start, start + count)]
+
+    def new_workerid(self):
+        return self.new_workerids()[0]
+
+    def touch(self):
+        """Note that the session is still in use, at most once every
+        ``TOUCH_INTERVAL`` seconds.
+        """
+        now = time.time()
+        if now - self.touched < TOUCH_INTERVAL:
+            return
+        self.touched = now
+        try:
+            os.utime(os.path.join(self.dir, SESSION_FILE))
+        except FileNotFoundError:
+            pass  # Removed while we weren't looking.
+
+    def remove(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+def _owner_alive(marker):
+    """Whether the process named in a session's SESSION_FILE is running
+    on this host.
+    """
+    try:
+        with open(marker) as f:
+            host, pid = f.read().split()
+        pid = int(pid)
+    except (OSError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # Someone else's process.
+    return True
+
+def collect(max_age=MAX_AGE):
+    """Remove the sessions under ``CFUT_DIR`` that haven't been used for
+    ``max_age`` seconds and whose processes aren't running here, along
+    with files that older versions left in ``CFUT_DIR`` itself. Anything
+    else there, such as a result cache, is left alone. Returns the paths
+    removed.
+    """
+    root = local_filename()
+    now = time.time()
+    removed = []
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return removed
+    for name in names:
+        path = os.path.join(root, name)
+        marker = os.path.join(path, SESSION_FILE)
+        if os.path.isfile(marker):
+            stamp = marker
+        elif any(fnmatch(name, pattern) for pattern in LEFTOVER_PATTERNS):
+            stamp = path
+        else:
+            continue
+        try:
+            age = now - os.stat(stamp).st_mtime
+        except FileNotFoundError:
+            continue
+        if age < max_age or (stamp == marker and _owner_alive(marker)):
+            continue
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except OSError:
+            continue
+        removed.append(path)
+    return removed
+
+_collected = set()  # The directories collected in this process.
+_collected_lock = threading.Lock()
+
+def collect_in_background(max_age=MAX_AGE):
+    """Run ``collect`` in a background thread, unless it has already run
+    on this ``CFUT_DIR`` in this process.
+    """
+    root = os.path.abspath(local_filename())
+    with _collected_lock:
+        if root in _collected:
+            return
+        _collected.add(root)
+    threading.Thread(target=collect, args=(max_age,), daemon=True,
+                     name='cfut-collect').start()
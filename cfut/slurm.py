@@ -1,25 +1,50 @@
 """Abstracts access to a Slurm cluster via its command-line tools.
 """
+import math
 import os
+import re
 from subprocess import run, PIPE
-from .util import chcall, random_string, local_filename, shlex_join
+import threading
+import time
+from .util import achcall, chcall, random_string, local_filename, shlex_join
 
 LOG_FILE = local_filename("slurmpy.log")
 OUTFILE_FMT = local_filename("slurmpy.stdout.{}.log")
 
+def _write_script(job):
+    filename = local_filename('_temp_{}.sh'.format(random_string()))
+    with open(filename, 'w') as f:
+        f.write(job)
+    return filename
+
+def _job_id(out):
+    """Find the job ID in the output of ``sbatch --parsable``."""
+    return int(out.split(b";")[0])
+
 def submit_text(job):
     """Submits a Slurm job represented as a job file string. Returns
     the job ID.
     """
-    filename = local_filename('_temp_{}.sh'.format(random_string()))
-    with open(filename, 'w') as f:
-        f.write(job)
+    filename = _write_script(job)
     jobid, _ = chcall('sbatch --parsable {}'.format(filename))
     os.unlink(filename)
-    return int(jobid.split(b";")[0])
+    return _job_id(jobid)
 
-def submit(cmdline, outpat=OUTFILE_FMT.format('%j'), additional_setup_lines=[]):
-    """Starts a Slurm job that runs the specified shell command line.
+async def asubmit_text(job):
+    """Like ``submit_text``, but runs sbatch without blocking the event
+    loop.
+    """
+    filename = _write_script(job)
+    try:
+        jobid, _ = await achcall(['sbatch', '--parsable', filename])
+    finally:
+        os.unlink(filename)
+    return _job_id(jobid)
+
+def job_script(cmdline, outpat=OUTFILE_FMT.format('%j'),
+               additional_setup_lines=[]):
+    """Make the text of a job script that runs the specified command
+    line.
     """
     script_lines = [
         "#!/bin/sh",
@@ -27,28 +52,213 @@ def submit(cmdline, outpat=OUTFILE_FMT.format('%j'), additional_setup_lines=[]):
         *additional_setup_lines,
         shlex_join(['srun', *cmdline]),
     ]
-    return submit_text('\n'.join(script_lines))
+    return '\n'.join(script_lines)
+
+def submit(cmdline, outpat=OUTFILE_FMT.format('%j'), additional_setup_lines=[]):
+    """Starts a Slurm job that runs the specified shell command line.
+    """
+    return submit_text(job_script(cmdline, outpat, additional_setup_lines))
+
+async def asubmit(cmdline, outpat=OUTFILE_FMT.format('%j'),
+                  additional_setup_lines=[]):
+    """Like ``submit``, for use in asyncio code."""
+    return await asubmit_text(
+        job_script(cmdline, outpat, additional_setup_lines)
+    )
+
+def submit_array(cmdline, count, throttle=None,
+                 outpat=OUTFILE_FMT.format('%A_%a'), additional_setup_lines=[]):
+    """Starts a Slurm job array of ``count`` tasks, each running the
+    specified shell command line. If ``throttle`` is given, at most that
+    many tasks run at once. Returns the job ID of the array; its tasks
+    have the IDs ``<jobid>_0`` to ``<jobid>_<count-1>``.
+    """
+    spec = '0-{}'.format(count - 1)
+    if throttle:
+        spec += '%{}'.format(throttle)
+    return submit(cmdline, outpat, [
+        "#SBATCH --array={}".format(spec),
+        *additional_setup_lines,
+    ])
+
+def resource_lines(mem=None, time=None, cpus=None):
+    """Make ``#SBATCH`` lines asking for ``mem`` bytes of memory, ``time``
+    seconds and ``cpus`` CPUs per task, leaving out those not given.
+    """
+    lines = []
+    if mem:
+        lines.append("#SBATCH --mem={}M".format(math.ceil(mem / 2**20)))
+    if time:
+        lines.append("#SBATCH --time={}".format(math.ceil(time / 60)))
+    if cpus:
+        lines.append("#SBATCH --cpus-per-task={}".format(cpus))
+    return lines
+
+MEM_UNITS = {'': 2**20, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+def requested_memory(setup_lines):
+    """Find the memory, in bytes, that a job script's ``#SBATCH --mem``
+    option asks for. The last one wins, as with sbatch. Returns None if
+    there isn't one.
+    """
+    mem = None
+    for line in setup_lines:
+        match = re.match(r'#SBATCH\s+--mem[= ](\d+)([KMGT]?)B?\s*$',
+                         line.strip(), re.IGNORECASE)
+        if match:
+            mem = int(match.group(1)) * MEM_UNITS[match.group(2).upper()]
+    return mem
 
 STATES_FINISHED = {  # https://slurm.schedmd.com/squeue.html#lbAG
     'BOOT_FAIL',  'CANCELLED', 'COMPLETED',  'DEADLINE', 'FAILED',
     'NODE_FAIL', 'OUT_OF_MEMORY', 'PREEMPTED', 'SPECIAL_EXIT', 'TIMEOUT',
 }
 
-def jobs_finished(job_ids):
-    """Check which ones of the given Slurm jobs already finished
-    """
+# The state of a job that is in neither squeue nor sacct (because job
+# accounting is disabled, for instance). It is treated as finished.
+UNKNOWN = 'UNKNOWN'
 
-    # If there is no Slurm job to check, return right away
-    if not job_ids:
-        return set()
+# How many job IDs to pass to one sacct command.
+SACCT_CHUNK = 500
 
+def _parse_states(out, sep):
+    """Parse lines of job IDs and states, skipping job steps."""
+    states = {}
+    for line in out.splitlines():
+        jobid, _, state = line.strip().partition(sep)
+        if jobid and '.' not in jobid:
+            # sacct says things like "CANCELLED by 1234".
+            states[jobid] = state.split(' ')[0]
+    return states
+
+def queue_states():
+    """Get the states of all the current user's jobs in the queue."""
+    # --array lists each task of a job array on its own line, with IDs
+    # like 1234_5.
     res = run([
-        'squeue', '--noheader', '--format=%i %T',
-        '--jobs', ','.join([str(j) for j in job_ids]), '--states=all',
+        'squeue', '--noheader', '--array', '--format=%i %T', '--me',
+        '--states=all',
     ], stdout=PIPE, stderr=PIPE, encoding='utf-8', check=True)
-    id_to_state = dict([
-        l.strip().partition(' ')[::2] for l in res.stdout.splitlines()
-    ])
-    # Finished jobs only stay in squeue for a few mins (configurable). If
-    # a job ID isn't there, we'll assume it's finished.
-    return {j for j in job_ids if id_to_state.get(j, 'COMPLETED') in STATES_FINISHED}
+    return _parse_states(res.stdout, ' ')
+
+def accounting_states(job_ids):
+    """Get the states of the given jobs from the accounting database.
+    Jobs it doesn't know about are left out.
+    """
+    states = {}
+    for i in range(0, len(job_ids), SACCT_CHUNK):
+        res = run([
+            'sacct', '--noheader', '--parsable2', '--format=JobID,State',
+            '--jobs', ','.join(job_ids[i:i + SACCT_CHUNK]),
+        ], stdout=PIPE, stderr=PIPE, encoding='utf-8')
+        if res.returncode != 0:
+            break  # Accounting isn't available.
+        states.update(_parse_states(res.stdout, '|'))
+    return states
+
+class StateCache:
+    """The states of this user's Slurm jobs, shared by everything in the
+    process that wants them. One squeue command lists all the user's
+    jobs, and is only run again once the cached listing is
+    ``interval`` seconds old. The interval drops to ``min_interval``
+    while jobs are finishing and doubles up to ``max_interval`` while
+    they aren't. Jobs that have left the queue are looked up with sacct,
+    once each, to learn how they ended.
+
+    A job is only taken to have left the queue if it is missing from a
+    listing made after it was first asked about, so that a job submitted
+    since the last listing isn't mistaken for one that has finished.
+    What is known about a job is dropped once it is reported finished,
+    or once nobody has asked about it since the previous listing.
+    """
+    min_interval = 5
+    max_interval = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queued = {}  # The latest squeue listing.
+        self.final = {}  # States of jobs that have left the queue.
+        self.listings = 0  # How many listings have been made.
+        self.first_asked = {}  # Maps job IDs to the listing count then.
+        self.asked = set()  # Job IDs asked about since the last listing.
+        self.updated = None
+        self.interval = self.min_interval
+
+    def _refresh(self):
+        # If squeue fails, don't try again until the interval is up.
+        self.updated = time.monotonic()
+        before = self.queued
+        self.queued = queue_states()
+        self.listings += 1
+
+        for jobid in set(self.first_asked) - self.asked:
+            del self.first_asked[jobid]
+        for jobid in set(self.final) - self.asked:
+            del self.final[jobid]
+        self.asked = set()
+
+        finishing = any(
+            state in STATES_FINISHED and before.get(jobid) != state
+            for jobid, state in self.queued.items()
+        ) or any(jobid not in self.queued for jobid in before)
+        if finishing:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+
+    def states(self, job_ids):
+        """Return a dict mapping each of the given job IDs to its state."""
+        ids = {str(j): j for j in job_ids}
+        with self.lock:
+            for s in ids:
+                self.first_asked.setdefault(s, self.listings)
+            self.asked.update(ids)
+            if self.updated is None or \
+                    time.monotonic() - self.updated >= self.interval:
+                self._refresh()
+
+            states = {s: self.queued.get(s) or self.final.get(s)
+                      for s in ids}
+            missing = [s for s, state in states.items() if state is None]
+            gone = [s for s in missing
+                    if self.first_asked[s] < self.listings]
+            if len(gone) < len(missing):
+                # New jobs: look again soon, to see whether they're queued.
+                self.interval = self.min_interval
+            if gone:
+                found = accounting_states(gone)
+                for jobid in gone:
+                    state = states[jobid] = found.get(jobid, UNKNOWN)
+                    # Only remember states that won't change. UNKNOWN
+                    # might just mean sacct hasn't heard of the job yet.
+                    if state in STATES_FINISHED:
+                        self.final[jobid] = state
+                        del self.first_asked[jobid]
+
+            return {j: states[s] for s, j in ids.items()}
+
+    def forget(self, job_ids):
+        """Drop what is known about jobs nobody will ask about again."""
+        with self.lock:
+            for jobid in job_ids:
+                self.first_asked.pop(str(jobid), None)
+                self.final.pop(str(jobid), None)
+                self.asked.discard(str(jobid))
+
+STATE_CACHE = StateCache()
+
+def job_states(job_ids):
+    """Get the states of the given Slurm jobs, from the shared cache."""
+    if not job_ids:
+        return {}
+    return STATE_CACHE.states(job_ids)
+
+def jobs_finished(job_ids):
+    """Check which ones of the given Slurm jobs already finished. Returns
+    a dict mapping the IDs of the finished jobs to their final states.
+    """
+    finished = {j: state for j, state in job_states(job_ids).items()
+                if state in STATES_FINISHED or state == UNKNOWN}
+    # Whoever asked stops waiting for these jobs now.
+    STATE_CACHE.forget(finished)
+    return finished
@@ -1,14 +1,43 @@
+import asyncio
 import os
 import random
 import shlex
 import string
 import subprocess
+import threading
+import time
 
 def local_filename(filename=""):
     return os.path.join(os.getenv("CFUT_DIR", ".cfut"), filename)
 
-INFILE_FMT = local_filename('cfut.in.%s.pickle')
-OUTFILE_FMT = local_filename('cfut.out.%s.pickle')
+# Tasks' files are split between subdirectories of their session's
+# directory, with this many tasks in each (see ``cfut.session``).
+SHARD_SIZE = 1000
+
+def task_path(workerid, suffix):
+    """The path of one of a task's files. A worker ID is
+    ``<session>.<n>`` for the ``n``th task in a session.
+    """
+    session, n = workerid.rsplit('.', 1)
+    return os.path.join(local_filename(session), str(int(n) // SHARD_SIZE),
+                        '%s.%s' % (n, suffix))
+
+def input_path(workerid):
+    return task_path(workerid, 'in.pickle')
+
+def output_path(workerid):
+    return task_path(workerid, 'out.pickle')
+
+def array_workerid(arrayid, index):
+    """The worker ID of a task in an array, given the ID of the array's
+    first task.
+    """
+    session, start = arrayid.rsplit('.', 1)
+    return '%s.%i' % (session, int(start) + int(index))
+
+# Placeholder in a worker ID that the worker replaces with its index in a
+# Slurm job array. Array tasks are started as ``<arrayid>+<index>``.
+ARRAY_TASK_ID = '%a'
 
 def random_string(length=32, chars=(string.ascii_letters + string.digits)):
     return ''.join(random.choice(chars) for i in range(length))
@@ -43,6 +72,45 @@ def chcall(command, stdin=None):
         raise CommandError(command, code, stderr)
     return stdout, stderr
 
+async def achcall(args, stdin=None):
+    """Like ``chcall`` for use in asyncio code: runs the command (given
+    as a list of arguments, not through the shell) without blocking the
+    event loop.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    stdout, stderr = await proc.communicate(stdin)
+    if proc.returncode != 0:
+        raise CommandError(shlex_join(args), proc.returncode, stderr)
+    return stdout, stderr
+
+class RateLimiter:
+    """Spaces out events so that there are at most ``rate`` per second
+    on average, allowing bursts of up to ``burst`` at once.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Block until another event is allowed."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Take a token even if there isn't one yet, so that callers
+            # waiting at the same time queue up behind each other.
+            self.tokens -= 1
+            delay = -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
 
 # This is part of the shlex module from Python 3.8. This is copied from 3.10:
 def shlex_join(split_command):
@@ -0,0 +1,220 @@
+"""Ways of finding out which of a set of files have been created.
+
+The wait threads ask a watcher which of the files they are waiting on
+exist, once per polling interval. ``stat`` checks each file separately,
+which costs one metadata request per outstanding job. ``scan`` lists each
+directory once instead, and ``inotify`` asks the (Linux) kernel to report
+new files so that no directory needs to be listed at all.
+"""
+import ctypes
+import ctypes.util
+import errno
+import os
+import struct
+import sys
+
+class StatWatcher:
+    """Checks whether each file exists individually."""
+    def found(self, filenames):
+        """Return the subset of ``filenames`` that exist."""
+        return {f for f in filenames if os.path.exists(f)}
+
+    def close(self):
+        pass
+
+def _by_directory(filenames):
+    dirs = {}
+    for filename in filenames:
+        dirname, basename = os.path.split(filename)
+        dirs.setdefault(dirname, {})[basename] = filename
+    return dirs
+
+def scan_directory(dirname):
+    """List the names in a directory as a set. A missing directory is
+    treated as empty.
+    """
+    try:
+        with os.scandir(dirname or '.') as it:
+            return {entry.name for entry in it}
+    except FileNotFoundError:
+        return set()
+
+class ScanWatcher:
+    """Lists each directory that contains waited-upon files once per
+    check, so the cost depends on the number of directory entries
+    rather than on the number of outstanding files.
+    """
+    def found(self, filenames):
+        found = set()
+        for dirname, names in _by_directory(filenames).items():
+            present = scan_directory(dirname)
+            found.update(path for name, path in names.items()
+                         if name in present)
+        return found
+
+    def close(self):
+        pass
+
+# Constants from <sys/inotify.h>.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')
+
+# Filesystems on which inotify does not see files created by other hosts.
+NETWORK_FILESYSTEMS = {
+    'nfs', 'nfs4', 'lustre', 'gpfs', 'cifs', 'smb3', 'smbfs', 'beegfs',
+    'ceph', 'cephfs', 'glusterfs', 'fuse.glusterfs', 'fuse.sshfs', 'panfs',
+    'afs', 'ocfs2', '9p', 'fuse.ceph-fuse', 'wekafs',
+}
+
+def filesystem_type(path):
+    """Return the type of the filesystem containing ``path`` according to
+    /proc/self/mounts, or None if it can't be determined.
+    """
+    path = os.path.realpath(path)
+    best, best_type = '', None
+    try:
+        with open('/proc/self/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mountpoint = fields[1].replace('\\040', ' ')
+                if (path == mountpoint or
+                        path.startswith(mountpoint.rstrip('/') + '/')):
+                    if len(mountpoint) >= len(best):
+                        best, best_type = mountpoint, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None,
+                           use_errno=True)
+        libc.inotify_init1, libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+class InotifyWatcher(ScanWatcher):
+    """Uses Linux's inotify to learn about new files without listing
+    directories. Directories on network filesystems, where inotify can't
+    see files written by other hosts, are scanned instead, as is
+    everything if inotify isn't available.
+    """
+    def __init__(self):
+        self.libc = _load_libc()
+        self.fd = None
+        if self.libc is not None:
+            fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0:
+                self.fd = fd
+        self.watches = {}  # Watch descriptor -> directory.
+        self.watched = set()  # Directories watched with inotify.
+        self.scanned = set()  # Directories we have to scan.
+        self.known = set()  # Filenames we have looked for before.
+        self.created = {}  # Directory -> names created since last check.
+
+    def _watch(self, dirname):
+        """Start watching a directory. Returns False if it must be
+        scanned instead.
+        """
+        if self.fd is None or filesystem_type(dirname or '.') in \
+                NETWORK_FILESYSTEMS:
+            return False
+        wd = self.libc.inotify_add_watch(
+            self.fd, os.fsencode(dirname or '.'),
+            IN_CREATE | IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            return False
+        self.watches[wd] = dirname
+        return True
+
+    def _read_events(self):
+        """Collect the names created in watched directories. Returns
+        False if the kernel's event queue overflowed, in which case some
+        events were lost.
+        """
+        ok = True
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return ok
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pos = 0
+            while pos < len(data):
+                wd, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    ok = False
+                elif wd in self.watches:
+                    self.created.setdefault(self.watches[wd], set()).add(
+                        os.fsdecode(name)
+                    )
+
+    def found(self, filenames):
+        found = set()
+        fresh = []
+        for dirname, names in _by_directory(filenames).items():
+            if dirname not in self.watched and dirname not in self.scanned:
+                if self._watch(dirname):
+                    self.watched.add(dirname)
+                else:
+                    self.scanned.add(dirname)
+            if dirname in self.scanned:
+                found |= ScanWatcher.found(self, names.values())
+            else:
+                fresh.extend(path for path in names.values()
+                             if path not in self.known)
+
+        if self.watched and not self._read_events():
+            # Lost events: fall back to scanning everything once.
+            self.created.clear()
+            watched = [f for f in filenames
+                       if os.path.dirname(f) in self.watched]
+            found |= ScanWatcher.found(self, watched)
+        else:
+            for filename in filenames:
+                dirname, basename = os.path.split(filename)
+                if basename in self.created.get(dirname, ()):
+                    found.add(filename)
+            # Files we haven't looked for before may have been created
+            # before we were told about them.
+            found |= StatWatcher.found(self, fresh)
+        self.created.clear()
+
+        self.known = set(filenames) - found
+        return found
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+WATCHERS = {
+    'stat': StatWatcher,
+    'scan': ScanWatcher,
+    'inotify': InotifyWatcher,
+}
+
+def make_watcher(name):
+    """Create a watcher by name: ``stat``, ``scan`` or ``inotify``."""
+    try:
+        return WATCHERS[name]()
+    except KeyError:
+        raise ValueError("unknown watcher %r (expected one of %s)"
+                         % (name, ', '.join(sorted(WATCHERS))))
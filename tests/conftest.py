@@ -0,0 +1,8 @@
+import pytest
+
+@pytest.fixture(autouse=True)
+def cfut_dir(tmp_path_factory, monkeypatch):
+    """Keep each test's sessions out of the working directory."""
+    path = tmp_path_factory.mktemp('cfut')
+    monkeypatch.setenv('CFUT_DIR', str(path))
+    return path
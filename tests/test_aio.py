@@ -0,0 +1,119 @@
+import asyncio
+import os
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import slurm
+from cfut.aio import AsyncSlurmExecutor
+from cfut.cache import ResultCache
+from .test_slurm import SBATCH_SAVE_SCRIPTS, no_jobs_finished, square
+from .utils import run_all_outstanding_work
+
+# Several sbatch processes run at once, so use their process IDs (which are
+# unique among running processes) as job IDs.
+SBATCH_PID = """
+import os
+print(os.getpid())
+"""
+
+def test_asubmit():
+    async def main():
+        async with AsyncSlurmExecutor(keep_logs=True) as executor:
+            executor.wait_thread.interval = 0.05
+            futs = await asyncio.gather(*(
+                executor.asubmit(square, n) for n in range(4)
+            ))
+            assert len(executor.jobs) == 4
+            assert not any(fut.done() for fut in futs)
+
+            run_all_outstanding_work()
+            return await asyncio.wait_for(asyncio.gather(*futs), 5)
+
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            MockCommand('sbatch', python=SBATCH_PID) as sbatch:
+        assert asyncio.run(main()) == [0, 1, 4, 9]
+    assert len(sbatch.get_calls()) == 4
+
+def test_log_path(tmp_path):
+    async def main():
+        async with AsyncSlurmExecutor(keep_logs=True) as executor:
+            executor.wait_thread.interval = 0.05
+            fut = await executor.asubmit(square, 2)
+            run_all_outstanding_work()
+            assert await asyncio.wait_for(fut, 5) == 4
+            return executor.outfile_fmt.format('%j')
+
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPTS': str(tmp_path)}), \
+            MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS):
+        outpat = asyncio.run(main())
+    # Logs go in the session, where the sync executor puts them.
+    lines = (tmp_path / '0').read_text().splitlines()
+    assert '#SBATCH --output={}'.format(outpat) in lines
+
+def test_amap():
+    async def main():
+        async with AsyncSlurmExecutor(keep_logs=True) as executor:
+            executor.wait_thread.interval = 0.05
+            results = asyncio.ensure_future(executor.amap(square, range(3)))
+            while len(executor.jobs) < 3:
+                await asyncio.sleep(0.01)
+            run_all_outstanding_work()
+            return await asyncio.wait_for(results, 5)
+
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            MockCommand('sbatch', python=SBATCH_PID):
+        assert asyncio.run(main()) == [0, 1, 4]
+
+def test_retry():
+    preempt = set()
+    def finished(job_ids):
+        gone = {j: 'PREEMPTED' for j in job_ids if j in preempt}
+        preempt.difference_update(gone)
+        return gone
+
+    async def main():
+        async with AsyncSlurmExecutor(
+            keep_logs=True, retry=cfut.RetryPolicy(backoff=0)
+        ) as executor:
+            executor.wait_thread.interval = 0.05
+            fut = await executor.asubmit(square, 3)
+            first, = executor.jobs
+            preempt.add(first)
+
+            async def resubmitted():
+                while first in executor.jobs or not executor.jobs:
+                    await asyncio.sleep(0.01)
+            await asyncio.wait_for(resubmitted(), 5)
+
+            run_all_outstanding_work()
+            return await asyncio.wait_for(fut, 5)
+
+    with patch.object(slurm, 'jobs_finished', finished), \
+            MockCommand('sbatch', python=SBATCH_PID) as sbatch:
+        assert asyncio.run(main()) == 9
+    assert len(sbatch.get_calls()) == 2
+
+def test_shared_options(tmp_path):
+    async def main():
+        async with AsyncSlurmExecutor(
+            keep_logs=True, lazy_results=True, submit_rate=100,
+            cache=ResultCache(str(tmp_path))
+        ) as executor:
+            executor.wait_thread.interval = 0.05
+            first = await executor.asubmit(square, 2)
+            second = await executor.asubmit(square, first)
+            run_all_outstanding_work()
+            results = await asyncio.wait_for(asyncio.gather(first, second),
+                                             5)
+            # The first call's result was cached when it was read, so
+            # this one doesn't need a job.
+            again = await executor.asubmit(square, 2)
+            return results + [await asyncio.wait_for(again, 1)]
+
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            MockCommand('sbatch', python=SBATCH_PID) as sbatch:
+        assert asyncio.run(main()) == [4, 16, 4]
+    assert len(sbatch.get_calls()) == 2
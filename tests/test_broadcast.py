@@ -0,0 +1,62 @@
+import gc
+import glob
+
+from testpath import MockCommand
+
+import cfut
+from cfut.broadcast import blob_path
+from cfut.util import input_path
+from .test_condor import CONDOR_JOB_COUNT
+from .utils import run_all_outstanding_work
+
+def blob_files():
+    return glob.glob(blob_path('*.*'))
+
+def lookup(handle, key):
+    return handle.value[key]
+
+
+def test_put():
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True)
+    try:
+        table = {'a': 1, 'b': 2}
+        handle = executor.put(table)
+        assert handle.value is table
+        assert len(blob_files()) == 1
+
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT):
+            futs = [executor.submit(lookup, handle, k) for k in 'ab']
+        run_all_outstanding_work()
+        assert [f.result(timeout=3) for f in futs] == [1, 2]
+
+        # The file goes once no job or handle needs it.
+        assert len(blob_files()) == 1
+        del handle
+        gc.collect()
+        assert blob_files() == []
+    finally:
+        executor.shutdown(wait=False)
+
+def test_large_closure_stored_once():
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True,
+                                   broadcast_threshold=10000)
+    try:
+        big = list(range(10000))
+        def nth(i):
+            return big[i]
+
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT):
+            futs = [executor.submit(nth, i) for i in range(3)]
+        assert len(blob_files()) == 1
+        for (_, workerid) in executor.jobs.values():
+            with open(input_path(workerid), 'rb') as f:
+                assert len(f.read()) < 1000
+
+        run_all_outstanding_work()
+        assert [f.result(timeout=3) for f in futs] == [0, 1, 2]
+
+        del nth
+        gc.collect()
+        assert blob_files() == []
+    finally:
+        executor.shutdown(wait=False)
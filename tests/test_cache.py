@@ -0,0 +1,77 @@
+import os
+import time
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import slurm
+from cfut.cache import ResultCache
+from .test_slurm import SBATCH_JOB_COUNT, no_jobs_finished, square
+from .utils import run_all_outstanding_work, workers_running
+
+def test_cached_results(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True,
+                                cache=cache) as executor:
+            with MockCommand.fixed_output('sbatch', stdout='1') as sbatch:
+                fut = executor.submit(square, 3)
+            run_all_outstanding_work()
+            assert fut.result(timeout=3) == 9
+            assert len(sbatch.get_calls()) == 1
+
+        # Another executor finds the result without running a job.
+        with cfut.SlurmExecutor(True, keep_logs=True,
+                                cache=cache) as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                assert executor.submit(square, 3).result(timeout=0) == 9
+                assert not executor.submit(square, 4).done()
+                # Our own key.
+                assert not executor.submit(
+                    square, 3, cache_key='mine'
+                ).done()
+            assert len(sbatch.get_calls()) == 2
+            run_all_outstanding_work()
+
+    assert cache.hits == 1
+
+def test_cached_chunks(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'))
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        executor = cfut.SlurmExecutor(True, cache=cache)
+        executor.wait_thread.interval = 0.05
+        with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch, \
+                workers_running():
+            results = cfut.map(executor, square, range(4), chunksize=2)
+            assert list(results) == [0, 1, 4, 9]
+        assert len(sbatch.get_calls()) == 2
+
+        # Each call's result was cached on its own.
+        with cfut.SlurmExecutor(True, cache=cache) as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                results = executor.map(square, range(5), chunksize=2)
+            assert len(sbatch.get_calls()) == 1
+            run_all_outstanding_work()
+            assert list(results) == [0, 1, 4, 9, 16]
+
+def test_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / 'cache'), max_bytes=1)
+    for name in ('old', 'new'):
+        out = tmp_path / name
+        cfut.payload.dump(((True, 'value'), {}), str(out))
+        cache.add(name, str(out))
+    old_file = os.path.join(cache._entry('old'), 'result.pickle')
+    assert cache.get('old')[0] and cache.get('new') == (True, 'value')
+
+    # Using an entry makes it the most recently used.
+    os.utime(old_file, (time.time() - 60, time.time() - 60))
+    cache.max_bytes = os.path.getsize(out)
+    cache.evict()
+    assert cache.get('old') == (False, None)
+    assert cache.get('new') == (True, 'value')
+
+    cache.max_age = 0
+    time.sleep(0.01)
+    cache.evict()
+    assert cache.get('new') == (False, None)
@@ -1,6 +1,13 @@
+import os
+import time
+from unittest.mock import patch
+
+import pytest
 from testpath import MockCommand
 
 import cfut
+from cfut import condor
+from cfut.remote import worker
 from .utils import run_all_outstanding_work
 
 def square(n):
@@ -42,3 +49,173 @@ def test_map():
         assert list(result_iter) == [0, 1, 4, 9]
     finally:
         executor.shutdown(wait=False)
+
+LOG_EVENTS = """\
+000 (017.000.000) 2024-01-01 12:00:00 Job submitted from host: <10.0.0.1:9618>
+...
+001 (017.000.000) 2024-01-01 12:00:05 Job executing on host: <10.0.0.2:9618>
+...
+005 (017.000.000) 2024-01-01 12:00:10 Job terminated.
+\t(1) Normal termination (return value 0)
+\t\tUsr 0 00:00:00, Sys 0 00:00:00  -  Run Remote Usage
+...
+"""
+
+def test_log_reader_incremental(tmp_path):
+    log = tmp_path / 'condor.log'
+    reader = condor.LogReader(str(log))
+    assert reader.read() == []
+
+    # Write the log in pieces, splitting lines.
+    log.write_text(LOG_EVENTS[:20])
+    assert reader.read() == []
+    split = LOG_EVENTS.index('Job executing') + 4
+    with log.open('a') as f:
+        f.write(LOG_EVENTS[20:split])
+    assert reader.read() == [(0, 17, 0)]
+    assert reader.states[17, 0] == 'idle'
+
+    with log.open('a') as f:
+        f.write(LOG_EVENTS[split:])
+    assert reader.read() == [(1, 17, 0), (5, 17, 0)]
+    assert reader.finished(17)
+    assert reader.read() == []
+
+    # A rotated log is read from the start.
+    log.unlink()
+    log.write_text(LOG_EVENTS.replace('017.', '018.'))
+    assert [e[1] for e in reader.read()] == [18, 18, 18]
+
+def test_wait_thread(tmp_path):
+    log = tmp_path / 'condor.log'
+    finished = []
+    thread = condor.WaitThread(finished.append, log=str(log), interval=0.01)
+    thread.start()
+    try:
+        thread.wait(17)
+        log.write_text(LOG_EVENTS)
+        for _ in range(300):
+            if finished:
+                break
+            time.sleep(0.01)
+        assert finished == [17]
+
+        # Waiting on a job that has already finished.
+        thread.wait(17)
+        for _ in range(300):
+            if len(finished) == 2:
+                break
+            time.sleep(0.01)
+        assert finished == [17, 17]
+    finally:
+        thread.stop()
+        thread.join()
+
+CONDOR_SAVE_DESCRIPTION = """
+import os, sys
+with open(os.environ['SAVED_DESCRIPTION'], 'w') as f:
+    f.write(sys.stdin.read())
+print("** Proc 5.0:")
+"""
+
+def test_map_array(tmp_path):
+    saved = tmp_path / 'description'
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True)
+    try:
+        with patch.dict(os.environ, {'SAVED_DESCRIPTION': str(saved)}), \
+                MockCommand('condor_submit',
+                            python=CONDOR_SAVE_DESCRIPTION) as csub:
+            result_iter = executor.map_array(square, range(3), timeout=5,
+                                             throttle=2)
+        assert len(csub.get_calls()) == 1
+        description = saved.read_text()
+        assert 'Queue 3' in description
+        assert 'max_materialize = 2' in description
+        assert '+$(Process)' in description
+        assert sorted(executor.jobs) == ['5.0', '5.1', '5.2']
+
+        run_all_outstanding_work()
+        assert list(result_iter) == [0, 1, 4]
+    finally:
+        executor.shutdown(wait=False)
+
+def test_wait_thread_procs(tmp_path):
+    log = tmp_path / 'condor.log'
+    finished = []
+    thread = condor.WaitThread(finished.append, log=str(log), interval=0.01)
+    thread.start()
+    try:
+        thread.wait('17.1')
+        thread.wait('17.0')
+        log.write_text(LOG_EVENTS.replace('017.000.', '017.001.'))
+        for _ in range(300):
+            if finished:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        assert finished == ['17.1']
+    finally:
+        thread.stop()
+        thread.join()
+
+HELD_EVENT = """\
+012 (000.000.000) 2024-01-01 12:00:05 Job was held.
+\tOut of memory
+...
+"""
+
+def test_held():
+    policy = cfut.RetryPolicy(max_attempts=1, states=['held'])
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True, retry=policy)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT), \
+                MockCommand('condor_rm') as crm:
+            fut = executor.submit(square, 2)
+            with open(executor.logfile, 'a') as f:
+                f.write(HELD_EVENT)
+            with pytest.raises(cfut.JobDied) as excinfo:
+                fut.result(timeout=5)
+        assert excinfo.value.state == 'held'
+        crm.assert_called(['0'])
+    finally:
+        executor.shutdown(wait=False)
+
+def test_held_without_retry():
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT), \
+                MockCommand('condor_rm') as crm:
+            fut = executor.submit(square, 2)
+            with open(executor.logfile, 'a') as f:
+                f.write(HELD_EVENT)
+            executor.wait_thread.check(0)
+            # The job might be released, so it is still waited for.
+            assert not fut.done()
+            assert crm.get_calls() == []
+
+            worker(fut.workerid)
+            assert fut.result(timeout=3) == 4
+    finally:
+        executor.shutdown(wait=False)
+
+def test_dependency():
+    executor = cfut.CondorExecutor(keep_logs=True)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT) as csub:
+            first = executor.submit(square, 2)
+            second = executor.submit(square, first)
+            # Condor has no dependencies, so the second job waits for
+            # the first one's result before it is submitted.
+            assert len(csub.get_calls()) == 1
+            worker(first.workerid)
+            assert first.result(timeout=3) == 4
+            for _ in range(300):
+                if second.jobid is not None:
+                    break
+                time.sleep(0.01)
+            assert len(csub.get_calls()) == 2
+
+        worker(second.workerid)
+        assert second.result(timeout=3) == 16
+    finally:
+        executor.shutdown(wait=False)
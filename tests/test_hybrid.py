@@ -0,0 +1,73 @@
+import os
+from unittest.mock import patch
+
+import pytest
+from testpath import MockCommand
+
+import cfut
+from cfut import slurm
+from cfut.hybrid import HybridExecutor, function_key
+from .test_slurm import SBATCH_JOB_COUNT, no_jobs_finished, square
+from .utils import run_all_outstanding_work
+
+def pid(n):
+    return os.getpid()
+
+def fail():
+    raise ValueError("oops")
+
+def make_executor():
+    cluster = cfut.SlurmExecutor(True, keep_logs=True)
+    return HybridExecutor(cluster, local_workers=2)
+
+def test_run_locally():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with make_executor() as executor:
+            with MockCommand('sbatch') as sbatch:
+                fut = executor.submit(pid, 1, run_locally=True)
+                assert fut.result(timeout=10) != os.getpid()
+            assert sbatch.get_calls() == []
+
+            with pytest.raises(cfut.RemoteException):
+                executor.submit(fail, run_locally=True).result(timeout=10)
+
+def test_routing():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with make_executor() as executor:
+            with MockCommand.fixed_output('sbatch', stdout='1234') as sbatch:
+                # The first call finds out how long the function takes.
+                assert executor.submit(square, 3).result(timeout=10) == 9
+                assert executor.submit(square, 4).result(timeout=10) == 16
+                assert sbatch.get_calls() == []
+
+                # A slow function goes to the cluster.
+                executor.estimates[function_key(square)] = 100
+                fut = executor.submit(square, 5)
+                assert len(sbatch.get_calls()) == 1
+
+            run_all_outstanding_work()
+            assert fut.result(timeout=5) == 25
+
+    assert [d['where'] for d in executor.decisions] == \
+        ['local', 'local', 'cluster']
+    stats = executor.stats()[function_key(square)]
+    assert stats['local'] == 2 and stats['cluster'] == 1
+    assert stats['cluster_run_time'] is not None
+
+def test_untimed_calls_stay_local():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with make_executor() as executor:
+            with MockCommand('sbatch') as sbatch:
+                results = executor.map(square, range(50), timeout=30)
+                assert list(results) == [n * n for n in range(50)]
+            assert sbatch.get_calls() == []
+
+def test_duration_hint():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with make_executor() as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                results = executor.map(square, range(3), timeout=5,
+                                       duration=100)
+            assert len(sbatch.get_calls()) == 3
+            run_all_outstanding_work()
+            assert list(results) == [0, 1, 4]
@@ -0,0 +1,95 @@
+import os
+import pickle
+
+import pytest
+from testpath import MockCommand
+
+import cfut
+from cfut import payload
+from cfut.util import input_path
+from .test_condor import CONDOR_JOB_COUNT
+from .utils import run_all_outstanding_work
+
+needs_protocol_5 = pytest.mark.skipif(
+    not payload.PROTOCOL_5, reason="needs pickle protocol 5"
+)
+
+def repeat(s, n):
+    return s * n
+
+class Blob:
+    """A stand-in for an array type that supports out-of-band pickling."""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        if protocol >= 5:
+            return Blob, (pickle.PickleBuffer(self.data),)
+        return Blob, (bytes(self.data),)
+
+
+def test_round_trip(tmp_path):
+    filename = str(tmp_path / 'small.pickle')
+    payload.dump({'a': [1, 2, 3]}, filename)
+    assert payload.load(filename) == {'a': [1, 2, 3]}
+    assert not os.path.exists(filename + payload.BUFFERS_SUFFIX)
+
+@needs_protocol_5
+def test_out_of_band_buffers(tmp_path):
+    filename = str(tmp_path / 'big.pickle')
+    big = bytearray(os.urandom(payload.OUT_OF_BAND_THRESHOLD * 2))
+    small = bytearray(b'small')
+    payload.dump([Blob(big), Blob(small), Blob(big)], filename)
+
+    # The big buffers aren't copied into the pickle itself.
+    assert os.path.getsize(filename) < 1000
+    assert os.path.exists(filename + payload.BUFFERS_SUFFIX)
+
+    loaded = payload.load(filename)
+    assert [bytes(b.data) for b in loaded] == [big, small, big]
+    # Mapped from the file rather than read into memory.
+    view = loaded[0].data
+    assert isinstance(view, memoryview)
+    assert not view.readonly
+
+    payload.remove(filename)
+    assert os.listdir(str(tmp_path)) == []
+
+def test_compression(tmp_path):
+    filename = str(tmp_path / 'compressed.pickle')
+    codec = payload.Codec('zlib', threshold=100)
+    obj = ['spam'] * 1000
+    raw, stored = payload.dump(obj, filename, codec)
+    assert stored < raw / 10
+
+    loaded = payload.read(filename)
+    assert loaded.obj == obj
+    assert loaded.codec == codec
+    assert (loaded.raw_size, loaded.stored_size) == (raw, stored)
+
+    # Below the threshold, the pickle is stored as it is, but the header
+    # still names the codec.
+    raw, stored = payload.dump('spam', filename, codec)
+    assert stored > raw
+    assert payload.read(filename).codec == codec
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        payload.Codec('morse')
+
+def test_executor_compression():
+    executor = cfut.CondorExecutor(debug=True, keep_logs=True, codec='zlib',
+                                   compress_threshold=0)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT):
+            fut = executor.submit(repeat, 'spam', 1000)
+        (_, workerid), = executor.jobs.values()
+        assert payload.read(input_path(workerid)).codec.name == 'zlib'
+
+        run_all_outstanding_work()
+        assert fut.result(timeout=3) == 'spam' * 1000
+        sizes = fut.payload_bytes
+        assert sizes['out_stored'] < sizes['out_raw'] / 10
+        assert executor.payload_totals['out_raw'] == sizes['out_raw']
+    finally:
+        executor.shutdown(wait=False)
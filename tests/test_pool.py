@@ -0,0 +1,102 @@
+import os
+import threading
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import pool
+from .test_condor import CONDOR_JOB_COUNT
+
+def square(n):
+    return n * n
+
+
+def test_pilot_runs_tasks():
+    executor = cfut.CondorPoolExecutor(debug=True, keep_logs=True, pilots=2)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT) as csub:
+            futs = [executor.submit(square, n) for n in range(3)]
+        assert len(csub.get_calls()) == 2  # One per pilot.
+
+        assert executor.queue.pending() == 3
+        pool.pilot(executor.poolid, 'p1', idle_timeout=0.2)
+        assert [f.result(timeout=3) for f in futs] == [0, 1, 4]
+    finally:
+        executor.shutdown(wait=False)
+
+def test_map_array():
+    executor = cfut.CondorPoolExecutor(keep_logs=True, pilots=4)
+    try:
+        with MockCommand('condor_submit', python=CONDOR_JOB_COUNT) as csub:
+            results = executor.map_array(square, range(20), timeout=5)
+        # As many pilots as for 20 separate tasks.
+        assert len(csub.get_calls()) == 4
+
+        pool.pilot(executor.poolid, 'p1', idle_timeout=0.2)
+        assert list(results) == [n * n for n in range(20)]
+    finally:
+        executor.shutdown(wait=False)
+
+def test_pilot_died():
+    executor = cfut.CondorPoolExecutor(debug=True, keep_logs=True, pilots=1)
+    try:
+        with MockCommand.fixed_output('condor_submit', stdout='Proc 7.0'):
+            fut = executor.submit(square, 2)
+        pilotid, = executor.pilots.values()
+
+        # The pilot claims the task, then vanishes without running it.
+        executor.queue.add_pilot(pilotid)
+        assert executor.queue.claim(pilotid) is not None
+        open(executor.queue.done_file(pilotid), 'w').close()
+
+        try:
+            fut.result(timeout=3)
+        except cfut.JobDied:
+            pass
+        else:
+            assert False, "expected JobDied"
+    finally:
+        executor.shutdown(wait=False)
+
+def test_shutdown_waits_for_pilots():
+    executor = cfut.CondorPoolExecutor(pilots=1)
+    executor.pilot_wait_thread.interval = 0.05
+    with MockCommand('condor_submit', python=CONDOR_JOB_COUNT):
+        fut = executor.submit(square, 3)
+    pilotid, = executor.pilots.values()
+    pilot = threading.Thread(target=pool.pilot,
+                             args=(executor.poolid, pilotid, 60))
+    pilot.start()
+    assert fut.result(timeout=3) == 9
+
+    # The pilot would idle for a minute, but stops when told to.
+    executor.shutdown()
+    pilot.join(timeout=5)
+    assert not pilot.is_alive()
+    assert not os.path.exists(executor.session.dir)
+
+CONDOR_SAVE_DESCRIPTIONS = CONDOR_JOB_COUNT + """
+import os, sys
+with open(os.environ['SAVED_DESCRIPTIONS'], 'a') as f:
+    f.write(sys.stdin.read())
+"""
+
+def test_multicore_pilot(tmp_path):
+    saved = tmp_path / 'descriptions'
+    executor = cfut.CondorPoolExecutor(debug=True, keep_logs=True, pilots=4,
+                                       cores=2)
+    try:
+        with patch.dict(os.environ, {'SAVED_DESCRIPTIONS': str(saved)}), \
+                MockCommand('condor_submit',
+                            python=CONDOR_SAVE_DESCRIPTIONS) as csub:
+            futs = [executor.submit(square, n) for n in range(4)]
+        # Two pilots with two cores each are enough for four tasks.
+        assert len(csub.get_calls()) == 2
+        assert saved.read_text().count('request_cpus = 2') == 2
+
+        pool.pilot(executor.poolid, 'p1', idle_timeout=0.2, cores=2)
+        assert [f.result(timeout=3) for f in futs] == [0, 1, 4, 9]
+        assert executor.queue.claimed('p1') == []
+    finally:
+        executor.shutdown(wait=False)
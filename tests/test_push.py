@@ -0,0 +1,84 @@
+import glob
+import os
+import socket
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import push, slurm
+from cfut.remote import worker
+from cfut.session import Session
+from cfut.util import output_path
+from .test_payload import Blob, needs_protocol_5
+from .test_slurm import SBATCH_SAVE_SCRIPTS, no_jobs_finished, square
+
+def test_push(tmp_path):
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPTS': str(tmp_path)}):
+        with cfut.SlurmExecutor(True, push_results=True,
+                                push_host='127.0.0.1') as executor:
+            # Only the server can tell the executor about results.
+            watcher = executor.wait_thread.watcher
+            with patch.object(watcher, 'found', lambda filenames: set()):
+                with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS):
+                    fut = executor.submit(square, 3)
+                assert executor.result_address.startswith('127.0.0.1:')
+                assert executor.result_address in \
+                    (tmp_path / '0').read_text()
+
+                worker(fut.workerid, '!', executor.result_address)
+                assert fut.result(timeout=3) == 9
+
+def blobs(n):
+    return [Blob(bytearray(range(256)) * n), Blob(bytearray(b'small'))]
+
+@needs_protocol_5
+def test_large_result():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.object(push, 'PIECE_SIZE', 1000):
+        with cfut.SlurmExecutor(True, push_results=True,
+                                push_host='127.0.0.1') as executor:
+            watcher = executor.wait_thread.watcher
+            with patch.object(watcher, 'found', lambda filenames: set()):
+                with MockCommand.fixed_output('sbatch', stdout='1'):
+                    fut = executor.submit(blobs, 1024)
+                # The result's data is sent out of band, in many pieces.
+                worker(fut.workerid, '!', executor.result_address)
+                big, small = fut.result(timeout=3)
+                assert bytes(big.data) == bytes(range(256)) * 1024
+                assert bytes(small.data) == b'small'
+            assert not glob.glob(output_path(fut.workerid) + '*')
+
+def test_fallback():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, push_results=True,
+                                push_host='127.0.0.1') as executor:
+            with MockCommand.fixed_output('sbatch', stdout='1'):
+                fut = executor.submit(square, 3)
+
+            # Results with the wrong key aren't accepted.
+            with open(push.key_file(fut.workerid), 'wb') as f:
+                f.write(b'x' * push.KEY_SIZE)
+            assert not push.send(executor.result_address, fut.workerid,
+                                 b'junk')
+            assert not os.path.exists(output_path(fut.workerid))
+
+            # So the worker writes its output file instead.
+            worker(fut.workerid, '!', executor.result_address)
+            assert fut.result(timeout=3) == 9
+
+def test_quiet_worker():
+    results = []
+    session = Session()
+    server = push.ResultServer(session, results.append, '127.0.0.1')
+    try:
+        host, _, port = server.address.rpartition(':')
+        with patch.object(push._Handler, 'timeout', 0.1), \
+                socket.create_connection((host, int(port)), 3) as sock:
+            # A connection that never sends anything is dropped.
+            sock.settimeout(3)
+            assert sock.recv(1) == b''
+        assert not results
+    finally:
+        server.close()
@@ -0,0 +1,80 @@
+import os
+import time
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import slurm
+from cfut.resources import ResourceProfiles
+from .test_slurm import SBATCH_SAVE_SCRIPTS, square
+from .utils import run_all_outstanding_work
+
+def test_requests(tmp_path):
+    profiles = ResourceProfiles(str(tmp_path), min_runs=2)
+    key = profiles.key(square)
+    assert key == 'tests.test_slurm.square'
+
+    timing = {'worker_started': 0, 'worker_finished': 100,
+              'max_rss': 2**30, 'cpu_time': 190}
+    profiles.observe(key, timing)
+    assert profiles.requests(key) == {}
+    profiles.observe(key, dict(timing, max_rss=2**29))
+    assert profiles.requests(key) == {'mem': 1.5 * 2**30, 'time': 150,
+                                      'cpus': 2}
+    # Runs are only written out from time to time.
+    assert ResourceProfiles(str(tmp_path)).get(key)['runs'] == []
+    profiles.flush()
+    assert len(ResourceProfiles(str(tmp_path)).get(key)['runs']) == 2
+
+    assert profiles.out_of_memory(key, 4 * 2**30) == 8 * 2**30
+    # Another store sharing the directory sees the same profile.
+    assert ResourceProfiles(str(tmp_path)).requests(key)['mem'] == 8 * 2**30
+
+def test_right_sizing(tmp_path):
+    scripts = tmp_path / 'scripts'
+    scripts.mkdir()
+    profiles = ResourceProfiles(str(tmp_path / 'profiles'), min_runs=1)
+    oom = {}
+    def finished(job_ids):
+        return {j: oom.pop(j) for j in list(oom) if j in job_ids}
+
+    with patch.object(slurm, 'jobs_finished', finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPTS': str(scripts)}):
+        with cfut.SlurmExecutor(True, resources=profiles,
+                                additional_setup_lines=['#SBATCH --mem=8G']) \
+                as executor:
+            with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS):
+                fut = executor.submit(square, 3)
+                run_all_outstanding_work()
+                assert fut.result(timeout=3) == 9
+                used = fut.timing['max_rss']
+
+                # Now the job asks for what the first one used.
+                fut = executor.submit(square, 4)
+                oom[1] = 'OUT_OF_MEMORY'
+                for _ in range(300):
+                    if 2 in executor.jobs:
+                        break
+                    time.sleep(0.1)
+                run_all_outstanding_work()
+                assert fut.result(timeout=3) == 16
+                assert fut.attempts == 2
+
+    # The runs were written out when the executor shut down.
+    profile = ResourceProfiles(str(tmp_path / 'profiles')).get(
+        profiles.key(square)
+    )
+    assert len(profile['runs']) == 2
+
+    mem = slurm.requested_memory(
+        (scripts / '1').read_text().splitlines()
+    )
+    assert mem == slurm.requested_memory(
+        slurm.resource_lines(used * 1.5)
+    )
+    assert mem < 8 * 2**30
+    # The retry asked for twice as much.
+    assert slurm.requested_memory(
+        (scripts / '2').read_text().splitlines()
+    ) == 2 * mem
@@ -0,0 +1,67 @@
+import os
+import socket
+import subprocess
+import time
+from unittest.mock import patch
+
+from testpath import MockCommand
+
+import cfut
+from cfut import session, slurm
+from cfut.util import SHARD_SIZE, array_workerid, input_path, local_filename
+from .test_slurm import SBATCH_JOB_COUNT, no_jobs_finished, square
+from .utils import run_all_outstanding_work
+
+def test_shards(tmp_path):
+    with patch.dict(os.environ, {'CFUT_DIR': str(tmp_path)}):
+        s = session.Session()
+        first, = s.new_workerids()
+        rest = s.new_workerids(SHARD_SIZE)
+        assert rest[0] == array_workerid(first, 1)
+
+        dirs = {os.path.dirname(input_path(w)) for w in [first] + rest}
+        assert dirs == {os.path.join(s.dir, '0'), os.path.join(s.dir, '1')}
+        assert all(os.path.isdir(d) for d in dirs)
+
+def test_collect(tmp_path):
+    with patch.dict(os.environ, {'CFUT_DIR': str(tmp_path)}):
+        old, new = session.Session(), session.Session()
+        leftover = local_filename('cfut.in.abc.pickle')
+        open(leftover, 'w').close()
+        os.makedirs(local_filename('cache'))
+        alive = session.Session()
+        # The old session's process has gone away.
+        with open(old.filename(session.SESSION_FILE), 'w') as f:
+            f.write('%s %i\n' % (socket.gethostname(), dead_pid()))
+        day_ago = time.time() - 24 * 3600
+        for path in [old.filename(session.SESSION_FILE), leftover,
+                     alive.filename(session.SESSION_FILE)]:
+            os.utime(path, (day_ago, day_ago))
+
+        assert sorted(session.collect(3600)) == sorted([old.dir, leftover])
+        assert sorted(os.listdir(tmp_path)) == \
+            sorted(['cache', new.id, alive.id])
+
+def dead_pid():
+    proc = subprocess.Popen(['true'])
+    proc.wait()
+    return proc.pid
+
+def test_wait_thread_touches_session():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.object(session, 'TOUCH_INTERVAL', 0):
+        with cfut.SlurmExecutor(True) as executor:
+            marker = executor.session.filename(session.SESSION_FILE)
+            os.utime(marker, (0, 0))
+            time.sleep(2 * executor.wait_thread.interval)
+            assert os.stat(marker).st_mtime > 0
+
+def test_shutdown_removes_session():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True) as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT):
+                fut = executor.submit(square, 2)
+            run_all_outstanding_work()
+            assert fut.result(timeout=3) == 4
+            assert os.path.isdir(executor.session.dir)
+    assert not os.path.exists(executor.session.dir)
@@ -1,16 +1,27 @@
+import gc
+import glob
+import io
+import json
+import os
+import threading
+import time
+from concurrent import futures
 from unittest.mock import patch
 
+import pytest
 from testpath import MockCommand
 
 import cfut
-from cfut import slurm
-from .utils import run_all_outstanding_work
+from cfut import metrics, slurm
+from cfut.remote import worker
+from cfut.util import CommandError, RateLimiter, output_path
+from .utils import run_all_outstanding_work, workers_running
 
 def square(n):
     return n * n
 
 def no_jobs_finished(job_ids):
-    return set()
+    return {}
 
 def test_submit():
     with patch.object(slurm, 'jobs_finished', no_jobs_finished):
@@ -44,3 +55,450 @@ def test_map():
 
             run_all_outstanding_work()
             assert list(result_iter) == [0, 1, 4, 9]
+
+SBATCH_SAVE_SCRIPT = """
+import os, shutil, sys
+shutil.copy(sys.argv[-1], os.environ['SAVED_SCRIPT'])
+print(1234)
+"""
+
+def test_map_array(tmp_path):
+    saved_script = tmp_path / 'script.sh'
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPT': str(saved_script)}):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPT) as sbatch:
+                result_iter = executor.map_array(
+                    square, range(4), timeout=5, throttle=2
+                )
+            script = saved_script.read_text()
+            assert len(sbatch.get_calls()) == 1
+            assert '#SBATCH --array=0-3%2' in script
+            assert sorted(executor.jobs) == ['1234_%i' % i for i in range(4)]
+
+            run_all_outstanding_work()
+            assert list(result_iter) == [0, 1, 4, 9]
+
+def test_map_array_split(tmp_path):
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPTS': str(tmp_path)}):
+        with cfut.SlurmExecutor(True, max_array_size=2) as executor:
+            with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS) as sbatch:
+                result_iter = executor.map_array(
+                    square, range(5), timeout=5, throttle=1
+                )
+            assert len(sbatch.get_calls()) == 3
+            scripts = [(tmp_path / str(i)).read_text() for i in range(3)]
+            assert '#SBATCH --array=0-1%1' in scripts[0]
+            assert '--dependency' not in scripts[0]
+            assert '#SBATCH --array=0-1%1' in scripts[1]
+            assert '#SBATCH --dependency=afterany:0' in scripts[1]
+            assert '#SBATCH --array=0-0%1' in scripts[2]
+            assert '#SBATCH --dependency=afterany:1' in scripts[2]
+            assert sorted(executor.jobs) == ['0_0', '0_1', '1_0', '1_1', '2_0']
+
+            run_all_outstanding_work()
+            assert list(result_iter) == [0, 1, 4, 9, 16]
+
+def test_map_array_error():
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand('sbatch', python='import sys; sys.exit(1)'):
+            with pytest.raises(CommandError):
+                executor.map_array(square, range(3))
+        assert not glob.glob(
+            os.path.join(executor.session.dir, '*', '*.in.pickle')
+        )
+
+def test_array_worker_id():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            with MockCommand.fixed_output('sbatch', stdout='1234'):
+                result_iter = executor.map_array(square, [3], timeout=5)
+            (fut, workerid), = executor.jobs.values()
+
+            with patch.dict(os.environ, {'SLURM_ARRAY_TASK_ID': '0'}):
+                worker(workerid + '+%a')
+            assert list(result_iter) == [9]
+
+def fail_on_two(n):
+    if n == 2:
+        raise ValueError("bad item")
+    return n * n
+
+def test_map_chunks():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                results = executor.map(fail_on_two, range(5), chunksize=2)
+            assert len(sbatch.get_calls()) == 3
+
+            run_all_outstanding_work()
+            assert [next(results), next(results)] == [0, 1]
+            with pytest.raises(cfut.RemoteException, match='bad item'):
+                next(results)
+            assert executor.call_time is not None
+
+def test_map_chunks_error():
+    with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+        with MockCommand('sbatch', python='import sys; sys.exit(1)'):
+            with pytest.raises(CommandError):
+                executor.map(square, range(4), chunksize=2)
+        assert not glob.glob(
+            os.path.join(executor.session.dir, '*', '*.in.pickle')
+        )
+        assert not executor.timings and not executor.payload_bytes
+
+def test_map_chunks_background():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        executor = cfut.SlurmExecutor(True, submitters=2)
+        executor.wait_thread.interval = 0.05
+        with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch, \
+                workers_running():
+            results = cfut.map(executor, square, range(4), chunksize=2)
+            assert list(results) == [0, 1, 4, 9]
+        assert len(sbatch.get_calls()) == 2
+
+def test_map_chunks_in_flight():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        executor = cfut.SlurmExecutor(True)
+        executor.wait_thread.interval = 0.05
+        in_flight = []
+        submit_chunks = executor._submit_chunks
+
+        def counting_submit_chunks(*args):
+            in_flight.append(len(executor.jobs))
+            return submit_chunks(*args)
+
+        with patch.object(executor, '_submit_chunks',
+                          counting_submit_chunks), \
+                MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch, \
+                workers_running():
+            results = cfut.map(executor, square, iter(range(7)),
+                               chunksize=3, max_in_flight=2)
+            assert list(results) == [n * n for n in range(7)]
+        assert len(sbatch.get_calls()) == 3
+        assert max(in_flight) < 2
+
+def test_auto_chunksize():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            assert executor._auto_chunksize() == 1
+            executor._observe_call_times([2.0])
+            assert executor._auto_chunksize() == 30
+
+def test_imap():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            executor.wait_thread.interval = 0.05
+            in_flight = []
+            submit = executor.submit
+
+            def counting_submit(*args, **kwargs):
+                in_flight.append(len(executor.jobs))
+                return submit(*args, **kwargs)
+
+            stop = threading.Event()
+
+            def run_workers():
+                while not stop.is_set():
+                    run_all_outstanding_work()
+                    time.sleep(0.05)
+
+            thread = threading.Thread(target=run_workers)
+            thread.start()
+            try:
+                with patch.object(executor, 'submit', counting_submit), \
+                        MockCommand('sbatch', python=SBATCH_JOB_COUNT):
+                    results = list(executor.imap(
+                        square, iter(range(10)), max_in_flight=3
+                    ))
+            finally:
+                stop.set()
+                thread.join()
+
+            assert results == [n * n for n in range(10)]
+            assert len(in_flight) == 10
+            assert max(in_flight) < 3
+
+SBATCH_SLOW = """
+import os, time
+time.sleep(0.5)
+print(os.getpid())
+"""
+
+def test_background_submit():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True,
+                                submitters=4) as executor:
+            with MockCommand('sbatch', python=SBATCH_SLOW):
+                start = time.monotonic()
+                futs = [executor.submit(square, n) for n in range(4)]
+                assert time.monotonic() - start < 0.4
+                assert executor.submit_queue_depth == 4
+
+                while executor.submit_queue_depth:
+                    time.sleep(0.05)
+            assert len(executor.jobs) == 4
+
+            run_all_outstanding_work()
+            assert [f.result(timeout=3) for f in futs] == [0, 1, 4, 9]
+
+def test_background_submit_error():
+    with cfut.SlurmExecutor(True, keep_logs=True, submitters=1) as executor:
+        with MockCommand('sbatch', python='import sys; sys.exit(1)'):
+            fut = executor.submit(square, 2)
+            with pytest.raises(CommandError):
+                fut.result(timeout=5)
+        assert not glob.glob(
+            os.path.join(executor.session.dir, '*', '*.in.pickle')
+        )
+
+def test_rate_limiter():
+    limiter = RateLimiter(20)
+    start = time.monotonic()
+    for _ in range(5):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.19
+
+SQUEUE_OUTPUT = """\
+1 RUNNING
+2 COMPLETED
+5_0 PENDING
+"""
+
+SACCT_OUTPUT = """\
+3|OUT_OF_MEMORY
+3.batch|OUT_OF_MEMORY
+4|CANCELLED by 1000
+"""
+
+def test_state_cache():
+    cache = slurm.StateCache()
+    with patch.object(slurm, 'STATE_CACHE', cache), \
+            MockCommand.fixed_output('squeue', SQUEUE_OUTPUT) as squeue, \
+            MockCommand.fixed_output('sacct', SACCT_OUTPUT) as sacct:
+        ids = [1, 2, 3, 4, '5_0', 6]
+        assert slurm.job_states(ids) == {
+            1: 'RUNNING', 2: 'COMPLETED', 3: 'OUT_OF_MEMORY',
+            4: 'CANCELLED', '5_0': 'PENDING', 6: slurm.UNKNOWN,
+        }
+        assert slurm.jobs_finished(ids) == {
+            2: 'COMPLETED', 3: 'OUT_OF_MEMORY', 4: 'CANCELLED',
+            6: slurm.UNKNOWN,
+        }
+
+    # The listing is cached, and jobs that left the queue are only looked
+    # up in the accounting database until it knows how they ended.
+    assert len(squeue.get_calls()) == 1
+    assert len(sacct.get_calls()) == 2
+    assert sacct.get_calls()[1]['argv'][-1] == '6'
+    assert '--me' in squeue.get_calls()[0]['argv']
+
+def test_state_cache_new_job():
+    cache = slurm.StateCache()
+    with patch.object(slurm, 'STATE_CACHE', cache), \
+            MockCommand.fixed_output('squeue', '1 RUNNING\n') as squeue, \
+            MockCommand.fixed_output('sacct', ''):
+        assert slurm.jobs_finished([1]) == {}
+        # Job 2 was submitted after that listing, so it isn't missing
+        # from the queue until a newer listing says so.
+        assert slurm.jobs_finished([1, 2]) == {}
+        assert len(squeue.get_calls()) == 1
+
+        cache.updated -= cache.interval
+        assert slurm.jobs_finished([1, 2]) == {2: slurm.UNKNOWN}
+        # Not remembered: sacct might not have heard of it yet.
+        assert '2' not in cache.final
+
+def test_state_cache_pruned():
+    cache = slurm.StateCache()
+    with patch.object(slurm, 'STATE_CACHE', cache), \
+            MockCommand.fixed_output('squeue', SQUEUE_OUTPUT), \
+            MockCommand.fixed_output('sacct', SACCT_OUTPUT):
+        assert slurm.jobs_finished([1, 2, 3]) == \
+            {2: 'COMPLETED', 3: 'OUT_OF_MEMORY'}
+        # Finished jobs are forgotten once they've been reported.
+        assert set(cache.first_asked) == {'1'}
+        assert not cache.final
+
+        # So is a job nobody asks about any more, at the next listing.
+        cache.updated -= cache.interval
+        assert slurm.job_states(['5_0']) == {'5_0': 'PENDING'}
+        assert set(cache.first_asked) == {'5_0'}
+
+def test_timing():
+    records = []
+    lines = io.StringIO()
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            executor.metrics.add_hook(records.append)
+            executor.metrics.add_hook(metrics.JsonLinesWriter(lines))
+            with MockCommand.fixed_output('sbatch', stdout='000000'):
+                fut = executor.submit(square, 2)
+            run_all_outstanding_work()
+            assert fut.result(timeout=3) == 4
+
+    assert sorted(fut.timing) == \
+        sorted(metrics.STEPS + ['max_rss', 'cpu_time'])
+    times = [fut.timing[step] for step in metrics.STEPS]
+    assert times == sorted(times)
+
+    record, = records
+    assert record['calls'] == 1 and record['failed'] == 0
+    assert set(record['phases']) == set(metrics.PHASES)
+    assert json.loads(lines.getvalue())['jobid'] == 0
+
+    summary = executor.metrics.summary()
+    assert summary['jobs'] == 1
+    assert summary['phases']['run']['count'] == 1
+    assert summary['payload_bytes']['in_raw'] == fut.payload_bytes['in_raw']
+
+def test_retry():
+    preempted = []
+    def preempt_first(job_ids):
+        if 0 in job_ids and not preempted:
+            preempted.append(0)
+            return {0: 'PREEMPTED'}
+        return {}
+
+    retry = cfut.RetryPolicy(backoff=0)
+    with patch.object(slurm, 'jobs_finished', preempt_first):
+        with cfut.SlurmExecutor(True, keep_logs=True, retry=retry) \
+                as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                fut = executor.submit(square, 3)
+                for _ in range(300):
+                    if 1 in executor.jobs:
+                        break
+                    time.sleep(0.01)
+            assert len(sbatch.get_calls()) == 2
+            assert list(executor.jobs) == [1]
+
+            # The input was kept for the second attempt.
+            run_all_outstanding_work()
+            assert fut.result(timeout=3) == 9
+            assert fut.attempts == 2
+
+    assert retry.delay(1) == 0
+    assert cfut.RetryPolicy(backoff=10, max_backoff=30).delay(3) == 30
+
+def fail(n):
+    raise ValueError(n)
+
+def test_lazy_results():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True, lazy_results=True) \
+                as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT):
+                fut = executor.submit(square, 3)
+                bad = executor.submit(fail, 1)
+                unread = executor.submit(square, 4)
+            workerid = executor.jobs[0][1]
+            unread_workerid = executor.jobs[2][1]
+            run_all_outstanding_work()
+            futures.wait([fut, bad, unread], timeout=5)
+
+            # Done, but not read yet.
+            assert 'loaded' not in fut.timing
+            assert os.path.exists(output_path(workerid))
+            assert fut.result() == 9
+            assert not os.path.exists(output_path(workerid))
+            assert isinstance(bad.exception(), cfut.RemoteException)
+
+            del unread
+            gc.collect()
+            assert not os.path.exists(output_path(unread_workerid))
+
+def test_slow_load():
+    # Reading one large result doesn't hold up noticing other jobs.
+    started, release = threading.Event(), threading.Event()
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True, keep_logs=True) as executor:
+            read_output = executor._read_output
+            def slow_read(jobid, *args):
+                if jobid == 0:
+                    started.set()
+                    release.wait(5)
+                return read_output(jobid, *args)
+            executor._read_output = slow_read
+
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT):
+                slow = executor.submit(square, 2)
+                run_all_outstanding_work()
+                assert started.wait(5)
+                quick = executor.submit(square, 3)
+                run_all_outstanding_work()
+            assert quick.result(timeout=5) == 9
+            assert not slow.done()
+            release.set()
+            assert slow.result(timeout=5) == 4
+
+SBATCH_SAVE_SCRIPTS = """
+import os, shutil, sys
+saved = os.environ['SAVED_SCRIPTS']
+count = len(os.listdir(saved))
+shutil.copy(sys.argv[-1], os.path.join(saved, str(count)))
+print(count)
+"""
+
+def test_dependency(tmp_path):
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished), \
+            patch.dict(os.environ, {'SAVED_SCRIPTS': str(tmp_path)}):
+        with cfut.SlurmExecutor(True) as executor:
+            with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS):
+                first = executor.submit(square, 2)
+                second = executor.submit(square, first)
+                bad = executor.submit(fail, 1)
+                after_bad = executor.submit(square, n=bad)
+            # Everything is queued up front.
+            script = (tmp_path / '1').read_text()
+            assert '#SBATCH --dependency=afterok:0' in script
+            assert '#SBATCH --dependency=afterok:2' in \
+                (tmp_path / '3').read_text()
+
+            worker(first.workerid)
+            assert first.result(timeout=3) == 4
+            # Kept for the job that needs it.
+            assert os.path.exists(output_path(first.workerid))
+
+            for fut in (second, bad, after_bad):
+                worker(fut.workerid)
+            assert second.result(timeout=3) == 16
+            assert 'UpstreamFailed' in str(after_bad.exception(timeout=3))
+            assert not os.path.exists(output_path(first.workerid))
+
+            # A future whose result is in is passed as its result.
+            with MockCommand('sbatch', python=SBATCH_SAVE_SCRIPTS):
+                third = executor.submit(square, first)
+            assert 'dependency' not in (tmp_path / '4').read_text()
+            worker(third.workerid)
+            assert third.result(timeout=3) == 16
+
+def test_foreign_future():
+    with cfut.SlurmExecutor(True) as executor:
+        with pytest.raises(TypeError):
+            executor.submit(square, futures.Future())
+
+def add(a, b):
+    return a + b
+
+def test_map_reduce():
+    with patch.object(slurm, 'jobs_finished', no_jobs_finished):
+        with cfut.SlurmExecutor(True) as executor:
+            with MockCommand('sbatch', python=SBATCH_JOB_COUNT) as sbatch:
+                fut = executor.map_reduce(square, add, range(5), fan_in=2)
+            # 5 maps, then 2, 1 and 1 reductions.
+            assert len(sbatch.get_calls()) == 9
+
+            run_all_outstanding_work()
+            assert fut.result(timeout=5) == 30
+            # Only the final result was loaded.
+            assert executor.metrics.summary()['jobs'] == 1
+            # The others are deleted once the jobs that read them are done.
+            outputs = os.path.join(executor.session.dir, '*', '*.out.pickle')
+            for _ in range(300):
+                gc.collect()
+                if not glob.glob(outputs):
+                    break
+                time.sleep(0.01)
+            assert not glob.glob(outputs)
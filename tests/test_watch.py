@@ -0,0 +1,41 @@
+import os
+
+import pytest
+
+from cfut import watch
+
+
+@pytest.mark.parametrize('name', sorted(watch.WATCHERS))
+def test_watchers_find_files(tmp_path, name):
+    watcher = watch.make_watcher(name)
+    try:
+        a, b = str(tmp_path / 'a'), str(tmp_path / 'b')
+        sub = str(tmp_path / 'sub' / 'c')
+        assert watcher.found([a, b, sub]) == set()
+
+        # Written the way workers write their output.
+        (tmp_path / 'a.tmp').write_text('x')
+        os.rename(a + '.tmp', a)
+        assert watcher.found([a, b, sub]) == {a}
+
+        (tmp_path / 'b').write_text('x')
+        os.makedirs(os.path.dirname(sub))
+        (tmp_path / 'sub' / 'c').write_text('x')
+        assert watcher.found([b, sub]) == {b, sub}
+    finally:
+        watcher.close()
+
+def test_inotify_sees_files_created_before_waiting(tmp_path):
+    watcher = watch.InotifyWatcher()
+    try:
+        a, b = str(tmp_path / 'a'), str(tmp_path / 'b')
+        assert watcher.found([a]) == set()
+        (tmp_path / 'b').write_text('x')
+        assert watcher.found([a]) == set()
+        assert watcher.found([a, b]) == {b}
+    finally:
+        watcher.close()
+
+def test_unknown_watcher():
+    with pytest.raises(ValueError):
+        watch.make_watcher('telepathy')
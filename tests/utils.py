@@ -1,12 +1,40 @@
+from contextlib import contextmanager
 import glob
 import os.path as osp
+import threading
+import time
 
 from cfut.util import local_filename
 from cfut.remote import worker
 
 def run_all_outstanding_work():
-    in_files = glob.glob(local_filename('cfut.in.*.pickle'))
-    worker_ids = [osp.basename(f)[len('cfut.in.'):-len('.pickle')]
+    in_files = glob.glob(local_filename('*/*/*.in.pickle'))
+    # Files are <session>/<shard>/<n>.in.pickle for worker <session>.<n>.
+    worker_ids = ['%s.%s' % (osp.basename(osp.dirname(osp.dirname(f))),
+                             osp.basename(f).split('.')[0])
                   for f in in_files]
+    # Run them in the order they were submitted, so that jobs that use
+    # others' results run after them.
+    worker_ids.sort(key=lambda wid: int(wid.rsplit('.', 1)[1]))
     for wid in worker_ids:
         worker(wid)
+
+@contextmanager
+def workers_running(interval=0.05):
+    """Keep running outstanding work in the background, for code that
+    waits for results as it submits.
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.is_set():
+            run_all_outstanding_work()
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()